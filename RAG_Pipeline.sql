@@ -91,6 +91,31 @@ CREATE TABLE Embeddings (
     embed_id SERIAL PRIMARY KEY,
     source_doc_id INT NOT NULL,
     chunk TEXT,
+    content_hash CHAR(64), -- sha256 of the chunk text, embedding model and chunking parameters, lets init_rag skip chunks already embedded
     embedding cs480_finalproject.vector(384),
     FOREIGN KEY (source_doc_id) REFERENCES Document(doc_id) ON DELETE CASCADE -- if source doc deleted, remove any embeddings that came from it too
-);
\ No newline at end of file
+);
+CREATE INDEX embeddings_doc_hash_index ON Embeddings (source_doc_id, content_hash);
+
+-- Semantic answer cache, an earlier answer is reused for a query within ANSWER_CACHE_MAX_DISTANCE of the one it
+-- answered, as long as the LLM, k, filters, prompt (context token budget and system prompt) and corpus (count and
+-- max embed_id of Embeddings) are all unchanged.
+-- answer_cache.py also creates it on first use in databases made before it existed.
+CREATE TABLE Answer_Cache (
+    cache_id SERIAL PRIMARY KEY,
+    query_text TEXT NOT NULL,
+    query_embedding cs480_finalproject.vector(384) NOT NULL,
+    embed_ids INT[] NOT NULL,   -- the chunks the answer was generated from
+    answer TEXT NOT NULL,
+    model VARCHAR(100) NOT NULL,
+    scope TEXT NOT NULL,        -- k, search filters, context token budget and a hash of the system prompt, see answer_cache.make_scope
+    corpus_version TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_hit_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    hits INT NOT NULL DEFAULT 0
+);
+CREATE INDEX answer_cache_hnsw_index ON Answer_Cache USING hnsw (query_embedding cs480_finalproject.vector_cosine_ops);
+CREATE INDEX answer_cache_last_hit_index ON Answer_Cache (last_hit_at);
+-- The HNSW index is built at run time by answer_queries.create_hnsw_index, on the embedding column itself or, with
+-- VECTOR_STORAGE=halfvec/binary, on a compact copy of it (existing rows are migrated by building that index), e.g.
+-- CREATE INDEX hnsw_halfvec_index ON Embeddings USING hnsw ((embedding::cs480_finalproject.halfvec(384)) cs480_finalproject.halfvec_cosine_ops);
\ No newline at end of file
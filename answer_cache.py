@@ -0,0 +1,147 @@
+# general utilities
+import os, time, hashlib, threading, dotenv
+import db_pool
+import context_packing  # the prompt's context budget, part of an answer's scope
+import llm_backend      # the system prompt, part of an answer's scope
+import query_cache  # the in-process corpus generation, bumped whenever this process changes the corpus
+import metrics
+
+dotenv.load_dotenv()
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_MAX_DISTANCE = float(os.environ.get("ANSWER_CACHE_MAX_DISTANCE", 0.08))     # cosine distance a paraphrase can be from a cached query
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 7 * 24 * 3600))             # seconds an answer is served for, 0 disables expiry
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", 10000))       # least recently hit answers are evicted past this
+ANSWER_CACHE_VERSION_INTERVAL = float(os.environ.get("ANSWER_CACHE_VERSION_INTERVAL", 5))  # seconds between checks for corpus changes made by other processes
+
+# One row per generated answer. The HNSW index finds the nearest cached query, the other columns decide whether its
+# answer still applies: same LLM, same retrieval and prompt settings ('scope') and an unchanged corpus.
+ANSWER_CACHE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS cs480_finalproject.answer_cache (
+        cache_id SERIAL PRIMARY KEY,
+        query_text TEXT NOT NULL,
+        query_embedding cs480_finalproject.vector(384) NOT NULL,
+        embed_ids INT[] NOT NULL,           -- the chunks the answer was generated from
+        answer TEXT NOT NULL,
+        model VARCHAR(100) NOT NULL,
+        scope TEXT NOT NULL,                -- k, search filters, context token budget and system prompt hash, see make_scope()
+        corpus_version TEXT NOT NULL,       -- see corpus_version()
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        last_hit_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        hits INT NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS answer_cache_hnsw_index ON cs480_finalproject.answer_cache
+        USING hnsw (query_embedding cs480_finalproject.vector_cosine_ops);
+    CREATE INDEX IF NOT EXISTS answer_cache_last_hit_index ON cs480_finalproject.answer_cache (last_hit_at);
+    """
+# along with the documents of the chunks the answer came from, for the query log
+LOOKUP_QUERY = """SELECT cache_id, query_text, answer, query_embedding <=> %(q)s::cs480_finalproject.vector AS distance,
+        ARRAY(SELECT e.source_doc_id FROM cs480_finalproject.embeddings e WHERE e.embed_id = ANY(c.embed_ids)
+              ORDER BY array_position(c.embed_ids, e.embed_id)) AS doc_ids
+    FROM cs480_finalproject.answer_cache c
+    WHERE model = %(model)s AND scope = %(scope)s AND corpus_version = %(version)s
+        AND (%(ttl)s = 0 OR created_at > CURRENT_TIMESTAMP - make_interval(secs => %(ttl)s))
+    ORDER BY distance
+    LIMIT 1;
+    """
+STORE_QUERY = """INSERT INTO cs480_finalproject.answer_cache (query_text, query_embedding, embed_ids, answer, model, scope, corpus_version)
+    VALUES (%s, %s, %s, %s, %s, %s, %s);
+    """
+# expired answers, answers for a corpus that has since changed (they can never be served again), then the least
+# recently hit ones past ANSWER_CACHE_MAX_ENTRIES
+EVICT_QUERY = """DELETE FROM cs480_finalproject.answer_cache
+    WHERE corpus_version <> %(version)s
+        OR (%(ttl)s > 0 AND created_at <= CURRENT_TIMESTAMP - make_interval(secs => %(ttl)s))
+        OR cache_id IN (
+            SELECT cache_id FROM cs480_finalproject.answer_cache
+            ORDER BY last_hit_at DESC
+            OFFSET %(max_entries)s
+        );
+    """
+
+hits = 0
+misses = 0
+_schema_ready = False
+_version = (None, 0.0, None)    # (corpus generation, time checked, version)
+_lock = threading.Lock()
+
+def ensure_schema(cur):
+    global _schema_ready
+    if not _schema_ready:
+        cur.execute(ANSWER_CACHE_SCHEMA)
+        cur.connection.commit()     # only marked ready once the table surely exists, a rolled back create is retried
+        _schema_ready = True
+
+def corpus_version(cur):
+    """
+    Changes whenever a row is added to or deleted from Embeddings: embed_id is a SERIAL, so any insert raises the max
+    and any delete lowers the count. Rechecked when this process bumps the corpus generation, and at least every
+    ANSWER_CACHE_VERSION_INTERVAL seconds for changes made by other processes.
+    """
+    global _version
+    generation, checked_at, version = _version
+    if generation != query_cache.corpus_generation or time.monotonic() - checked_at > ANSWER_CACHE_VERSION_INTERVAL:
+        cur.execute("SELECT count(*), coalesce(max(embed_id), 0) FROM cs480_finalproject.embeddings;")
+        version = "%d:%d" % cur.fetchone()
+        _version = (query_cache.corpus_generation, time.monotonic(), version)
+    return version
+
+# answers depend on how many chunks were retrieved, which documents they could come from, how much of them made it
+# in to the prompt and what the model was told to do with them
+def make_scope(k, filters=None, token_budget=None, system_prompt=None):
+    if filters is not None and filters.doc_ids is not None:
+        filters = filters._replace(doc_ids=tuple(sorted(filters.doc_ids)))
+    token_budget = context_packing.CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    prompt = hashlib.sha256((llm_backend.SYSTEM_PROMPT if system_prompt is None else system_prompt).encode("utf-8"))
+    return f"k={k};filters={filters!r};budget={token_budget};prompt={prompt.hexdigest()[:16]}"
+
+def _count(hit):
+    global hits, misses
+    with _lock:
+        if hit:
+            hits += 1
+        else:
+            misses += 1
+    metrics.count("answer_cache_hit" if hit else "answer_cache_miss")
+
+def lookup(q_emb, model, scope):
+    """
+    The cached answer of the nearest earlier query within ANSWER_CACHE_MAX_DISTANCE of 'q_emb', asked with the same
+    'model' and 'scope' against the current corpus. Returns a dict with 'answer', 'query_text', 'distance' and 'doc_ids'
+    (the documents of the chunks it was generated from), or None.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    with metrics.span("query.answer_cache_lookup") as span:
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            ensure_schema(cur)
+            cur.execute(LOOKUP_QUERY, {"q": q_emb, "model": model, "scope": scope, "version": corpus_version(cur),
+                                       "ttl": ANSWER_CACHE_TTL})
+            row = cur.fetchone()
+            hit = row is not None and row[3] <= ANSWER_CACHE_MAX_DISTANCE
+            if hit:
+                cur.execute("UPDATE cs480_finalproject.answer_cache SET hits = hits + 1, last_hit_at = CURRENT_TIMESTAMP "
+                            "WHERE cache_id = %s;", (row[0],))
+            conn.commit()
+        _count(hit)
+        span.add(hit=hit, distance=row[3] if row is not None else None)
+    if not hit:
+        return None
+    return {"query_text": row[1], "answer": row[2], "distance": row[3], "doc_ids": row[4]}
+
+def store(query, q_emb, embed_ids, answer, model, scope):
+    """
+    Cache 'answer' to 'query', generated by 'model' from the chunks 'embed_ids', then evict what has to go.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        ensure_schema(cur)
+        version = corpus_version(cur)
+        cur.execute(STORE_QUERY, (query, q_emb, list(embed_ids), answer, model, scope, version))
+        cur.execute(EVICT_QUERY, {"version": version, "ttl": ANSWER_CACHE_TTL, "max_entries": ANSWER_CACHE_MAX_ENTRIES})
+        conn.commit()
+
+def stats():
+    total = hits + misses
+    return {"hits": hits, "misses": misses, "hit_rate": hits / total if total else 0.0}
@@ -1,26 +1,52 @@
 # general utiliies
-import os, glob, dotenv, time
-import psycopg2
-from pgvector.psycopg2 import register_vector
+import os, glob, dotenv, time, io, struct, hashlib, threading
+from collections import defaultdict, namedtuple
+import numpy as np
+import db_pool      # shared connection pool, pgvector adapters are registered on every connection
 import pdf_helper   # helper module that processes initial Corpus
-from sentence_transformers import SentenceTransformer # for text -> vector embedding
+import artifact_manifest    # atomic writes of chunk files
+import embedding_cache  # on-disk cache of chunk embeddings, skips model.encode for chunks seen before
+import query_cache      # in-process caches for repeated queries
+import local_index      # optional in-process exact search, see SEARCH_BACKEND
+import metrics          # per-stage latency and throughput, a no-op unless METRICS_ENABLED
+import context_packing  # merges overlapping hits and fits them in the prompt's token budget
+import answer_cache     # answers to earlier paraphrases of a query, see ANSWER_CACHE_MAX_DISTANCE
 import subprocess    # detect at runtime if we have cuda installed
-import ollama
+import llm_backend      # the LLM answers come from, see LLM_BACKEND
+import query_log        # QueryLog rows are written in batches off the answer path
+import embedding_engine # length-bucketed batches, optional worker processes and ONNX/int8 models, see EMBED_BACKEND
 
 dotenv.load_dotenv()
 
 FETCH_K = int(os.environ.get("FETCH_K", 5))
-
-conn = psycopg2.connect(database="postgres",
-        host="localhost",
-        user="postgres",
-        password="postgres",
-        port="5432",
-        options="-c search_path=cs480_finalproject,public")
-register_vector(conn)
+LLM_MODEL = llm_backend.LLM_MODEL   # set with LLM_MODEL in .env
+INSERT_BATCH_SIZE = int(os.environ.get("INSERT_BATCH_SIZE", 1000))   # rows streamed per COPY
+MODEL_NAME = pdf_helper.EMBED_MODEL_NAME
+EMBED_DEVICE = os.environ.get("EMBED_DEVICE")   # "cpu" or "cuda", skips the nvidia-smi probe when set
+HNSW_M = int(os.environ.get("HNSW_M", 16))                              # graph links per node, pgvector's default
+HNSW_EF_CONSTRUCTION = int(os.environ.get("HNSW_EF_CONSTRUCTION", 64))  # candidate list size while building the index
+HNSW_EF_SEARCH = int(os.environ.get("HNSW_EF_SEARCH", 40))              # candidate list size per query, trades latency for recall
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "postgres")   # "local" searches an in-process copy of the Embeddings table
+VECTOR_STORAGE = os.environ.get("VECTOR_STORAGE", "full")       # what the HNSW index is built on: "full", "halfvec" or "binary"
+RERANK_OVERSAMPLE = int(os.environ.get("RERANK_OVERSAMPLE", 0))  # candidates per result for halfvec/binary, 0 uses DEFAULT_OVERSAMPLE
+EMBED_DIMENSION = 384   # all-MiniLM-L6-v2, matches Embeddings.embedding vector(384)
+FILTER_EXACT_MAX_ROWS = int(os.environ.get("FILTER_EXACT_MAX_ROWS", 20000))          # filters matching at most this many chunks are searched exactly
+FILTER_EXACT_SELECTIVITY = float(os.environ.get("FILTER_EXACT_SELECTIVITY", 0.05))   # ... as are filters matching at most this share of the corpus
+HNSW_ITERATIVE_SCAN = os.environ.get("HNSW_ITERATIVE_SCAN", "relaxed_order")        # for broad filters, "off" (or pgvector < 0.8) searches every filter exactly
+HNSW_MAX_SCAN_TUPLES = int(os.environ.get("HNSW_MAX_SCAN_TUPLES", 20000))            # stop an iterative scan after visiting this many rows
 
 chunks = []           # list[str]
 dimension = None      # embedding dimension
+embed_cache = None    # embedding_cache.EmbeddingCache, opened on first use
+
+# Loading the model and probing for CUDA take seconds, and Admin and Curator sessions never need either,
+# so both happen on first use instead of at import time.
+_model = None
+_device = None
+_engine = None
+_model_id = None
+_model_lock = threading.Lock()
+startup_timings = {}  # step name -> seconds it took, see report_startup()
 
 # use CLI function to figure out if the computer has CUDA installed
 def has_cuda():
@@ -34,45 +60,457 @@ def has_cuda():
     except FileNotFoundError:
         return False
 
-print("Loading SentenceTransformer model...")
+# detect at runtime if user has cuda installed, if so, use it. Only probes once per process.
+def get_device():
+    global _device
+    if _device is None:
+        start = time.perf_counter()
+        _device = EMBED_DEVICE or ("cuda" if has_cuda() else "cpu")
+        startup_timings["device_probe"] = time.perf_counter() - start
+    return _device
 
-# detect at runtime if user has cuda installed, if so, use it
-transform_device = "cuda" if has_cuda() else "cpu"
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2", device=transform_device)
+def get_model():
+    """
+    Returns the SentenceTransformer, loading it the first time it is needed.
+    """
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                print("Loading SentenceTransformer model...")
+                device = get_device()
+                start = time.perf_counter()
+                _model = embedding_engine.load_model(MODEL_NAME, device, embedding_engine.EMBED_BACKEND, embedding_engine.EMBED_THREADS)
+                startup_timings["model_load"] = time.perf_counter() - start
+                print(f"Model loaded on {device} in {startup_timings['model_load']:.2f} seconds")
+    return _model
+
+def get_engine():
+    """
+    Returns the EmbeddingEngine chunks are encoded with. With one worker it encodes with get_model() in this process,
+    on a GPU it always does.
+    """
+    global _engine
+    if _engine is None:
+        workers = 1 if get_device() != "cpu" else embedding_engine.EMBED_WORKERS
+        with _model_lock:
+            if _engine is None:
+                _engine = embedding_engine.EmbeddingEngine(MODEL_NAME, workers=workers, local_model=get_model)
+    return _engine
+
+def embed_model_id():
+    """
+    Names the model chunks are embedded with, the backend actually loaded on this device included.
+    """
+    global _model_id
+    if _model_id is None:
+        _model_id = embedding_engine.model_id(MODEL_NAME, embedding_engine.EMBED_BACKEND, get_device())
+    return _model_id
+
+# 'answer_queries.model' and 'answer_queries.transform_device' still work, they just load on first access now
+def __getattr__(name):
+    if name == "model":
+        return get_model()
+    if name == "transform_device":
+        return get_device()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def warm_up(background=True, on_done=None):
+    """
+    Load the model, open the database pool and have the LLM server load its model ahead of the first query.
 
+    With 'background' set this returns immediately and the work happens on a daemon thread. 'on_done' is called once
+    it has finished, e.g. report_startup.
+    """
+    def _warm():
+        start = time.perf_counter()
+        get_model()
+        db_pool.get_pool()
+        try:
+            llm_backend.get_backend().load()
+        except Exception as e:
+            print(f"Could not preload the LLM: {e}")
+        startup_timings["warm_up"] = time.perf_counter() - start
+        if on_done is not None:
+            on_done()
+
+    if not background:
+        _warm()
+        return None
+    thread = threading.Thread(target=_warm, name="answer_queries-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+def report_startup():
+    print("Startup timings: " + ", ".join(f"{step}={seconds:.2f}s" for step, seconds in startup_timings.items()))
+
+_report_after_first_query = False
+
+# Without a warm-up, the model and connections are loaded by the first query, so that is when the report is complete
+def report_startup_after_first_query():
+    global _report_after_first_query
+    _report_after_first_query = True
+
+def first_query_done(seconds):
+    global _report_after_first_query
+    if "first_query" not in startup_timings:
+        startup_timings["first_query"] = seconds
+    if _report_after_first_query:
+        _report_after_first_query = False
+        report_startup()
+
+
+# PostgreSQL binary COPY framing, see https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)    # signature, flags, header extension length
+COPY_TRAILER = struct.pack(">h", -1)
+COPY_EMBEDDINGS = """COPY cs480_finalproject.embeddings (source_doc_id, chunk, content_hash, embedding)
+    FROM STDIN WITH (FORMAT BINARY);"""
+
+# Identifies an embedding row by what produced it: the chunk text, the model (and backend) that embedded it and the
+# chunking parameters that cut it. If any of those change, the hash changes and the row gets re-embedded.
+def chunk_hash(chunk_text):
+    key = f"{embed_model_id()}\0{pdf_helper.chunking_signature()}\0{chunk_text}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+# Brings databases created before content hashes existed up to date, safe to run every start up
+def ensure_embeddings_schema(cur):
+    cur.execute("""ALTER TABLE cs480_finalproject.embeddings ADD COLUMN IF NOT EXISTS content_hash CHAR(64);""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS embeddings_doc_hash_index
+        ON cs480_finalproject.embeddings (source_doc_id, content_hash);""")
+
+# Serialize one batch of rows in to the binary COPY format and stream it to the server.
+# pgvector's binary representation of a vector is: int16 dim, int16 unused, dim * float32 (all big endian)
+def _copy_embeddings_batch(cur, doc_ids, chunk_texts, content_hashes, embeddings):
+    dim = embeddings.shape[1]
+    vector_prefix = struct.pack(">ihh", 4 + 4 * dim, dim, 0)    # field length, then pgvector's own header
+    vectors = np.ascontiguousarray(embeddings, dtype=">f4")     # one conversion for the whole batch, no .tolist()
+
+    buf = io.BytesIO()
+    buf.write(COPY_HEADER)
+    for doc_id, chunk, content_hash, vector in zip(doc_ids, chunk_texts, content_hashes, vectors):
+        text = chunk.encode("utf-8")
+        buf.write(struct.pack(">hii", 4, 4, doc_id))    # field count, then int4 source_doc_id
+        buf.write(struct.pack(">i", len(text)))
+        buf.write(text)
+        buf.write(struct.pack(">i", 64))
+        buf.write(content_hash.encode("ascii"))
+        buf.write(vector_prefix)
+        buf.write(vector.tobytes())
+    buf.write(COPY_TRAILER)
+    buf.seek(0)
+    cur.copy_expert(COPY_EMBEDDINGS, buf)
+
+def bulk_insert_embeddings(cur, doc_ids, chunk_texts, content_hashes, embeddings, batch_size=INSERT_BATCH_SIZE):
+    """
+    Stream rows in to the Embeddings table with binary COPY, 'batch_size' rows per COPY statement.
 
-def embed_and_index_chunks():
-    global chunks, model, dimension
+    'doc_ids', 'chunk_texts' and 'content_hashes' are parallel sequences to the rows of the 'embeddings' matrix.
+    Caller is responsible for committing. Returns the number of rows written.
+    """
+    total = len(chunk_texts)
+    if total == 0:
+        return 0
 
-    print("Embedding chunks...")
     start = time.time()
-    embed_chunks = [tup[0] for tup in chunks]
-    embeddings = model.encode(
-        embed_chunks,
-        convert_to_numpy=True,
-        normalize_embeddings=True
+    for i in range(0, total, batch_size):
+        _copy_embeddings_batch(cur, doc_ids[i:i+batch_size], chunk_texts[i:i+batch_size],
+                               content_hashes[i:i+batch_size], embeddings[i:i+batch_size])
+    elapsed = time.time() - start
+    metrics.record("ingest.insert", elapsed, items=total)
+
+    print(f"    Inserted {total} rows in {elapsed:.2f} seconds ({total / max(elapsed, 1e-9):.0f} rows/s)")
+    return total
+
+# Encode document chunks, only running the model on chunks that are not in the on-disk embedding cache
+def encode_chunks(texts):
+    global embed_cache
+
+    if embed_cache is None:
+        embed_cache = embedding_cache.EmbeddingCache(embed_model_id(), normalize=True)
+
+    keys = [embedding_cache.text_hash(text) for text in texts]
+    embeddings, missing = embed_cache.get_many(keys)
+    if missing:
+        engine = get_engine()
+        with metrics.span("ingest.embed", cached=len(texts) - len(missing), backend=engine.backend, workers=engine.workers) as span:
+            encoded = engine.encode([texts[i] for i in missing])
+            span.add(items=len(missing), **engine.last_stats)
+        if embeddings is None:
+            embeddings = encoded
+        else:
+            embeddings[missing] = encoded
+        embed_cache.put_many([keys[i] for i in missing], encoded)
+        embed_cache.save()
+
+    stats = embed_cache.stats()
+    print(f"    Embedding cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries")
+    return embeddings
+
+# What the HNSW index is built on. "full" indexes the float32 vectors themselves, "halfvec" indexes a float16 copy
+# (half the index size) and "binary" a one bit per dimension copy (1/32 of it). The compact copies are expression
+# indexes, Embeddings.embedding keeps the full vectors, and candidates found through them are reranked on those.
+INDEX_NAMES = {"full": "hnsw_index", "halfvec": "hnsw_halfvec_index", "binary": "hnsw_binary_index"}
+INDEX_EXPRESSIONS = {
+    "full": "embedding cs480_finalproject.vector_cosine_ops",
+    "halfvec": f"(embedding::cs480_finalproject.halfvec({EMBED_DIMENSION})) cs480_finalproject.halfvec_cosine_ops",
+    "binary": f"(cs480_finalproject.binary_quantize(embedding)::bit({EMBED_DIMENSION})) cs480_finalproject.bit_hamming_ops",
+}
+# distance each compact index orders candidates by, it has to match the index expression for the index to be used
+CANDIDATE_DISTANCES = {
+    "halfvec": f"embedding::cs480_finalproject.halfvec({EMBED_DIMENSION}) <=> {{q}}::cs480_finalproject.vector::cs480_finalproject.halfvec({EMBED_DIMENSION})",
+    "binary": f"cs480_finalproject.binary_quantize(embedding)::bit({EMBED_DIMENSION}) <~> cs480_finalproject.binary_quantize({{q}}::cs480_finalproject.vector)",
+}
+DEFAULT_OVERSAMPLE = {"full": 1, "halfvec": 2, "binary": 10}     # candidates fetched per result, binary loses the most precision
+
+# Create an HNSW index for searching, HNSW picks up inserted rows on its own so this only builds it the first time
+CREATE_HNSW_INDEX = """CREATE INDEX IF NOT EXISTS {name} ON cs480_finalproject.embeddings
+    USING hnsw ({expression}) WITH (m = {m}, ef_construction = {ef_construction});"""
+HNSW_INDEX_OPTIONS = """SELECT c.reloptions FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = 'cs480_finalproject' AND c.relname = %s;"""
+
+# Nearest neighbors of one query vector, {q}, {k} and {candidates} are filled in with the driver's placeholders and
+# {where} with an optional filter. hnsw.ef_search only applies to the transaction it is set in.
+FULL_SEARCH_TEMPLATE = """SELECT embed_id, chunk, embedding <=> {q}::cs480_finalproject.vector AS distance, source_doc_id
+    FROM cs480_finalproject.embeddings{where}
+    ORDER BY distance
+    LIMIT {k}
+    """
+# two stages: the compact index finds 'candidates' rows, which are reranked by exact cosine distance
+RERANK_SEARCH_TEMPLATE = """SELECT embed_id, chunk, embedding <=> {q}::cs480_finalproject.vector AS distance, source_doc_id
+    FROM (
+        SELECT embed_id, chunk, embedding, source_doc_id
+        FROM cs480_finalproject.embeddings{where}
+        ORDER BY {candidate_distance}
+        LIMIT {candidates}
+    ) AS candidates
+    ORDER BY distance
+    LIMIT {k}
+    """
+
+# a filtered search that is selective enough reads the matching rows and sorts them exactly, MATERIALIZED keeps the
+# planner from turning it back in to an HNSW scan that would run out of matching rows before finding k
+FILTERED_EXACT_QUERY = """WITH matching AS MATERIALIZED (
+        SELECT embed_id, chunk, embedding, source_doc_id
+        FROM cs480_finalproject.embeddings
+        WHERE source_doc_id = ANY(%(doc_ids)s)
     )
+    SELECT embed_id, chunk, embedding <=> %(q)s::cs480_finalproject.vector AS distance, source_doc_id
+    FROM matching
+    ORDER BY distance
+    LIMIT %(k)s;
+    """
 
-    dimension = embeddings.shape[1]
-
-    print(f"Model loaded. Embedding dimension = {dimension}")
-    
-    # Insert embeddings into psql database
-    # TODO: make sure table format matches
-    cur = conn.cursor()
-    for (chunk_text, doc_id), embedding in zip(chunks, embeddings):
-        insert_query = """
-        INSERT INTO cs480_finalproject.embeddings (source_doc_id, chunk, embedding)
-        VALUES (%s, %s, %s)
-        """
-        cur.execute(insert_query, (doc_id, chunk_text, embedding.tolist()))
-    conn.commit()
+def search_sql(q, k, candidates, storage=None, doc_ids=None):
+    storage = storage or VECTOR_STORAGE
+    where = f"\n    WHERE source_doc_id = ANY({doc_ids})" if doc_ids else ""
+    if storage == "full":
+        sql = FULL_SEARCH_TEMPLATE.format(q=q, k=k, where=where)
+        # an iterative scan may return rows slightly out of order, sort them again
+        return f"SELECT * FROM ({sql}) AS nearest ORDER BY distance" if doc_ids else sql
+    return RERANK_SEARCH_TEMPLATE.format(q=q, k=k, candidates=candidates, where=where,
+                                         candidate_distance=CANDIDATE_DISTANCES[storage].format(q=q))
+
+SEARCH_QUERY = search_sql("%(q)s", "%(k)s", "%(candidates)s")
+
+# how many candidates the index has to find to return k results
+def candidate_count(k, storage=None, oversample=None):
+    storage = storage or VECTOR_STORAGE
+    return k * (oversample or RERANK_OVERSAMPLE or DEFAULT_OVERSAMPLE[storage])
+
+def create_hnsw_index(cur, storage=None, drop_others=True):
+    """
+    Build the HNSW index for 'storage' (default VECTOR_STORAGE) with HNSW_M and HNSW_EF_CONSTRUCTION, rebuilding it if
+    it exists with different settings. Building the index over existing rows is the whole migration between storage
+    modes, the indexes of the other modes are dropped unless 'drop_others' is False.
+
+    Returns True if the index was (re)built.
+    """
+    storage = storage or VECTOR_STORAGE
+    name = INDEX_NAMES[storage]
+    if drop_others:
+        for other in INDEX_NAMES.values():
+            if other != name:
+                cur.execute(f"DROP INDEX IF EXISTS cs480_finalproject.{other};")
+
+    cur.execute(HNSW_INDEX_OPTIONS, (name,))
+    row = cur.fetchone()
+    wanted = {f"m={HNSW_M}", f"ef_construction={HNSW_EF_CONSTRUCTION}"}
+    if row is not None:
+        # an index built before these settings existed has no reloptions, which means pgvector's defaults
+        options = set(row[0] or ["m=16", "ef_construction=64"])
+        if options == wanted:
+            return False
+        print(f"  Rebuilding {name} with m={HNSW_M}, ef_construction={HNSW_EF_CONSTRUCTION}")
+        cur.execute(f"DROP INDEX cs480_finalproject.{name};")
+    with metrics.span("ingest.index_build", storage=storage, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION):
+        cur.execute(CREATE_HNSW_INDEX.format(name=name, expression=INDEX_EXPRESSIONS[storage], m=HNSW_M,
+                                             ef_construction=HNSW_EF_CONSTRUCTION))
+    return True
+
+def set_ef_search(cur, ef_search=None):
+    """
+    Set hnsw.ef_search for the current transaction. An index scan returns at most ef_search rows, so it should be
+    at least k.
+    """
+    cur.execute("SELECT set_config('hnsw.ef_search', %s, true);", (str(ef_search or HNSW_EF_SEARCH),))
+
+# Restricts a search to some documents. Fields left as None match everything, the time range is [after, before).
+SearchFilter = namedtuple("SearchFilter", ["doc_ids", "doc_type", "added_by", "added_after", "added_before"],
+                          defaults=(None, None, None, None, None))
+
+def filtered_doc_ids(cur, filters):
+    """
+    The doc_ids of every document matching 'filters', or None if 'filters' doesn't restrict anything.
+    """
+    clauses, params = [], []
+    if filters.doc_ids is not None:
+        clauses.append("doc_id = ANY(%s)")
+        params.append(list(filters.doc_ids))
+    if filters.doc_type is not None:
+        clauses.append("type = %s")
+        params.append(filters.doc_type)
+    if filters.added_by is not None:
+        clauses.append("added_by = %s")
+        params.append(filters.added_by)
+    if filters.added_after is not None:
+        clauses.append("time_added >= %s")
+        params.append(filters.added_after)
+    if filters.added_before is not None:
+        clauses.append("time_added < %s")
+        params.append(filters.added_before)
+    if not clauses:
+        return None
+    cur.execute("SELECT doc_id FROM cs480_finalproject.document WHERE " + " AND ".join(clauses) + ";", params)
+    return [row[0] for row in cur.fetchall()]
+
+# doc_id -> number of Embeddings rows, recounted whenever the corpus generation changes. Only used to estimate how
+# selective a filter is, so a count that is a little stale (another process changed the table) does no harm.
+_doc_row_counts = (None, {})
+
+def doc_row_counts(cur):
+    global _doc_row_counts
+    generation, counts = _doc_row_counts
+    if generation != query_cache.corpus_generation:
+        cur.execute("SELECT source_doc_id, count(*) FROM cs480_finalproject.embeddings GROUP BY source_doc_id;")
+        counts = dict(cur.fetchall())
+        _doc_row_counts = (query_cache.corpus_generation, counts)
+    return counts
+
+# hnsw.iterative_scan is new in pgvector 0.8, older servers reject the setting. Checked once per process.
+_iterative_scan_supported = None
+
+def iterative_scan_supported(cur):
+    global _iterative_scan_supported
+    if _iterative_scan_supported is None:
+        cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector';")
+        row = cur.fetchone()
+        version = tuple(int(part) for part in row[0].split(".")[:2] if part.isdigit()) if row else ()
+        _iterative_scan_supported = version >= (0, 8)
+        if not _iterative_scan_supported and HNSW_ITERATIVE_SCAN != "off":
+            print(f"  pgvector {row[0] if row else '?'} has no iterative index scan (0.8+), filtered searches are exact")
+    return _iterative_scan_supported
+
+def nearest_rows(cur, q_emb, k, ef_search=None, storage=None, oversample=None, filters=None):
+    """
+    (embed_id, chunk, distance, source_doc_id) of the k chunks nearest to 'q_emb', searching the index of 'storage'.
+
+    ef_search is raised to the candidate count when it is smaller, or the index scan would come back short.
+    With 'filters', a filter matching few chunks (at most FILTER_EXACT_MAX_ROWS, or FILTER_EXACT_SELECTIVITY of the
+    corpus) is searched exactly over just those chunks. A broader one walks the HNSW index with an iterative scan,
+    which keeps going until k matching rows are found instead of filtering an already cut off top k. Before pgvector
+    0.8 there is no iterative scan, and every filter is searched exactly.
+    """
+    doc_ids = filtered_doc_ids(cur, filters) if filters is not None else None
+    params = {"q": q_emb.tolist(), "k": k, "doc_ids": doc_ids}
+    if doc_ids is not None:
+        counts = doc_row_counts(cur)
+        matching = sum(counts.get(doc_id, 0) for doc_id in doc_ids)
+        if matching == 0:
+            return []
+        if (HNSW_ITERATIVE_SCAN == "off" or matching <= FILTER_EXACT_MAX_ROWS
+                or matching <= FILTER_EXACT_SELECTIVITY * sum(counts.values()) or not iterative_scan_supported(cur)):
+            cur.execute(FILTERED_EXACT_QUERY, params)
+            return cur.fetchall()
+        cur.execute("SELECT set_config('hnsw.iterative_scan', %s, true), set_config('hnsw.max_scan_tuples', %s, true);",
+                    (HNSW_ITERATIVE_SCAN, str(HNSW_MAX_SCAN_TUPLES)))
+
+    params["candidates"] = candidate_count(k, storage, oversample)
+    set_ef_search(cur, max(ef_search or HNSW_EF_SEARCH, params["candidates"]))
+    cur.execute(search_sql("%(q)s", "%(k)s", "%(candidates)s", storage, "%(doc_ids)s" if doc_ids is not None else None), params)
+    return cur.fetchall()
+
+# (doc_id, content_hash) -> embed_ids already stored, a list because a document can repeat a chunk verbatim
+def load_stored_embeddings():
+    with db_pool.connection() as conn:
+        with conn.cursor() as cur:
+            ensure_embeddings_schema(cur)
+            cur.execute("SELECT embed_id, source_doc_id, content_hash FROM cs480_finalproject.embeddings;")
+            rows = cur.fetchall()
+        conn.commit()
+
+    stored = defaultdict(list)
+    for embed_id, doc_id, content_hash in rows:
+        stored[(doc_id, content_hash)].append(embed_id)
+    return stored
+
+# Diff the chunks loaded from disk against the Embeddings table, only embedding and inserting the ones that are
+# missing and deleting rows whose chunk no longer exists. Does nothing to the table or index when already in sync.
+def embed_and_index_chunks():
+    global chunks, dimension
+
+    print("Syncing embeddings...")
+    start = time.time()
+
+    stored = load_stored_embeddings()
+
+    missing = []    # (chunk_text, doc_id, content_hash)
+    for chunk_text, doc_id in chunks:
+        content_hash = chunk_hash(chunk_text)
+        matches = stored.get((doc_id, content_hash))
+        if matches:
+            matches.pop()   # this chunk is already embedded, claim one of its rows
+        else:
+            missing.append((chunk_text, doc_id, content_hash))
+
+    # only prune documents we actually loaded chunks for, a document whose chunk file went missing keeps its rows
+    loaded_docs = {doc_id for _, doc_id in chunks}
+    stale = [embed_id for (doc_id, _), embed_ids in stored.items() if doc_id in loaded_docs for embed_id in embed_ids]
+
+    if not missing and not stale:
+        # the rows are in sync, but the index may still need building with new HNSW settings
+        with db_pool.connection() as conn, conn.cursor() as cur:
+            rebuilt = create_hnsw_index(cur)
+            conn.commit()
+        if rebuilt:
+            query_cache.bump_corpus_generation()
+        print(f"Embeddings already up to date. Took {time.time() - start:.2f} seconds")
+        return
+
+    print(f"  {len(missing)} new chunks to embed, {len(stale)} stale rows to delete")
 
-    # Create an HNSW index for searching
-    create = """CREATE INDEX IF NOT EXISTS hnsw_index ON cs480_finalproject.embeddings USING hnsw (embedding cs480_finalproject.vector_cosine_ops);"""
-    cur.execute(create)
-    conn.commit()
-    cur.close()
+    # encode before checking out a connection, so we don't hold one open for the slowest step
+    embed_chunks = [tup[0] for tup in missing]
+    if missing:
+        embeddings = encode_chunks(embed_chunks)
+        dimension = embeddings.shape[1]
+        print(f"Model loaded. Embedding dimension = {dimension}")
+
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        if stale:
+            cur.execute("DELETE FROM cs480_finalproject.embeddings WHERE embed_id = ANY(%s);", (stale,))
+
+        if missing:
+            # Insert embeddings into psql database
+            doc_ids = [tup[1] for tup in missing]
+            content_hashes = [tup[2] for tup in missing]
+            bulk_insert_embeddings(cur, doc_ids, embed_chunks, content_hashes, embeddings)
+
+        create_hnsw_index(cur)
+        conn.commit()
+        cur.close()
+
+    query_cache.bump_corpus_generation()   # cached search results may reference deleted rows or miss new ones
 
     print(f"Embedding & indexing complete. Took {time.time() - start:.2f} seconds")
 
@@ -82,7 +520,7 @@ def update_all_chunks():
 
     chunks = []
 
-    with conn.cursor() as cur:
+    with db_pool.connection() as conn, conn.cursor() as cur:
         # Get all documents and their IDs from the DB
         cur.execute("""
             SELECT doc_id, source
@@ -94,20 +532,17 @@ def update_all_chunks():
         print("No documents found in the database.")
         return
 
+    # bring the extracted and chunked text up to date, only pdfs and text files that changed (or were never
+    # processed, or were processed with different settings) are redone
+    pdf_helper.process_pdf_to_txt()
+    pdf_helper.chunk_processed_txt()
+
     for doc_id, source in docs:
         # each source pdf should have had its text extracted and chunked, find the path for that chunked file
-        base_name = os.path.splitext(os.path.basename(source))[0]   # remove .pdf
-        txt_path = os.path.join(pdf_helper.CHUNKS_OUTPUT_DIRECTORY, base_name + ".txt")
-
-        # for some reason, it wasn't already extracted and chunked, do it now
+        txt_path = pdf_helper.chunked_txt_path(pdf_helper.extracted_txt_path(source))
         if not os.path.exists(txt_path):
-            print(f"Chunked text not found for {source} — regenerating.")
-            pdf_helper.process_pdf_to_txt()       # regenerate corpus
-            pdf_helper.chunk_processed_txt()      # re-chunk
-            # after regeneration, check again
-            if not os.path.exists(txt_path):
-                print(f"Still missing chunks for {source}, skipping.")
-                continue
+            print(f"Missing chunks for {source}, skipping.")
+            continue
 
         # Load chunks from the file
         with open(txt_path, "r", encoding="utf-8") as f:
@@ -160,6 +595,8 @@ def update_all_chunks():
 def init_rag():
     """
     Call this once in any external script.
+
+    Safe to call repeatedly, only chunks that are new or changed since the last call get embedded.
     """
     update_all_chunks()
     embed_and_index_chunks()
@@ -169,7 +606,8 @@ def init_rag():
 # take a pdf, extract it, chunk it, embed it, and add it index (last portion handled internally by HNSW)
 def add_document_to_index(pdf_path):
     # pdf_path is a source that should already exist in the DB Document table
-    with conn.cursor() as cur:
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        ensure_embeddings_schema(cur)
         doc_id_query = """
             SELECT doc_id
             FROM cs480_finalproject.document
@@ -178,116 +616,171 @@ def add_document_to_index(pdf_path):
         cur.execute(doc_id_query, (pdf_path,))
         result = cur.fetchone()
         new_doc_id = result[0]   # guaranteed to exist
+        # chunks an earlier, interrupted call already committed, by content hash
+        cur.execute("SELECT content_hash FROM cs480_finalproject.embeddings WHERE source_doc_id = %s;", (new_doc_id,))
+        stored = defaultdict(int)
+        for (content_hash,) in cur.fetchall():
+            stored[content_hash] += 1
+        conn.commit()
 
-    global model
     _ = pdf_helper.extract_pdf(pdf_path)
 
     # extract out the text from the pdf and chunk it
-    base_name = os.path.splitext(os.path.basename(pdf_path))[0]
-    chunked_path = pdf_helper.CHUNKS_OUTPUT_DIRECTORY + "/" + base_name + ".txt"
-    txt_path = pdf_helper.TXT_OUTPUT_DIRECTORY + "/" + base_name + ".txt"
-    with open(txt_path, "r", encoding="utf-8") as r:
-        text = r.read()
-    
-        text = pdf_helper.normalize(text) # strips repetitive whitespace
-    
-    # write the chunks to a Chunked_txt directory
-    chunked = pdf_helper.chunk_text(text, pdf_helper.CHUNK_WORD_COUNT, pdf_helper.OVERLAP)
-    with open(chunked_path, "x", encoding="utf-8") as f:
-        for chunk in chunked:
-            f.write(chunk + "\n")
-    
-    embeddings = model.encode(
-        chunked,
-        convert_to_numpy=True,
-        normalize_embeddings=True
-    )
-    cur = conn.cursor()
-    for chunk_text, embedding in zip(chunked, embeddings):
-        insert_query = """
-        INSERT INTO cs480_finalproject.embeddings (source_doc_id, chunk, embedding)
-        VALUES (%s, %s, %s)
-        """
-        cur.execute(insert_query, (new_doc_id, chunk_text, embedding.tolist()))
-    
-    # after processing, set "processed" to true
-    process_doc_query = """
-        UPDATE cs480_finalproject.document
-        SET processed = TRUE
-        WHERE source = %s
-        RETURNING doc_id;
-    """
-    cur.execute(process_doc_query, (pdf_path,))
-    
-    conn.commit()
-
-
-# turn query text in to an embedding, then search our index
-def search(query, k=FETCH_K):
-    global model
+    txt_path = pdf_helper.extracted_txt_path(pdf_path)
+    chunked_path = pdf_helper.chunked_txt_path(txt_path)
+
+    # stream the text through the chunker a batch at a time, writing each batch to the Chunked_txt directory and
+    # embedding it, so memory stays bounded by the batch size however large the document is. Each batch is encoded
+    # before checking out a connection, so we don't hold one open for the slowest step, and committed on its own
+    with artifact_manifest.atomic_write(chunked_path) as f:
+        for chunked in pdf_helper.batched(pdf_helper.iter_chunks(txt_path), INSERT_BATCH_SIZE):
+            for chunk in chunked:
+                f.write(chunk + "\n")
+            pending = []
+            for chunk in chunked:
+                content_hash = chunk_hash(chunk)
+                if stored[content_hash]:
+                    stored[content_hash] -= 1   # already embedded
+                else:
+                    pending.append((chunk, content_hash))
+            if not pending:
+                continue
+            texts = [tup[0] for tup in pending]
+            embeddings = encode_chunks(texts)
+            with db_pool.connection() as conn, conn.cursor() as cur:
+                bulk_insert_embeddings(cur, [new_doc_id] * len(texts), texts, [tup[1] for tup in pending], embeddings)
+                conn.commit()
 
-    q_emb = model.encode([query], convert_to_numpy=True, normalize_embeddings=True)[0]
-    
-    # Search nearest neighbors
-    cur = conn.cursor()
-    # TODO: check query
-    search_query = """SELECT embed_id, chunk, embedding <=> %s::cs480_finalproject.vector AS distance
-        FROM cs480_finalproject.embeddings
-        ORDER BY distance
-        LIMIT %s;
+    # after processing, set "processed" to true
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        process_doc_query = """
+            UPDATE cs480_finalproject.document
+            SET processed = TRUE
+            WHERE source = %s
+            RETURNING doc_id;
         """
-    cur.execute(search_query, (q_emb.tolist(), k))
-
-    results = cur.fetchall()
-    print(results)
-    cur.close()
-
+        cur.execute(process_doc_query, (pdf_path,))
+        conn.commit()
+    pdf_helper.get_manifest().record(chunked_path, txt_path, pdf_helper.chunking_params())
+    query_cache.bump_corpus_generation()
+
+
+# turn query text in to an embedding, reusing the embedding of an identical earlier query
+def embed_query(query):
+    key = query_cache.normalize_query(query)
+    q_emb = query_cache.query_embeddings.get(key)
+    if q_emb is None:
+        with metrics.span("query.encode"):
+            q_emb = get_model().encode([query], convert_to_numpy=True, normalize_embeddings=True)[0]
+        query_cache.query_embeddings.put(key, q_emb)
+    else:
+        metrics.count("query_embedding_cache_hit")
+    return q_emb
+
+# results are only valid for the corpus they were computed against, and depend on how hard the index searched
+def result_cache_key(q_emb, k, ef_search=None, filters=None):
+    return (query_cache.embedding_key(q_emb), k, ef_search or HNSW_EF_SEARCH, filters, query_cache.corpus_generation)
+
+# turn (embed_id, chunk, distance, source_doc_id) rows in to ranked hits
+def rank_results(results, k):
     top_k = []
     # make ranking start at 1 instead of 0
     for rank, item in enumerate(results[:k], start=1):
         top_k.append({
             "rank": rank,
             "score": item[2],
-            "chunk": item[1]
+            "chunk": item[1],
+            "doc_id": item[3],
+            "embed_id": item[0]
         })
-
     return top_k
 
-def queryDB(enduser_id):
+# turn query text in to an embedding, then search our index
+# ef_search overrides HNSW_EF_SEARCH for this query, higher finds the true nearest chunks more often but takes longer
+# filters (a SearchFilter) restricts the search to matching documents
+def search(query, k=FETCH_K, ef_search=None, filters=None):
+    q_emb = embed_query(query)
+    if filters is not None and filters.doc_ids is not None:
+        filters = filters._replace(doc_ids=tuple(sorted(filters.doc_ids)))  # hashable, and the same key in any order
+
+    result_key = result_cache_key(q_emb, k, ef_search, filters)
+    cached = query_cache.search_results.get(result_key)
+    if cached is not None:
+        metrics.count("search_result_cache_hit")
+        return [dict(hit) for hit in cached]
+
+    # Search nearest neighbors
+    with metrics.span("query.search", backend=SEARCH_BACKEND, filtered=filters is not None) as span:
+        if SEARCH_BACKEND == "local":
+            doc_ids = None
+            if filters is not None:
+                with db_pool.connection() as conn, conn.cursor() as cur:
+                    doc_ids = filtered_doc_ids(cur, filters)
+            results = local_index.search(q_emb, k, doc_ids)[0]
+        else:
+            with db_pool.connection() as conn:
+                cur = conn.cursor()
+                results = nearest_rows(cur, q_emb, k, ef_search, filters=filters)
+                cur.close()
+        span.add(items=len(results))
+
+    top_k = rank_results(results, k)
+    query_cache.search_results.put(result_key, top_k)
+    return [dict(hit) for hit in top_k]
+
+# Construct a RAG-style prompt by injecting the retrieved hits, returns the chat messages to send to the LLM
+# Overlapping chunks of a document are merged and the context is held to CONTEXT_TOKEN_BUDGET (or 'token_budget'),
+# so prefill time stays bounded whatever FETCH_K is, see context_packing.py
+def build_messages(query, hits, token_budget=None):
+    with metrics.span("query.prompt_build") as span:
+        passages, stats = context_packing.pack_context(hits, token_budget)
+        context = "\n\n".join(passage["text"] for passage in passages)
+        prompt = f"Context:\n{context}\n\nQuestion: {query}\n\nAnswer:"
+        span.add(items=len(hits), prompt_chars=len(prompt), **stats)
+    # the instructions live in the fixed system prompt, so every request shares a prefix the server can cache
+    return [
+        {"role": "system", "content": llm_backend.SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+def print_hits(hits):
+    print("\nTop matches:")
+    for h in hits:
+        print(f"[{h['rank']}] score={h['score']:.3f}\n{h['chunk'][:200]}...\n---")
+    print("\n")
+
+def queryDB(enduser_id, filters=None):
     query = input("What would you like to know about? Answer with \"X\" or nothing to exit.\n->")
     while query and query != "X":
-        # intentional query made, log it
-        with conn.cursor() as cur:
-            querylog_insert = """INSERT INTO QueryLog (query_text, issuer_id)
-            VALUES (%s, %s)
-            """
-            cur.execute(querylog_insert, (query, enduser_id))
-            conn.commit()
-
-        hits = search(query, k=FETCH_K)
-
-        print("\nTop matches:")
-        for h in hits:
-            print(f"[{h['rank']}] score={h['score']:.3f}\n{h['chunk'][:200]}...\n---")
-        print("\n")
-
-        print("Thinking...")    
-        # Construct a RAG-style prompt by injecting the retrieved hits
-        context = "\n".join([hit['chunk'] for hit in hits])
-        prompt = f"Answer the following question grounded on, but not absolutely limited to, the provided context.\n\nContext:\n{context}\n\nQuestion: {query}\n\nAnswer:"
-
-        # Query the local Ollama endpoint
-        response = ollama.chat(
-            model="llama3",   # replace with the model you have locally
-            messages=[
-                {"role": "system", "content": "You are a domain expert assistant."},
-                {"role": "user", "content": prompt}
-            ]
-        )
+        start = time.perf_counter()
+        with metrics.span("query.answer"):
+            # a paraphrase of a question answered before, against the same corpus, gets the same answer
+            backend = llm_backend.get_backend()
+            scope = answer_cache.make_scope(FETCH_K, filters)
+            cached = answer_cache.lookup(embed_query(query), backend.model, scope)
+            if cached is not None:
+                answer = cached["answer"]
+                query_log.log_query(query, enduser_id, cached["doc_ids"])  # intentional query made, log it with its answer's documents
+                print(f"(cached answer to \"{cached['query_text']}\", distance {cached['distance']:.3f})")
+            else:
+                hits = search(query, k=FETCH_K, filters=filters)
+                # intentional query made, log it with the documents it fetched, written behind by query_log's thread
+                query_log.log_query(query, enduser_id, [hit["doc_id"] for hit in hits])
+                print_hits(hits)
+
+                print("Thinking...")
+                # Query the local Ollama endpoint, through the process wide client
+                response = backend.chat(build_messages(query, hits))
+                answer = response["message"]["content"]
+                answer_cache.store(query, embed_query(query), [hit["embed_id"] for hit in hits], answer, backend.model, scope)
+        first_query_done(time.perf_counter() - start)
         print("\n")
-        print(response["message"]["content"])
+        print(answer)
         print("\n\n")
         query = input("What would you like to know about? Answer with \"X\" or nothing to exit.\n->")
+    if answer_cache.hits + answer_cache.misses:
+        stats = answer_cache.stats()
+        print(f"Answer cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate)")
     print("Returning to role selection...")
 
 if __name__ == "__main__":
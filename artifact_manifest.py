@@ -0,0 +1,122 @@
+# general utilities
+import os, json, hashlib, threading
+
+HASH_BLOCK_SIZE = 1 << 20   # bytes read at a time when hashing a file
+
+# sha256 of a file's contents, read a block at a time so big pdfs don't have to fit in memory
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Write 'path' through a temporary file that is renamed in to place, so a crash never leaves a half written file
+# behind under the real name. Used as: with atomic_write(path) as f: ...
+class atomic_write:
+    def __init__(self, path, mode="w", encoding="utf-8"):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.mode = mode
+        self.encoding = encoding if "b" not in mode else None
+
+    def __enter__(self):
+        self.file = open(self.tmp_path, self.mode, encoding=self.encoding)
+        return self.file
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        return False
+
+class ArtifactManifest:
+    """
+    Records what every derived file (an extracted text file, a chunk file) was built from, so a stage only redoes the
+    artifacts that are out of date.
+
+    An artifact is current when its file exists, its source still hashes to what it was built from, and it was built
+    with the same parameters (extractor version, chunk sizes, ...). File hashes are remembered along with each file's
+    size and modification time, so a file is only read again once it has changed on disk.
+
+    Paths under 'root' are stored relative to it, so the manifest stays valid when the project directory moves.
+    """
+
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self.lock = threading.Lock()    # pipeline stages record from different threads
+        self.files = {}         # path -> {"size", "mtime_ns", "sha256"}
+        self.artifacts = {}     # output path -> {"source", "source_sha256", "params"}
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            self.files = manifest.get("files", {})
+            self.artifacts = manifest.get("artifacts", {})
+
+    def _key(self, path):
+        path = os.path.abspath(path)
+        if os.path.commonpath([path, self.root]) == self.root:
+            return os.path.relpath(path, self.root)
+        return path
+
+    def file_hash(self, path):
+        """
+        sha256 of 'path', reusing the recorded hash while the file's size and modification time are unchanged.
+        """
+        stat = os.stat(path)
+        key = self._key(path)
+        with self.lock:
+            known = self.files.get(key)
+            if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+                return known["sha256"]
+        digest = sha256_file(path)
+        with self.lock:
+            self.files[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest}
+        return digest
+
+    def is_current(self, output_path, source_path, params):
+        """
+        True if 'output_path' exists and was built from the current contents of 'source_path' with 'params'.
+        """
+        with self.lock:
+            artifact = self.artifacts.get(self._key(output_path))
+        if artifact is None or not os.path.exists(output_path) or not os.path.exists(source_path):
+            return False
+        if artifact["source"] != self._key(source_path) or artifact["params"] != params:
+            return False
+        return artifact["source_sha256"] == self.file_hash(source_path)
+
+    def has_record(self, output_path):
+        with self.lock:
+            return self._key(output_path) in self.artifacts
+
+    def record(self, output_path, source_path, params):
+        """
+        Note that 'output_path' was just built from 'source_path' with 'params', and save the manifest right away so
+        the artifact counts as done even if the run crashes afterwards.
+        """
+        source_sha256 = self.file_hash(source_path)
+        self.file_hash(output_path)     # downstream stages use this file as their source
+        with self.lock:
+            self.artifacts[self._key(output_path)] = {
+                "source": self._key(source_path),
+                "source_sha256": source_sha256,
+                "params": params,
+            }
+        self.save()
+
+    def forget(self, output_path):
+        with self.lock:
+            self.artifacts.pop(self._key(output_path), None)
+            self.files.pop(self._key(output_path), None)
+        self.save()
+
+    def save(self):
+        with self.lock:
+            manifest = {"files": self.files, "artifacts": self.artifacts}
+            with atomic_write(self.path) as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
@@ -0,0 +1,140 @@
+# general utilities
+import time, asyncio, contextvars, dotenv
+import asyncpg
+from pgvector.asyncpg import register_vector
+import llm_backend      # bounded, retried LLM requests over one client per event loop
+import answer_queries   # query embedding, caches and prompt construction are shared with the blocking path
+import db_pool          # same connection settings as the blocking pool
+import query_cache
+import local_index
+import metrics
+import answer_cache
+import query_log
+
+dotenv.load_dotenv()
+
+SEARCH_QUERY = answer_queries.search_sql("$1", "$2", "$3")
+
+# the vector type lives in our schema, not in public where pgvector's asyncpg codec looks by default
+async def _init_connection(conn):
+    await register_vector(conn, schema="cs480_finalproject")
+
+async def create_pool():
+    return await asyncpg.create_pool(
+        database=db_pool.DB_NAME,
+        host=db_pool.DB_HOST,
+        user=db_pool.DB_USER,
+        password=db_pool.DB_PASSWORD,
+        port=int(db_pool.DB_PORT),
+        min_size=db_pool.DB_POOL_MIN,
+        max_size=db_pool.DB_POOL_MAX,
+        server_settings={"search_path": "cs480_finalproject,public"},
+        init=_init_connection)
+
+async def search(pool, query, k=answer_queries.FETCH_K, ef_search=None, filters=None):
+    """
+    Async counterpart of answer_queries.search(), sharing its query embedding and result caches.
+    """
+    # encoding is CPU bound and would block the event loop, run it on the default executor. Executor threads don't
+    # inherit context variables, copying the context keeps their metrics spans in this query's trace.
+    loop = asyncio.get_running_loop()
+    if filters is not None:
+        # choosing a plan for a filter takes a few round trips of its own, reuse the blocking implementation
+        return await loop.run_in_executor(None, contextvars.copy_context().run, answer_queries.search, query, k, ef_search, filters)
+    q_emb = await loop.run_in_executor(None, contextvars.copy_context().run, answer_queries.embed_query, query)
+
+    result_key = answer_queries.result_cache_key(q_emb, k, ef_search)
+    cached = query_cache.search_results.get(result_key)
+    if cached is not None:
+        metrics.count("search_result_cache_hit")
+        return [dict(hit) for hit in cached]
+
+    with metrics.span("query.search", backend=answer_queries.SEARCH_BACKEND, filtered=False) as span:
+        if answer_queries.SEARCH_BACKEND == "local":
+            # syncing uses the blocking pool and scoring is CPU bound, keep both off the event loop
+            rows = (await loop.run_in_executor(None, local_index.search, q_emb, k))[0]
+        else:
+            async with pool.acquire() as conn, conn.transaction():
+                # set_config(..., true) only lasts until the end of this transaction
+                candidates = answer_queries.candidate_count(k)
+                await conn.execute("SELECT set_config('hnsw.ef_search', $1, true);",
+                                   str(max(ef_search or answer_queries.HNSW_EF_SEARCH, candidates)))
+                # postgres can't type a parameter the query never uses, and full storage has no candidate limit
+                args = (q_emb, k) if answer_queries.VECTOR_STORAGE == "full" else (q_emb, k, candidates)
+                rows = [tuple(row) for row in await conn.fetch(SEARCH_QUERY, *args)]
+        span.add(items=len(rows))
+
+    top_k = answer_queries.rank_results(rows, k)
+    query_cache.search_results.put(result_key, top_k)
+    return [dict(hit) for hit in top_k]
+
+async def stream_answer(backend, messages):
+    """
+    Print the LLM's answer token by token as it arrives.
+
+    Returns (answer text, seconds until the first token arrived).
+    """
+    start = time.perf_counter()
+    time_to_first_token = None
+    parts = []
+    async for part in backend.astream(messages):
+        content = part["message"]["content"]
+        if content and time_to_first_token is None:
+            time_to_first_token = time.perf_counter() - start
+        parts.append(content)
+        print(content, end="", flush=True)
+    print()
+    return "".join(parts), time_to_first_token
+
+async def answer_query(pool, backend, enduser_id, query, filters=None):
+    with metrics.span("query.answer"):
+        # the cache lives in postgres behind the blocking pool, like filtered searches it runs on the executor
+        loop = asyncio.get_running_loop()
+        scope = answer_cache.make_scope(answer_queries.FETCH_K, filters)
+        q_emb = await loop.run_in_executor(None, contextvars.copy_context().run, answer_queries.embed_query, query)
+        cached = await loop.run_in_executor(None, contextvars.copy_context().run, answer_cache.lookup, q_emb,
+                                            backend.model, scope)
+        if cached is not None:
+            query_log.log_query(query, enduser_id, cached["doc_ids"])  # only queues it, query_log's thread does the write
+            print(f"(cached answer to \"{cached['query_text']}\", distance {cached['distance']:.3f})\n")
+            print(cached["answer"])
+            return cached["answer"]
+
+        start = time.perf_counter()
+        hits = await search(pool, query, filters=filters)
+        retrieval_time = time.perf_counter() - start
+        query_log.log_query(query, enduser_id, [hit["doc_id"] for hit in hits])
+        answer_queries.print_hits(hits)
+
+        print("Thinking...\n")
+        answer, time_to_first_token = await stream_answer(backend, answer_queries.build_messages(query, hits))
+        await loop.run_in_executor(None, answer_cache.store, query, q_emb, [hit["embed_id"] for hit in hits], answer,
+                                   backend.model, scope)
+
+    if time_to_first_token is not None:
+        print(f"\n(retrieval {retrieval_time:.2f}s, time to first token {time_to_first_token:.2f}s)")
+    return answer
+
+async def async_queryDB(enduser_id, filters=None):
+    """
+    Same interaction loop as answer_queries.queryDB(), but the answer streams in as the LLM generates it.
+    """
+    loop = asyncio.get_running_loop()
+    prompt = "What would you like to know about? Answer with \"X\" or nothing to exit.\n->"
+
+    pool = await create_pool()
+    backend = llm_backend.get_backend()
+    try:
+        query = await loop.run_in_executor(None, input, prompt)
+        while query and query != "X":
+            start = time.perf_counter()
+            await answer_query(pool, backend, enduser_id, query, filters)
+            answer_queries.first_query_done(time.perf_counter() - start)
+            print("\n\n")
+            query = await loop.run_in_executor(None, input, prompt)
+    finally:
+        await pool.close()
+    print("Returning to role selection...")
+
+def queryDB(enduser_id, filters=None):
+    asyncio.run(async_queryDB(enduser_id, filters))
@@ -0,0 +1,134 @@
+# general utilities
+import sys, json, time, argparse, threading, dotenv
+from concurrent.futures import ThreadPoolExecutor
+import llm_backend      # bounded, retried LLM requests over one persistent client
+import answer_queries   # embedding model, prompt construction
+import db_pool
+import local_index
+import metrics
+
+dotenv.load_dotenv()
+
+LLM_CONCURRENCY = llm_backend.LLM_CONCURRENCY  # questions being answered by the LLM at once
+
+# Top k for every query vector in one round trip: unnest the array of query vectors and run the nearest neighbor
+# search once per vector with a LATERAL join, each inner search can still use the HNSW index.
+BATCH_SEARCH_QUERY = """
+    SELECT q.idx, e.embed_id, e.chunk, e.distance, e.source_doc_id
+    FROM unnest(%(idx)s::int[], %(q)s::cs480_finalproject.vector[]) AS q(idx, emb)
+    CROSS JOIN LATERAL (
+        {search}
+    ) AS e
+    ORDER BY q.idx, e.distance;
+    """.format(search=answer_queries.search_sql("q.emb", "%(k)s", "%(candidates)s"))
+
+# Each line of a JSONL file is one question. The text is taken from "query", "question" or "body" (so a file shaped
+# like requests.jsonl works as is), and the id from "id" or "request_id", falling back to the line number.
+def load_questions(path):
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            text = record.get("query") or record.get("question") or record.get("body")
+            if not text:
+                print(f"  Skipping line {line_number}, it has no query text.")
+                continue
+            questions.append({"id": record.get("id") or record.get("request_id") or line_number, "query": text})
+    return questions
+
+def batch_search(queries, k=answer_queries.FETCH_K, ef_search=None):
+    """
+    Encode every query in one model.encode call and fetch the top k hits for all of them in one SQL statement.
+
+    Returns one list of hits per query, in the same order as 'queries'.
+    """
+    with metrics.span("query.encode", batched=True) as span:
+        q_embs = answer_queries.get_model().encode(queries, convert_to_numpy=True, normalize_embeddings=True)
+        span.add(items=len(queries))
+
+    with metrics.span("query.search", backend=answer_queries.SEARCH_BACKEND, batched=True) as span:
+        if answer_queries.SEARCH_BACKEND == "local":
+            # one matrix product scores every query against every chunk
+            per_query = local_index.search(q_embs, k)
+        else:
+            with db_pool.connection() as conn, conn.cursor() as cur:
+                candidates = answer_queries.candidate_count(k)
+                answer_queries.set_ef_search(cur, max(ef_search or answer_queries.HNSW_EF_SEARCH, candidates))
+                cur.execute(BATCH_SEARCH_QUERY, {"idx": list(range(len(queries))), "q": list(q_embs), "k": k, "candidates": candidates})
+                rows = cur.fetchall()
+
+            per_query = [[] for _ in queries]
+            for idx, *row in rows:
+                per_query[idx].append(tuple(row))
+        span.add(items=len(queries))
+    return [answer_queries.rank_results(results, k) for results in per_query]
+
+def answer_all(questions, k=answer_queries.FETCH_K, concurrency=LLM_CONCURRENCY, use_llm=True, ef_search=None):
+    """
+    Answer every question, yielding one result dict per question in input order. At most 'concurrency' LLM requests
+    are in flight at once, and never more than the process wide backend's own limit.
+    """
+    start = time.time()
+    all_hits = batch_search([q["query"] for q in questions], k, ef_search)
+    print(f"  Retrieved top {k} for {len(questions)} questions in {time.time() - start:.2f} seconds")
+
+    # the process wide backend, so every request goes over its one client and connections to the Ollama server get reused
+    backend = llm_backend.get_backend()
+    slots = threading.BoundedSemaphore(max(1, concurrency))
+
+    def answer_one(item):
+        question, hits = item
+        answer = None
+        if use_llm:
+            messages = answer_queries.build_messages(question["query"], hits)
+            with slots:
+                response = backend.chat(messages)
+            answer = response["message"]["content"]
+        return {
+            "id": question["id"],
+            "query": question["query"],
+            "hits": [{"rank": h["rank"], "score": h["score"], "chunk": h["chunk"]} for h in hits],
+            "answer": answer,
+        }
+
+    # one more thread than requests in flight, so the next prompt is built while the others generate, map() still
+    # yields results in input order
+    with ThreadPoolExecutor(max_workers=max(1, concurrency) + 1) as pool:
+        yield from pool.map(answer_one, zip(questions, all_hits))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions without the interactive CLI.")
+    parser.add_argument("input", help="JSONL file with one question per line")
+    parser.add_argument("output", help="JSONL file to write one answer per line to")
+    parser.add_argument("-k", type=int, default=answer_queries.FETCH_K, help="chunks retrieved per question")
+    parser.add_argument("--concurrency", type=int, default=LLM_CONCURRENCY, help="LLM requests in flight at once, at most LLM_CONCURRENCY")
+    parser.add_argument("--ef-search", type=int, default=None, help="HNSW candidate list size (default HNSW_EF_SEARCH)")
+    parser.add_argument("--no-llm", action="store_true", help="only retrieve, don't generate answers")
+    parser.add_argument("--metrics", help="write per-stage metrics here (JSON if it ends in .json, else Prometheus text), "
+                                          "needs METRICS_ENABLED=1")
+    args = parser.parse_args(argv)
+
+    questions = load_questions(args.input)
+    if not questions:
+        print("No questions found.")
+        return 1
+
+    print(f"Answering {len(questions)} questions...")
+    start = time.time()
+    with open(args.output, "w", encoding="utf-8") as out:
+        for result in answer_all(questions, k=args.k, concurrency=args.concurrency, use_llm=not args.no_llm,
+                                 ef_search=args.ef_search):
+            out.write(json.dumps(result) + "\n")
+    elapsed = time.time() - start
+    print(f"Answered {len(questions)} questions in {elapsed:.2f} seconds ({len(questions) / max(elapsed, 1e-9):.2f} questions/s)")
+    if metrics.METRICS_ENABLED:
+        print(metrics.report())
+        if args.metrics:
+            metrics.write(args.metrics)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
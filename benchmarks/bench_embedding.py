@@ -0,0 +1,87 @@
+# Chunk embedding throughput (chunks/s, and per core) of each EMBED_BACKEND and worker count, with a parity check of
+# every configuration's vectors against the reference torch model's.
+# Usage: python benchmarks/bench_embedding.py [--samples 1000] [--backends torch,onnx,onnx-int8] [--workers 1,2,4]
+# Chunks come from Chunked_txt/ (run the ingestion once first). Exits with 1 if any configuration fails parity.
+import os, sys, glob, json, time, random, argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))   # run from anywhere
+import pdf_helper
+import embedding_engine
+
+def load_chunks(samples, seed=0):
+    chunks = []
+    for path in sorted(glob.glob(os.path.join(pdf_helper.CHUNKS_OUTPUT_DIRECTORY, "*.txt"))):
+        with open(path, "r", encoding="utf-8") as f:
+            chunks.extend(line.strip() for line in f if line.strip())
+    if not chunks:
+        raise SystemExit(f"No chunks in {pdf_helper.CHUNKS_OUTPUT_DIRECTORY}, run the ingestion first.")
+    return random.Random(seed).sample(chunks, min(samples, len(chunks)))
+
+def reference_embeddings(chunks):
+    """
+    What the repository embedded with before the engine: one model.encode call on the float torch model.
+    """
+    model = embedding_engine.load_model(backend="torch")
+    start = time.perf_counter()
+    embeddings = model.encode(chunks, convert_to_numpy=True, normalize_embeddings=True)
+    return embeddings, time.perf_counter() - start
+
+def run(chunks, reference, backend, workers, threads, bucketed, min_cosine):
+    engine = embedding_engine.EmbeddingEngine(backend=backend, workers=workers, threads=threads, bucketed=bucketed)
+    try:
+        start = time.perf_counter()
+        engine.encode(chunks[:workers * 2])     # loads the model, in every worker
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        embeddings = engine.encode(chunks)
+        elapsed = time.perf_counter() - start
+    finally:
+        engine.close()
+
+    rate = len(chunks) / max(elapsed, 1e-9)
+    return {"backend": backend, "workers": workers, "threads": engine.threads, "cores": engine.cores,
+            "bucketed": bucketed, "load_s": load_time, "encode_s": elapsed, "chunks_per_s": rate,
+            "chunks_per_s_per_core": rate / engine.cores,
+            "padding_efficiency": engine.last_stats.get("padding_efficiency"),
+            **embedding_engine.parity_check(embeddings, reference, min_cosine)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Embedding throughput and parity of each backend and worker count.")
+    parser.add_argument("--samples", type=int, default=1000, help="chunks to encode")
+    parser.add_argument("--backends", default=",".join(embedding_engine.BACKENDS), help="comma separated EMBED_BACKENDs")
+    parser.add_argument("--workers", default="1,2,4", help="comma separated worker counts")
+    parser.add_argument("--threads", type=int, default=0, help="threads per worker (default: cores / workers)")
+    parser.add_argument("--unbucketed", action="store_true", help="also run each configuration without length bucketing")
+    parser.add_argument("--min-cosine", type=float, default=embedding_engine.EMBED_PARITY_MIN_COSINE,
+                        help="lowest cosine similarity to the reference vectors that passes")
+    parser.add_argument("--output", help="write the results here as JSON")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    chunks = load_chunks(args.samples, args.seed)
+    lengths = embedding_engine.token_lengths(chunks)
+    print(f"{len(chunks)} chunks, {lengths.mean():.0f} tokens on average ({lengths.min()}-{lengths.max()}), {os.cpu_count()} cores")
+
+    reference, reference_time = reference_embeddings(chunks)
+    print(f"Reference (torch, one encode call): {len(chunks) / reference_time:.1f} chunks/s")
+
+    results = []
+    for backend in args.backends.split(","):
+        for workers in (int(w) for w in args.workers.split(",")):
+            for bucketed in ((True, False) if args.unbucketed else (True,)):
+                print(f"  {backend}, {workers} workers{'' if bucketed else ', unbucketed'}...", flush=True)
+                results.append(run(chunks, reference, backend, workers, args.threads, bucketed, args.min_cosine))
+
+    print(f"\n{'backend':>9} {'workers':>7} {'threads':>7} {'bucketed':>8} {'chunks/s':>9} {'per core':>9} {'padding':>8} "
+          f"{'min cos':>8} {'top5 agree':>10} {'parity':>6}")
+    for r in results:
+        print(f"{r['backend']:>9} {r['workers']:>7} {r['threads']:>7} {str(r['bucketed']):>8} {r['chunks_per_s']:>9.1f} "
+              f"{r['chunks_per_s_per_core']:>9.2f} {r['padding_efficiency']:>8.1%} {r['min_cosine']:>8.4f} "
+              f"{r['neighbor_agreement']:>10.3f} {'ok' if r['passed'] else 'FAIL':>6}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"reference_chunks_per_s": len(chunks) / reference_time, "results": results}, f, indent=2)
+    return 0 if all(r["passed"] for r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,42 @@
+# Wall time of extracting the whole Corpus/ against THREAD_COUNT, with and without page range splitting.
+# Usage: python benchmarks/bench_extract.py [thread counts...]      (default: 1 2 4 8)
+import os, sys, json, time, shutil, tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))   # run from anywhere
+import pdf_helper
+
+def time_extraction(pdf_files, thread_count, split):
+    # extract in to a scratch directory with a scratch manifest, so existing Processed_pdf/ output is neither reused
+    # nor overwritten
+    output_directory = tempfile.mkdtemp(prefix="bench_extract_")
+    original = pdf_helper.TXT_OUTPUT_DIRECTORY, pdf_helper.MANIFEST_PATH, pdf_helper._manifest
+    pdf_helper.TXT_OUTPUT_DIRECTORY = output_directory
+    pdf_helper.MANIFEST_PATH, pdf_helper._manifest = os.path.join(output_directory, "artifact_manifest.json"), None
+    try:
+        start = time.perf_counter()
+        pdf_helper.process_pdf_to_txt(pdf_files, thread_count=thread_count, split=split)
+        return time.perf_counter() - start
+    finally:
+        pdf_helper.TXT_OUTPUT_DIRECTORY, pdf_helper.MANIFEST_PATH, pdf_helper._manifest = original
+        shutil.rmtree(output_directory)
+
+def main(argv):
+    thread_counts = [int(arg) for arg in argv] or [1, 2, 4, 8]
+    pdf_files = pdf_helper.corpus_pdfs()
+    total_mb = sum(os.path.getsize(pdf_path) for pdf_path in pdf_files) / 1e6
+    print(f"{len(pdf_files)} PDFs, {total_mb:.1f} MB, {os.cpu_count()} CPUs")
+
+    results = []
+    for thread_count in thread_counts:
+        whole = time_extraction(pdf_files, thread_count, split=False)
+        split = time_extraction(pdf_files, thread_count, split=True)
+        tasks = len(pdf_helper.plan_extraction(pdf_files, thread_count))
+        results.append({"thread_count": thread_count, "whole_files_s": whole, "page_ranges_s": split, "tasks": tasks})
+
+    print(f"\n{'THREAD_COUNT':>12} {'whole files':>12} {'page ranges':>12} {'tasks':>6} {'speedup':>8}")
+    for r in results:
+        print(f"{r['thread_count']:>12} {r['whole_files_s']:>11.2f}s {r['page_ranges_s']:>11.2f}s {r['tasks']:>6} "
+              f"{r['whole_files_s'] / r['page_ranges_s']:>7.2f}x")
+    print(json.dumps(results))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
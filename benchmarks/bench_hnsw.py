@@ -0,0 +1,96 @@
+# Recall@k and latency of the HNSW index against exact nearest neighbors, across a sweep of hnsw.ef_search values.
+# Usage: python benchmarks/bench_hnsw.py [--queries questions.jsonl] [--samples 200] [-k 5] [--ef 10 20 40 80 160 320]
+# Without --queries, rows sampled from the Embeddings table are used as query vectors.
+import os, sys, json, time, argparse
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))   # run from anywhere
+import answer_queries
+import db_pool
+
+def load_embeddings():
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT embed_id, embedding FROM cs480_finalproject.embeddings ORDER BY embed_id;")
+        rows = cur.fetchall()
+    embed_ids = np.array([row[0] for row in rows])
+    matrix = np.vstack([np.asarray(row[1], dtype=np.float32) for row in rows])
+    return embed_ids, matrix
+
+def exact_top_k(matrix, queries, k):
+    """
+    Brute force ground truth: the embed_id indices of the k smallest cosine distances for every query.
+    """
+    unit = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    q_unit = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    distances = 1.0 - q_unit @ unit.T
+    top = np.argpartition(distances, min(k, distances.shape[1] - 1), axis=1)[:, :k]
+    order = np.take_along_axis(distances, top, axis=1).argsort(axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+def uses_index(cur, q_emb, k, storage):
+    candidates = answer_queries.candidate_count(k, storage)
+    cur.execute("EXPLAIN " + answer_queries.search_sql("%(q)s", "%(k)s", "%(candidates)s", storage),
+                {"q": q_emb.tolist(), "k": k, "candidates": candidates})
+    return any(answer_queries.INDEX_NAMES[storage] in row[0] for row in cur.fetchall())
+
+def run_sweep(queries, truth_ids, k, ef_values, warmup, storage=None, oversample=None):
+    storage = storage or answer_queries.VECTOR_STORAGE
+    results = []
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        if not uses_index(cur, queries[0], k, storage):
+            print(f"  Warning: the planner isn't using {answer_queries.INDEX_NAMES[storage]}, these numbers are for a sequential scan.")
+        conn.rollback()
+        for ef_search in ef_values:
+            latencies, recalls = [], []
+            for i, q_emb in enumerate(np.concatenate([queries[:warmup], queries])):
+                start = time.perf_counter()
+                rows = answer_queries.nearest_rows(cur, q_emb, k, ef_search, storage, oversample)
+                elapsed = time.perf_counter() - start
+                conn.rollback()     # ends the transaction the ef_search setting belongs to
+                if i < warmup:
+                    continue
+                found = {row[0] for row in rows}
+                recalls.append(len(found & truth_ids[i - warmup]) / k)
+                latencies.append(elapsed * 1000)
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            results.append({"ef_search": ef_search, "recall": float(np.mean(recalls)),
+                            "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)})
+    return results
+
+# stored rows sampled as queries, or the questions of a JSONL file encoded by the embedding model
+def load_queries(matrix, queries_path, samples, seed):
+    if queries_path:
+        import batch_answer
+        texts = [q["query"] for q in batch_answer.load_questions(queries_path)]
+        return answer_queries.get_model().encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+    rng = np.random.default_rng(seed)
+    return matrix[rng.choice(len(matrix), size=min(samples, len(matrix)), replace=False)]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recall and latency of the HNSW index across hnsw.ef_search values.")
+    parser.add_argument("--queries", help="JSONL file of questions (same format as batch_answer.py) to use as queries")
+    parser.add_argument("--samples", type=int, default=200, help="stored rows to use as queries when --queries isn't given")
+    parser.add_argument("-k", type=int, default=answer_queries.FETCH_K, help="neighbors per query")
+    parser.add_argument("--ef", type=int, nargs="+", default=[10, 20, 40, 80, 160, 320], help="ef_search values to sweep")
+    parser.add_argument("--warmup", type=int, default=10, help="untimed queries run first to warm caches")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    embed_ids, matrix = load_embeddings()
+    queries = load_queries(matrix, args.queries, args.samples, args.seed)
+    print(f"{len(embed_ids)} embeddings, {len(queries)} queries, k={args.k}, storage={answer_queries.VECTOR_STORAGE}, "
+          f"m={answer_queries.HNSW_M}, ef_construction={answer_queries.HNSW_EF_CONSTRUCTION}")
+
+    start = time.perf_counter()
+    truth_ids = [set(embed_ids[row].tolist()) for row in exact_top_k(matrix, queries, args.k)]
+    print(f"  Exact ground truth in {time.perf_counter() - start:.2f} seconds")
+
+    results = run_sweep(queries, truth_ids, args.k, args.ef, args.warmup)
+
+    print(f"\n{'ef_search':>9} {'recall@' + str(args.k):>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for r in results:
+        print(f"{r['ef_search']:>9} {r['recall']:>9.3f} {r['p50_ms']:>7.2f}ms {r['p95_ms']:>7.2f}ms {r['p99_ms']:>7.2f}ms")
+    print(json.dumps(results))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,65 @@
+# Index size and recall@k of each VECTOR_STORAGE mode ("full", "halfvec", "binary") against exact nearest neighbors.
+# Usage: python benchmarks/bench_quantization.py [--queries questions.jsonl] [--samples 200] [-k 5] [--ef 40] [--oversample N]
+# Builds every mode's HNSW index side by side, then drops all but the configured one (pass --keep to leave them).
+import os, sys, json, time, argparse
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))   # run from anywhere
+import answer_queries
+import db_pool
+from bench_hnsw import load_embeddings, load_queries, exact_top_k, run_sweep
+
+INDEX_SIZE = "SELECT pg_relation_size(%s::regclass);"
+
+def build_index(storage):
+    start = time.perf_counter()
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        answer_queries.create_hnsw_index(cur, storage, drop_others=False)
+        conn.commit()
+        build_time = time.perf_counter() - start
+        cur.execute(INDEX_SIZE, (f"cs480_finalproject.{answer_queries.INDEX_NAMES[storage]}",))
+        size = cur.fetchone()[0]
+    return size, build_time
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index size and recall of full, halfvec and binary HNSW indexes.")
+    parser.add_argument("--queries", help="JSONL file of questions (same format as batch_answer.py) to use as queries")
+    parser.add_argument("--samples", type=int, default=200, help="stored rows to use as queries when --queries isn't given")
+    parser.add_argument("-k", type=int, default=answer_queries.FETCH_K, help="neighbors per query")
+    parser.add_argument("--ef", type=int, default=answer_queries.HNSW_EF_SEARCH, help="hnsw.ef_search for every mode")
+    parser.add_argument("--oversample", type=int, default=None, help="candidates per result (default per mode: DEFAULT_OVERSAMPLE)")
+    parser.add_argument("--warmup", type=int, default=10, help="untimed queries run first to warm caches")
+    parser.add_argument("--keep", action="store_true", help="keep every mode's index instead of only VECTOR_STORAGE's")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    embed_ids, matrix = load_embeddings()
+    queries = load_queries(matrix, args.queries, args.samples, args.seed)
+    truth_ids = [set(embed_ids[row].tolist()) for row in exact_top_k(matrix, queries, args.k)]
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(INDEX_SIZE, ("cs480_finalproject.embeddings",))
+        table_size = cur.fetchone()[0]
+    print(f"{len(embed_ids)} embeddings ({table_size / 1e6:.1f} MB table), {len(queries)} queries, k={args.k}, ef_search={args.ef}")
+
+    results = []
+    try:
+        for storage in answer_queries.INDEX_NAMES:
+            size, build_time = build_index(storage)
+            sweep = run_sweep(queries, truth_ids, args.k, [args.ef], args.warmup, storage, args.oversample)[0]
+            results.append({"storage": storage, "index_bytes": size, "build_s": build_time,
+                            "oversample": args.oversample or answer_queries.DEFAULT_OVERSAMPLE[storage],
+                            "recall": sweep["recall"], "p50_ms": sweep["p50_ms"], "p95_ms": sweep["p95_ms"]})
+    finally:
+        if not args.keep:
+            with db_pool.connection() as conn, conn.cursor() as cur:
+                answer_queries.create_hnsw_index(cur)
+                conn.commit()
+
+    full_size = results[0]["index_bytes"] if results else 0
+    print(f"\n{'storage':>8} {'index':>10} {'vs full':>8} {'build':>8} {'oversample':>10} {'recall@' + str(args.k):>9} {'p50':>9} {'p95':>9}")
+    for r in results:
+        print(f"{r['storage']:>8} {r['index_bytes'] / 1e6:>8.2f}MB {r['index_bytes'] / max(full_size, 1):>7.1%} "
+              f"{r['build_s']:>7.2f}s {r['oversample']:>10} {r['recall']:>9.3f} {r['p50_ms']:>7.2f}ms {r['p95_ms']:>7.2f}ms")
+    print(json.dumps(results))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+# A stand-in for the Ollama server that answers /api/chat with canned text, so the query path can be timed without a
+# GPU or a downloaded model. Time to first token and time per token are simulated with sleeps.
+# Usage: python benchmarks/fake_ollama.py [port]      then point OLLAMA_HOST at http://127.0.0.1:<port>
+import sys, json, time, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ANSWER = ("Based on the provided context, the reports describe how much waste is generated, how it is composed, "
+          "and how much of it is recycled or diverted from landfills.").split(" ")
+
+class FakeOllama:
+    """
+    Serves /api/chat (streaming and not), /api/tags and /api/version on 127.0.0.1, in a background thread.
+    """
+
+    def __init__(self, port=0, first_token_delay=0.05, token_delay=0.005):
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def host(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-ollama", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass    # keep benchmark output readable
+
+            def _send_json(self, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == "/api/version":
+                    self._send_json({"version": "0.0.0-fake"})
+                elif self.path == "/api/tags":
+                    self._send_json({"models": []})
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                if self.path != "/api/chat":
+                    self.send_error(404)
+                    return
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                fake.requests += 1
+                model = request.get("model", "fake")
+                time.sleep(fake.first_token_delay)
+
+                def message(content, done):
+                    return {"model": model, "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                            "message": {"role": "assistant", "content": content}, "done": done,
+                            **({"done_reason": "stop", "eval_count": len(ANSWER)} if done else {})}
+
+                if not request.get("stream", True):
+                    time.sleep(fake.token_delay * len(ANSWER))
+                    self._send_json(message(" ".join(ANSWER), True))
+                    return
+
+                # newline delimited JSON, one message per token, like the real server
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.end_headers()
+                for i, word in enumerate(ANSWER):
+                    if i:
+                        time.sleep(fake.token_delay)
+                    self.wfile.write((json.dumps(message(word if i == 0 else " " + word, False)) + "\n").encode("utf-8"))
+                    self.wfile.flush()
+                self.wfile.write((json.dumps(message("", True)) + "\n").encode("utf-8"))
+                self.close_connection = True
+
+        return Handler
+
+if __name__ == "__main__":
+    with FakeOllama(int(sys.argv[1]) if len(sys.argv) > 1 else 11434) as fake:
+        print(f"Fake Ollama listening on {fake.host}, Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,107 @@
+# A throwaway PostgreSQL server with pgvector and the project schema loaded, for benchmarks that must not touch the
+# real database. Runs a fresh cluster with the local initdb/pg_ctl binaries, or the pgvector/pgvector docker image.
+import os, glob, time, socket, shutil, tempfile, subprocess
+import psycopg2
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHEMA_PATH = os.path.join(PROJECT_ROOT, "RAG_Pipeline.sql")
+DOCKER_IMAGE = os.environ.get("BENCH_PG_IMAGE", "pgvector/pgvector:pg16")
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Directory holding initdb and pg_ctl: PG_BIN, then pg_config, then PATH, then the usual Debian/Ubuntu location
+def find_pg_bin():
+    if os.environ.get("PG_BIN"):
+        return os.environ["PG_BIN"]
+    try:
+        bindir = subprocess.run(["pg_config", "--bindir"], capture_output=True, text=True, check=True).stdout.strip()
+        if os.path.exists(os.path.join(bindir, "initdb")):     # client only installs ship pg_config without a server
+            return bindir
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        pass
+    if shutil.which("initdb"):
+        return os.path.dirname(shutil.which("initdb"))
+    candidates = sorted(glob.glob("/usr/lib/postgresql/*/bin/initdb"))
+    return os.path.dirname(candidates[-1]) if candidates else None
+
+class ThrowawayPostgres:
+    """
+    Start with start() (or a with block), read the connection settings from 'settings', and stop() removes
+    everything. 'use_docker' None picks local binaries when they exist and docker otherwise.
+    """
+
+    def __init__(self, use_docker=None):
+        self.pg_bin = find_pg_bin()
+        self.use_docker = (self.pg_bin is None) if use_docker is None else use_docker
+        self.port = _free_port()
+        self.directory = None
+        self.container = None
+        self.settings = {"DB_NAME": "postgres", "DB_HOST": "127.0.0.1", "DB_USER": "postgres",
+                         "DB_PASSWORD": "postgres", "DB_PORT": str(self.port)}
+
+    def start(self):
+        if self.use_docker:
+            if not shutil.which("docker"):
+                raise RuntimeError("Neither initdb nor docker found, install PostgreSQL with pgvector or docker, or set PG_BIN.")
+            self.container = subprocess.run(
+                ["docker", "run", "-d", "--rm", "-p", f"127.0.0.1:{self.port}:5432", "-e", "POSTGRES_PASSWORD=postgres", DOCKER_IMAGE],
+                capture_output=True, text=True, check=True).stdout.strip()
+        else:
+            if self.pg_bin is None:
+                raise RuntimeError("No initdb found, install PostgreSQL with pgvector, set PG_BIN, or use docker.")
+            self.directory = tempfile.mkdtemp(prefix="bench_pg_")
+            data = os.path.join(self.directory, "data")
+            subprocess.run([os.path.join(self.pg_bin, "initdb"), "-D", data, "-U", "postgres", "--auth=trust", "-E", "UTF8"],
+                           capture_output=True, check=True)
+            subprocess.run([os.path.join(self.pg_bin, "pg_ctl"), "-D", data, "-l", os.path.join(self.directory, "server.log"), "-w",
+                            "-o", f"-p {self.port} -k {self.directory} -c listen_addresses=127.0.0.1 -c fsync=off", "start"],
+                           capture_output=True, check=True)
+        self._wait_until_ready()
+        self._load_schema()
+        return self
+
+    def connect(self):
+        return psycopg2.connect(database=self.settings["DB_NAME"], host=self.settings["DB_HOST"], user=self.settings["DB_USER"],
+                                password=self.settings["DB_PASSWORD"], port=self.port)
+
+    def _wait_until_ready(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.connect().close()
+                return
+            except psycopg2.OperationalError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.5)
+
+    def _load_schema(self):
+        with open(SCHEMA_PATH, "r", encoding="utf-8") as f:
+            schema = f.read()
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(schema)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def stop(self):
+        if self.container:
+            subprocess.run(["docker", "stop", self.container], capture_output=True)
+            self.container = None
+        if self.directory:
+            subprocess.run([os.path.join(self.pg_bin, "pg_ctl"), "-D", os.path.join(self.directory, "data"), "-m", "immediate", "stop"],
+                           capture_output=True)
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
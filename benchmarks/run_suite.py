@@ -0,0 +1,182 @@
+# End to end benchmark of the ingestion and query paths over the bundled Corpus/, against a throwaway Postgres with
+# pgvector (see local_postgres.py) and a fake Ollama server (see fake_ollama.py). Nothing outside a temp directory is
+# touched. Results are written as JSON so runs can be compared across commits.
+# Usage: python benchmarks/run_suite.py [--output results.json] [--reuse-text] [--queries 100] [--docker]
+import os, sys, json, time, random, shutil, argparse, platform, tempfile, subprocess
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))   # run from anywhere
+from local_postgres import ThrowawayPostgres, PROJECT_ROOT
+from fake_ollama import FakeOllama
+
+RESULTS_DIRECTORY = os.path.join(PROJECT_ROOT, "benchmarks", "results")
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return None
+
+def latency_summary(seconds):
+    ms = np.asarray(seconds) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {"count": len(ms), "mean_ms": float(ms.mean()), "p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
+
+def timed(results, name, fn, items=None, unit=None):
+    """
+    Run fn(), store its wall time (and throughput, if it returns an item count) under results[name].
+    """
+    print(f"  {name}...", flush=True)
+    start = time.perf_counter()
+    count = fn()
+    elapsed = time.perf_counter() - start
+    entry = {"seconds": elapsed}
+    if unit is not None:
+        count = items if items is not None else count
+        entry.update({unit: count, f"{unit}_per_second": count / max(elapsed, 1e-9)})
+    results[name] = entry
+    print(f"    {elapsed:.2f}s" + (f", {entry[unit + '_per_second']:.1f} {unit}/s" if unit else ""))
+    return count
+
+# short spans of chunk text stand in for user questions, they are never in the query caches
+def sample_queries(chunks, count, seed=0):
+    rng = random.Random(seed)
+    queries = []
+    for chunk in rng.sample(chunks, min(count, len(chunks))):
+        words = chunk.split()
+        start = rng.randrange(max(len(words) - 12, 1))
+        queries.append(" ".join(words[start:start + rng.randint(6, 12)]))
+    return queries
+
+def seed_documents(cur, txt_paths):
+    cur.execute("""INSERT INTO cs480_finalproject.users (name, email, role, username, password)
+        VALUES ('Bench Curator', 'bench@example.com', 'Curator', 'bench', 'bench') RETURNING user_id;""")
+    curator_id = cur.fetchone()[0]
+    cur.execute("INSERT INTO cs480_finalproject.curator (curator_id) VALUES (%s);", (curator_id,))
+    doc_ids = {}
+    for txt_path in txt_paths:
+        name = os.path.splitext(os.path.basename(txt_path))[0]
+        cur.execute("""INSERT INTO cs480_finalproject.document (title, type, source, added_by, processed)
+            VALUES (%s, 'report', %s, %s, TRUE) RETURNING doc_id;""", (name, name + ".pdf", curator_id))
+        doc_ids[txt_path] = cur.fetchone()[0]
+    return doc_ids
+
+def run(args, workdir):
+    # imported only now, so their module level settings pick up the throwaway server and the fake LLM
+    import pdf_helper, answer_queries, db_pool, query_cache, llm_backend
+
+    pdf_helper.TXT_OUTPUT_DIRECTORY = os.path.join(workdir, "Processed_pdf")
+    pdf_helper.CHUNKS_OUTPUT_DIRECTORY = os.path.join(workdir, "Chunked_txt")
+    pdf_helper.MANIFEST_PATH, pdf_helper._manifest = os.path.join(workdir, "artifact_manifest.json"), None
+    os.makedirs(pdf_helper.TXT_OUTPUT_DIRECTORY)
+    os.makedirs(pdf_helper.CHUNKS_OUTPUT_DIRECTORY)
+
+    pdf_files = pdf_helper.corpus_pdfs()
+    corpus_bytes = sum(os.path.getsize(pdf_path) for pdf_path in pdf_files)
+    stages = {}
+
+    if args.reuse_text:
+        # the committed extractions, for quick runs that only care about the later stages
+        for pdf_path in pdf_files:
+            committed = os.path.join(PROJECT_ROOT, "Processed_pdf", os.path.basename(pdf_helper.extracted_txt_path(pdf_path)))
+            shutil.copy(committed, pdf_helper.TXT_OUTPUT_DIRECTORY)
+    else:
+        timed(stages, "extract", lambda: pdf_helper.process_pdf_to_txt(pdf_files), items=corpus_bytes / 1e6, unit="mb")
+
+    timed(stages, "chunk", pdf_helper.chunk_processed_txt)
+    txt_paths = sorted(os.path.join(pdf_helper.TXT_OUTPUT_DIRECTORY, name) for name in os.listdir(pdf_helper.TXT_OUTPUT_DIRECTORY))
+    rows = []   # (doc txt path, chunk)
+    for txt_path in txt_paths:
+        with open(pdf_helper.chunked_txt_path(txt_path), "r", encoding="utf-8") as f:
+            rows.extend((txt_path, line.strip()) for line in f if line.strip())
+    stages["chunk"].update({"chunks": len(rows), "chunks_per_second": len(rows) / max(stages["chunk"]["seconds"], 1e-9)})
+    texts = [chunk for _, chunk in rows]
+
+    timed(stages, "model_load", answer_queries.get_model)
+    # straight to the model, the embedding cache would turn a second run in to a cache benchmark
+    embeddings = None
+    def embed():
+        nonlocal embeddings
+        embeddings = answer_queries.get_model().encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+        return len(texts)
+    timed(stages, "embed", embed, unit="chunks")
+
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        answer_queries.ensure_embeddings_schema(cur)
+        doc_ids = seed_documents(cur, txt_paths)
+        conn.commit()
+        hashes = [answer_queries.chunk_hash(text) for text in texts]
+        def insert():
+            count = answer_queries.bulk_insert_embeddings(cur, [doc_ids[path] for path, _ in rows], texts, hashes, embeddings)
+            conn.commit()
+            return count
+        timed(stages, "insert", insert, unit="rows")
+        def build_index():
+            answer_queries.create_hnsw_index(cur)
+            conn.commit()
+        timed(stages, "index_build", build_index)
+    query_cache.bump_corpus_generation()
+
+    queries = sample_queries(texts, args.queries)
+    print(f"  query ({len(queries)} queries)...", flush=True)
+    search_times, answer_times = [], []
+    # the production backend, talking HTTP to the fake server, so client overhead is part of the measurement
+    backend = llm_backend.OllamaBackend(host=os.environ["OLLAMA_HOST"])
+    for query in queries:
+        start = time.perf_counter()
+        hits = answer_queries.search(query)
+        search_times.append(time.perf_counter() - start)
+        backend.chat(answer_queries.build_messages(query, hits))
+        answer_times.append(time.perf_counter() - start)
+    stages["query_search"] = latency_summary(search_times)
+    stages["query_answer"] = latency_summary(answer_times)
+    print(f"    search p50 {stages['query_search']['p50_ms']:.1f}ms p99 {stages['query_search']['p99_ms']:.1f}ms, "
+          f"answer p50 {stages['query_answer']['p50_ms']:.1f}ms p99 {stages['query_answer']['p99_ms']:.1f}ms")
+
+    config = {
+        "pdfs": len(pdf_files), "corpus_mb": corpus_bytes / 1e6, "reuse_text": args.reuse_text,
+        "thread_count": pdf_helper.THREAD_COUNT, "chunk_mode": pdf_helper.CHUNK_MODE, "chunking": pdf_helper.chunking_params(),
+        "model": answer_queries.MODEL_NAME, "device": answer_queries.get_device(),
+        "insert_batch_size": answer_queries.INSERT_BATCH_SIZE, "search_backend": answer_queries.SEARCH_BACKEND,
+        "vector_storage": answer_queries.VECTOR_STORAGE, "hnsw_m": answer_queries.HNSW_M,
+        "hnsw_ef_construction": answer_queries.HNSW_EF_CONSTRUCTION, "hnsw_ef_search": answer_queries.HNSW_EF_SEARCH,
+        "context_token_budget": answer_queries.context_packing.CONTEXT_TOKEN_BUDGET,
+        "llm_num_ctx": llm_backend.LLM_NUM_CTX, "llm_keep_alive": llm_backend.LLM_KEEP_ALIVE,
+        "fake_llm_first_token_s": args.llm_first_token, "fake_llm_token_s": args.llm_token,
+    }
+    return config, stages
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage against a throwaway Postgres and a fake Ollama.")
+    parser.add_argument("--output", help="JSON file to write (default benchmarks/results/<commit>.json)")
+    parser.add_argument("--reuse-text", action="store_true", help="copy the committed Processed_pdf/ text instead of extracting")
+    parser.add_argument("--queries", type=int, default=100, help="queries to time")
+    parser.add_argument("--docker", action="store_true", help="run Postgres in docker even if local binaries exist")
+    parser.add_argument("--llm-first-token", type=float, default=0.05, help="fake LLM seconds until the first token")
+    parser.add_argument("--llm-token", type=float, default=0.005, help="fake LLM seconds per following token")
+    args = parser.parse_args(argv)
+
+    commit = git_commit()
+    print("Starting throwaway Postgres and fake Ollama...")
+    with ThrowawayPostgres(use_docker=args.docker or None) as pg, \
+            FakeOllama(first_token_delay=args.llm_first_token, token_delay=args.llm_token) as llm, \
+            tempfile.TemporaryDirectory(prefix="bench_suite_") as workdir:
+        os.environ.update(pg.settings)
+        os.environ["OLLAMA_HOST"] = llm.host
+        config, stages = run(args, workdir)
+
+    results = {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": config,
+        "stages": stages,
+    }
+    output = args.output or os.path.join(RESULTS_DIRECTORY, f"{(commit or 'unknown')[:12]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
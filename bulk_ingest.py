@@ -0,0 +1,165 @@
+# general utilities
+import os, sys, csv, json, time, argparse, dotenv
+import pdf_helper       # project paths
+import ingest_pipeline  # overlapping extract -> chunk -> embed -> insert
+import db_pool
+import metrics
+
+dotenv.load_dotenv()
+
+BULK_COMMIT_ROWS = int(os.environ.get("BULK_COMMIT_ROWS", 5000))      # Embeddings rows per transaction, each commit is a checkpoint
+DEFAULT_DOC_TYPE = os.environ.get("DEFAULT_DOC_TYPE", "report")       # type of documents whose manifest entry has none
+SOURCE_MAX_LENGTH = 200     # Document.source is a VARCHAR(200)
+
+REGISTER_QUERY = """INSERT INTO cs480_finalproject.document (title, type, source, added_by, processed)
+    SELECT t, ty, s, %s, FALSE FROM unnest(%s::varchar[], %s::varchar[], %s::varchar[]) AS d(t, ty, s)
+    RETURNING doc_id, source;
+    """
+ADDS_QUERY = """INSERT INTO cs480_finalproject.adds (curator_id, doc_id)
+    SELECT d.added_by, d.doc_id FROM cs480_finalproject.document d WHERE d.doc_id = ANY(%s)
+    ON CONFLICT DO NOTHING;
+    """
+# a document whose text could not be extracted has no chunks, it stays unprocessed so the next run tries it again
+MARK_PROCESSED_QUERY = """UPDATE cs480_finalproject.document d SET processed = TRUE
+    WHERE d.doc_id = ANY(%s)
+        AND EXISTS (SELECT 1 FROM cs480_finalproject.embeddings e WHERE e.source_doc_id = d.doc_id)
+    RETURNING d.doc_id;
+    """
+
+# Document.source holds the path relative to the project root, the same as create_doc asks for
+def source_path(path):
+    path = os.path.abspath(path)
+    relative = os.path.relpath(path, pdf_helper.PROJECT_ROOT)
+    return path if relative.startswith("..") else relative
+
+def load_entries(path, doc_type=DEFAULT_DOC_TYPE):
+    """
+    The documents to ingest, as dicts with 'path', 'title' and 'type'.
+
+    'path' is a directory (every pdf in it, titled by file name), a CSV file with a header row naming 'path', 'title'
+    and 'type' columns, or a JSON file holding a list of objects with those keys. Only 'path' is required, paths in a
+    manifest are relative to the manifest's own directory.
+    """
+    if os.path.isdir(path):
+        records = [{"path": pdf} for pdf in pdf_helper.corpus_pdfs(path)]
+        base = ""
+    elif path.lower().endswith(".csv"):
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            records = list(csv.DictReader(f))
+        base = os.path.dirname(path)
+    elif path.lower().endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            records = json.load(f)
+        base = os.path.dirname(path)
+    else:
+        raise ValueError(f"{path} is not a directory, .csv or .json manifest")
+
+    entries = []
+    for number, record in enumerate(records, start=1):
+        pdf_path = (record.get("path") or "").strip()
+        if not pdf_path:
+            print(f"  Skipping entry {number}, it has no path.")
+            continue
+        pdf_path = os.path.join(base, pdf_path)
+        title = (record.get("title") or "").strip() or os.path.splitext(os.path.basename(pdf_path))[0]
+        entries.append({"path": pdf_path, "title": title, "type": (record.get("type") or "").strip() or doc_type})
+    return entries
+
+def check_entries(entries, documents):
+    """
+    Split 'entries' in to the ones to register, the ones already registered (by an earlier, maybe interrupted, run)
+    and the ones that can't be ingested. 'documents' maps each existing source to (doc_id, processed).
+    """
+    new, resumed, skipped = [], [], []
+    seen = set()
+    # extracted and chunked text is named after the pdf's file name, so two documents can't share one
+    names = {os.path.splitext(os.path.basename(source))[0]: source for source in documents}
+    for entry in entries:
+        source = source_path(entry["path"])
+        name = os.path.splitext(os.path.basename(source))[0]
+        if source in seen:
+            skipped.append((entry, "listed twice"))
+        elif not os.path.isfile(entry["path"]) or not entry["path"].lower().endswith(".pdf"):
+            skipped.append((entry, "not a pdf file"))
+        elif len(source) > SOURCE_MAX_LENGTH or len(entry["title"]) > 200 or len(entry["type"]) > 200:
+            skipped.append((entry, "path, title or type longer than 200 characters"))
+        elif source in documents:
+            seen.add(source)
+            if not documents[source][1]:
+                resumed.append(dict(entry, source=source, doc_id=documents[source][0]))
+        elif name in names:
+            skipped.append((entry, f"another document has the same file name ({names[name]})"))
+        else:
+            names[name] = source
+            seen.add(source)
+            new.append(dict(entry, source=source))
+    return new, resumed, skipped
+
+def ingest(curator_id, path, doc_type=DEFAULT_DOC_TYPE, commit_rows=BULK_COMMIT_ROWS):
+    """
+    Add every document listed by 'path' (see load_entries) as 'curator_id', and embed them all in one pipeline run.
+
+    New documents get their Document and Adds rows in one transaction, marked unprocessed. Their pdfs are then
+    extracted in parallel and their chunks embedded in batches that span documents and written 'commit_rows' rows per
+    transaction. A document is marked processed once its chunks are in. Running it again on the same input resumes an
+    interrupted run: registered documents are not added twice, and text already extracted and chunks already embedded
+    are skipped. Returns the doc_ids that were processed.
+    """
+    start = time.perf_counter()
+    entries = load_entries(path, doc_type)
+
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT source, doc_id, processed FROM cs480_finalproject.document;")
+        documents = {source: (doc_id, processed) for source, doc_id, processed in cur.fetchall()}
+    new, resumed, skipped = check_entries(entries, documents)
+    for entry, reason in skipped:
+        print(f"  Skipping {entry['path']}: {reason}")
+    print(f"{len(entries)} documents listed: {len(new)} new, {len(resumed)} resumed from an earlier run, "
+          f"{len(entries) - len(new) - len(resumed) - len(skipped)} already processed, {len(skipped)} skipped")
+    if not new and not resumed:
+        return []
+
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        try:
+            if new:
+                cur.execute(REGISTER_QUERY, (curator_id, [e["title"] for e in new], [e["type"] for e in new],
+                                             [e["source"] for e in new]))
+                doc_ids = {source: doc_id for doc_id, source in cur.fetchall()}
+                for entry in new:
+                    entry["doc_id"] = doc_ids[entry["source"]]
+            cur.execute(ADDS_QUERY, ([e["doc_id"] for e in new + resumed],))
+            conn.commit()
+        except Exception as e:
+            print("Database error while registering documents:", e)
+            conn.rollback()
+            return None
+    print(f"  Registered {len(new)} documents in {time.perf_counter() - start:.2f} seconds")
+
+    pending = new + resumed
+    ingest_pipeline.run_pipeline([e["path"] for e in pending], commit_rows=commit_rows)
+
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute(MARK_PROCESSED_QUERY, ([e["doc_id"] for e in pending],))
+        processed = {row[0] for row in cur.fetchall()}
+        conn.commit()
+    for entry in pending:
+        if entry["doc_id"] not in processed:
+            print(f"  No text could be embedded for {entry['path']}, it will be retried on the next run.")
+    print(f"Ingested {len(processed)} of {len(pending)} documents in {time.perf_counter() - start:.2f} seconds")
+    return sorted(processed)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Add a directory or manifest of PDFs as a Curator, without the interactive CLI.")
+    parser.add_argument("path", help="directory of pdfs, or a .csv/.json manifest of path, title and type")
+    parser.add_argument("--curator", type=int, required=True, help="curator_id the documents are added by")
+    parser.add_argument("--type", default=DEFAULT_DOC_TYPE, help="document type for entries that don't give one")
+    parser.add_argument("--commit-rows", type=int, default=BULK_COMMIT_ROWS, help="Embeddings rows per transaction")
+    args = parser.parse_args(argv)
+
+    processed = ingest(args.curator, args.path, args.type, args.commit_rows)
+    if metrics.METRICS_ENABLED:
+        print(metrics.report())
+    return 1 if processed is None else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+# general utilities
+import os, math, dotenv
+
+dotenv.load_dotenv()
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 1500))         # retrieved text allowed in one prompt, bounds LLM prefill
+CONTEXT_MAX_DISTANCE = float(os.environ.get("CONTEXT_MAX_DISTANCE", 1.0))        # hits farther than this cosine distance are dropped
+CONTEXT_TOKENS_PER_WORD = float(os.environ.get("CONTEXT_TOKENS_PER_WORD", 1.3))  # LLM tokens per word of English, for the budget
+CONTEXT_MIN_OVERLAP = int(os.environ.get("CONTEXT_MIN_OVERLAP", 8))              # shared words needed before two chunks count as overlapping
+CONTEXT_MIN_PASSAGE = int(os.environ.get("CONTEXT_MIN_PASSAGE", 50))             # tokens, a passage cut shorter than this to fit is left out
+
+def estimate_tokens(words):
+    return math.ceil(len(words) * CONTEXT_TOKENS_PER_WORD)
+
+def overlap_length(first, second, min_overlap=CONTEXT_MIN_OVERLAP):
+    """
+    Number of words at the end of 'first' that 'second' starts with (the longest such run), or 0 if it is shorter than
+    'min_overlap'. A 'second' that is entirely the tail of 'first' overlaps by all of its words.
+    """
+    longest = min(len(first), len(second))
+    if longest < min_overlap or not second:
+        return 0
+    head = second[0]
+    # try the earliest start first, it gives the longest overlap
+    for start in range(len(first) - longest, len(first) - min_overlap + 1):
+        if first[start] == head and first[start:] == second[:len(first) - start]:
+            return len(first) - start
+    return 0
+
+def merge_passages(passages, min_overlap=CONTEXT_MIN_OVERLAP):
+    """
+    Join passages of the same document where one picks up where the other ends, until no two overlap. Consecutive
+    chunks share OVERLAP words (or a few sentences in token mode), so two hits on neighbouring chunks become one
+    passage holding that text once.
+    """
+    merged = True
+    while merged:
+        merged = False
+        for i, a in enumerate(passages):
+            for j, b in enumerate(passages):
+                if i == j or a["doc_id"] is None or a["doc_id"] != b["doc_id"]:
+                    continue
+                n = overlap_length(a["words"], b["words"], min_overlap)
+                if not n:
+                    continue
+                if b["score"] < a["score"]:
+                    a["best_start"] = len(a["words"]) - n + b["best_start"]
+                a["words"] = a["words"] + b["words"][n:]
+                a["score"] = min(a["score"], b["score"])
+                a["ranks"] = sorted(a["ranks"] + b["ranks"])
+                a["saved_words"] += b["saved_words"] + n
+                del passages[j]
+                merged = True
+                break
+            if merged:
+                break
+    return passages
+
+def pack_context(hits, token_budget=None, max_distance=None):
+    """
+    Turn ranked hits in to the passages to put in the prompt.
+
+    Hits farther than 'max_distance' (default CONTEXT_MAX_DISTANCE) are dropped, overlapping chunks of the same
+    document are merged, and passages are taken nearest first until 'token_budget' (default CONTEXT_TOKEN_BUDGET)
+    estimated tokens are used. The passage that crosses the budget is cut to fit, keeping the text from its nearest
+    chunk onwards. Returns (passages, stats), each passage a dict with 'text', 'doc_id', 'score', 'ranks' and 'tokens'.
+    """
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    max_distance = CONTEXT_MAX_DISTANCE if max_distance is None else max_distance
+
+    kept = [hit for hit in hits if hit["score"] <= max_distance]
+    passages = merge_passages([{"doc_id": hit.get("doc_id"), "words": hit["chunk"].split(), "score": hit["score"],
+                                "ranks": [hit["rank"]], "saved_words": 0, "best_start": 0} for hit in kept])
+    passages.sort(key=lambda p: p["score"])
+
+    packed, used, cut = [], 0, 0
+    for passage in passages:
+        words = passage["words"]
+        tokens = estimate_tokens(words)
+        if used + tokens > token_budget:
+            fits = int((token_budget - used) / CONTEXT_TOKENS_PER_WORD)
+            if estimate_tokens(words[:fits]) < CONTEXT_MIN_PASSAGE:
+                cut += len(words)
+                continue
+            cut += len(words) - fits
+            start = min(passage["best_start"], len(words) - fits)
+            words = words[start:start + fits]
+            tokens = estimate_tokens(words)
+        packed.append({"text": " ".join(words), "doc_id": passage["doc_id"], "score": passage["score"],
+                       "ranks": passage["ranks"], "tokens": tokens})
+        used += tokens
+
+    stats = {"hits": len(hits), "dropped": len(hits) - len(kept), "passages": len(packed), "tokens": used,
+             "merged_words": sum(p["saved_words"] for p in passages), "cut_words": cut}
+    return packed, stats
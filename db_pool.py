@@ -0,0 +1,125 @@
+# general utilities
+import os, time, threading, contextlib, atexit, dotenv
+import psycopg2, psycopg2.pool
+from pgvector.psycopg2 import register_vector
+
+dotenv.load_dotenv()
+
+DB_NAME = os.environ.get("DB_NAME", "postgres")
+DB_HOST = os.environ.get("DB_HOST", "localhost")
+DB_USER = os.environ.get("DB_USER", "postgres")
+DB_PASSWORD = os.environ.get("DB_PASSWORD", "postgres")
+DB_PORT = os.environ.get("DB_PORT", "5432")
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 8))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))               # seconds to wait for a free connection
+DB_HEALTH_CHECK_INTERVAL = float(os.environ.get("DB_HEALTH_CHECK_INTERVAL", 30))  # ping connections idle longer than this
+
+# Every pooled connection gets the pgvector adapters registered once, when it is opened
+class VectorConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        register_vector(conn)
+        conn.commit()   # register_vector looks up the vector type oid, don't leave that transaction open
+        _last_used[id(conn)] = time.monotonic()
+        return conn
+
+_pool = None
+_pool_lock = threading.Lock()
+# counts free connections so callers block instead of getting PoolError when all are checked out. It lives as long as
+# the process, not the pool: a connection checked out before close_all() still gives its slot back afterwards
+_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_last_used = {}     # id(conn) -> time it was last returned to the pool
+
+def get_pool():
+    """
+    Returns the process wide connection pool, opening it on first use.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = VectorConnectionPool(DB_POOL_MIN, DB_POOL_MAX,
+                        database=DB_NAME,
+                        host=DB_HOST,
+                        user=DB_USER,
+                        password=DB_PASSWORD,
+                        port=DB_PORT,
+                        options="-c search_path=cs480_finalproject,public")
+                atexit.register(close_all)
+    return _pool
+
+# A connection is healthy if it is open and, when it has sat idle for a while, still answers a trivial query
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    if time.monotonic() - _last_used.get(id(conn), 0) < DB_HEALTH_CHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _checkout(pool):
+    # a dropped server connection is thrown away and replaced, bounded so a dead server fails fast
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if _is_healthy(conn):
+            return conn
+        _last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError("Could not get a healthy database connection from the pool.")
+
+def _checkin(pool, conn, broken):
+    if pool.closed:
+        # close_all() ran while this connection was checked out, it has no pool to go back to
+        _last_used.pop(id(conn), None)
+        conn.close()
+        return
+    if not broken and not conn.closed:
+        try:
+            # anything the caller did not commit is discarded, the next user gets a clean connection
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            broken = True
+    if broken or conn.closed:
+        _last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    else:
+        _last_used[id(conn)] = time.monotonic()
+        pool.putconn(conn)
+
+@contextlib.contextmanager
+def connection():
+    """
+    Check out a connection for the duration of a with block, returning it to the pool afterwards.
+
+    Callers commit their own work, anything left uncommitted is rolled back when the connection is returned.
+    """
+    pool = get_pool()
+    if not _slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise psycopg2.pool.PoolError(f"No database connection became free within {DB_POOL_TIMEOUT} seconds.")
+    try:
+        conn = _checkout(pool)
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True   # the connection itself failed, don't hand it to anyone else
+            raise
+        finally:
+            _checkin(pool, conn, broken)
+    finally:
+        _slots.release()
+
+def close_all():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _last_used.clear()
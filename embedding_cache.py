@@ -0,0 +1,142 @@
+# general utilities
+import os, json, hashlib, dotenv
+import numpy as np
+import pdf_helper   # for project pathing
+import memmap_matrix   # the memory-mapped file the vectors live in
+
+dotenv.load_dotenv()
+
+# lives next to Chunked_txt/ so that a copy of the project directory carries its embeddings along with it
+EMBED_CACHE_DIRECTORY = os.path.join(pdf_helper.PROJECT_ROOT, "Embedding_cache")
+EMBED_CACHE_MAX_ENTRIES = int(os.environ.get("EMBED_CACHE_MAX_ENTRIES", 100000))
+EMBED_CACHE_DTYPE = os.environ.get("EMBED_CACHE_DTYPE", "float32")     # "float16" halves the disk footprint
+
+# Embeddings only depend on the text that was encoded, so that is all the cache key hashes.
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class EmbeddingCache(memmap_matrix.MemmapMatrix):
+    """
+    Persistent cache of chunk embeddings for one (model id, normalize flag) pair.
+
+    Vectors live in a flat memory-mapped array of 'dtype' rows ("slots"), and a JSON index maps each chunk hash to
+    its slot along with a last used tick. Once 'max_entries' is reached, the least recently used slots are reused.
+    """
+
+    def __init__(self, model_id, normalize=True, directory=EMBED_CACHE_DIRECTORY,
+                 max_entries=EMBED_CACHE_MAX_ENTRIES, dtype=EMBED_CACHE_DTYPE):
+        self.model_id = model_id
+        self.normalize = normalize
+        self.dtype = np.dtype(dtype)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # every (model, normalize, dtype) combination gets its own pair of files, so they never mix
+        namespace = hashlib.sha256(f"{model_id}\0{normalize}\0{self.dtype.name}".encode("utf-8")).hexdigest()[:16]
+        os.makedirs(directory, exist_ok=True)
+        self.data_path = os.path.join(directory, f"{namespace}.{self.dtype.name}.bin")
+        self.index_path = os.path.join(directory, f"{namespace}.index.json")
+
+        self.dim = None
+        self.capacity = 0
+        self.tick = 0           # bumped on every lookup or insert, orders entries for eviction
+        self.entries = {}       # chunk hash -> [slot, last used tick]
+        self.free = []          # slots released by eviction
+        self.data = None        # np.memmap of shape (capacity, dim)
+
+        if os.path.exists(self.index_path) and os.path.exists(self.data_path):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            self.dim = index["dim"]
+            self.capacity = index["capacity"]
+            self.tick = index["tick"]
+            self.entries = index["entries"]
+            self.free = index["free"]
+            if self.capacity > 0:
+                self._map()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses, "hit_rate": hit_rate}
+
+    def get_many(self, keys):
+        """
+        Look up every hash in 'keys'.
+
+        Returns (embeddings, missing) where 'embeddings' is a float32 matrix with one row per key (rows of misses are
+        left as zeros), or None if the cache has never stored anything, and 'missing' lists the indices of the misses.
+        """
+        if self.dim is None:
+            self.misses += len(keys)
+            return None, list(range(len(keys)))
+
+        embeddings = np.zeros((len(keys), self.dim), dtype=np.float32)
+        missing = []
+        for i, key in enumerate(keys):
+            entry = self.entries.get(key)
+            if entry is None:
+                missing.append(i)
+                continue
+            self.tick += 1
+            entry[1] = self.tick
+            embeddings[i] = self.data[entry[0]]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        return embeddings, missing
+
+    def put_many(self, keys, embeddings):
+        """
+        Store one embedding per hash in 'keys', evicting the least recently used entries if the cache is full.
+        """
+        if len(keys) == 0:
+            return
+        if self.dim is None:
+            self.dim = int(embeddings.shape[1])
+
+        # never try to keep more than max_entries, only the tail of an oversized batch is stored
+        if len(keys) > self.max_entries:
+            keys, embeddings = keys[-self.max_entries:], embeddings[-self.max_entries:]
+
+        new_keys = sum(1 for key in set(keys) if key not in self.entries)
+        overflow = len(self.entries) + new_keys - self.max_entries
+        if overflow > 0:
+            self._evict(overflow, protected=set(keys))
+
+        needed = len(self.entries) + len(self.free) + max(0, new_keys - len(self.free))
+        if needed > self.capacity:
+            self._grow(needed, self.max_entries)
+
+        for key, embedding in zip(keys, embeddings):
+            self.tick += 1
+            entry = self.entries.get(key)
+            if entry is None:
+                slot = self.free.pop() if self.free else len(self.entries) + len(self.free)
+                entry = self.entries[key] = [slot, self.tick]
+            entry[1] = self.tick
+            self.data[entry[0]] = embedding
+
+    def save(self):
+        """
+        Flush the vectors and atomically rewrite the index, so a crash never leaves an index pointing at garbage.
+        """
+        self._write_index({
+            "model_id": self.model_id,
+            "normalize": self.normalize,
+            "dtype": self.dtype.name,
+            "dim": self.dim,
+            "capacity": self.capacity,
+            "tick": self.tick,
+            "entries": self.entries,
+            "free": self.free,
+        })
+
+    # Release the 'count' least recently used slots, never evicting anything in 'protected'
+    def _evict(self, count, protected):
+        candidates = sorted((entry[1], key) for key, entry in self.entries.items() if key not in protected)
+        for _, key in candidates[:count]:
+            self.free.append(self.entries.pop(key)[0])
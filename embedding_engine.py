@@ -0,0 +1,258 @@
+# general utilities
+import os, time, atexit, platform, threading, multiprocessing, dotenv
+import numpy as np
+import pdf_helper   # embedding model name and its tokenizer
+
+dotenv.load_dotenv()
+
+EMBED_BACKEND = os.environ.get("EMBED_BACKEND", "torch")          # "torch", "onnx", or "onnx-int8" for the dynamically quantized export
+EMBED_WORKERS = int(os.environ.get("EMBED_WORKERS", 1))           # encoding processes, 1 encodes in this process
+EMBED_THREADS = int(os.environ.get("EMBED_THREADS", 0))           # threads per process, 0 splits the cores evenly between workers
+EMBED_PIN_CORES = os.environ.get("EMBED_PIN_CORES", "1") == "1"   # give each worker its own cores (Linux only)
+EMBED_MODEL_BATCH_SIZE = int(os.environ.get("EMBED_MODEL_BATCH_SIZE", 64))    # most chunks in one forward pass
+EMBED_BATCH_TOKENS = int(os.environ.get("EMBED_BATCH_TOKENS", 8192))          # most padded tokens in one forward pass
+EMBED_MAX_SEQ_LENGTH = 256  # all-MiniLM-L6-v2 truncates input past 256 word pieces
+EMBED_ONNX_FILE = os.environ.get("EMBED_ONNX_FILE")              # overrides the quantized file picked for this CPU
+EMBED_PARITY_MIN_COSINE = float(os.environ.get("EMBED_PARITY_MIN_COSINE", 0.99))
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+
+def _cpu_flags():
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return set(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return set()
+
+# The model repository ships int8 exports made with onnxruntime's dynamic quantization, one per instruction set
+def onnx_int8_file():
+    if EMBED_ONNX_FILE:
+        return EMBED_ONNX_FILE
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "onnx/model_qint8_arm64.onnx"
+    flags = _cpu_flags()
+    if "avx512_vnni" in flags:
+        return "onnx/model_qint8_avx512_vnni.onnx"
+    if "avx512f" in flags:
+        return "onnx/model_qint8_avx512.onnx"
+    return "onnx/model_quint8_avx2.onnx"
+
+# ONNX Runtime is only used on the CPU, on a GPU load_model() loads the torch model whatever 'backend' asks for
+def effective_backend(backend=EMBED_BACKEND, device="cpu"):
+    return backend if device == "cpu" else "torch"
+
+def model_id(model_name=pdf_helper.EMBED_MODEL_NAME, backend=EMBED_BACKEND, device="cpu"):
+    """
+    Names what produces the vectors on 'device', the int8 model's differ slightly from the float one's so they are
+    cached apart.
+    """
+    backend = effective_backend(backend, device)
+    if backend == "torch":
+        return model_name
+    if backend == "onnx-int8":
+        return f"{model_name}@{onnx_int8_file()}"
+    return f"{model_name}@{backend}"
+
+def load_model(model_name=pdf_helper.EMBED_MODEL_NAME, device="cpu", backend=EMBED_BACKEND, threads=0):
+    """
+    The SentenceTransformer for 'backend', running on 'threads' threads (0 leaves the library default).
+    ONNX Runtime is only used on the CPU, on a GPU the torch model is loaded instead.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown EMBED_BACKEND {backend!r}, expected one of {', '.join(BACKENDS)}")
+    if effective_backend(backend, device) != backend:
+        print(f"EMBED_BACKEND={backend} only runs on the CPU, using the torch model on {device}")
+        backend = "torch"
+    from sentence_transformers import SentenceTransformer # heavy import
+    if backend == "torch":
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        return SentenceTransformer(model_name, device=device)
+
+    model_kwargs = {"provider": "CPUExecutionProvider"}
+    if backend == "onnx-int8":
+        model_kwargs["file_name"] = onnx_int8_file()
+    if threads:
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        model_kwargs["session_options"] = options
+    return SentenceTransformer(model_name, device="cpu", backend="onnx", model_kwargs=model_kwargs)
+
+def encode_with(model, texts):
+    # the batch was sized by plan_batches, so it goes through in one forward pass
+    return model.encode(texts, batch_size=max(1, len(texts)), convert_to_numpy=True, normalize_embeddings=True)
+
+def token_lengths(texts):
+    tokenizer = pdf_helper.get_tokenizer()
+    encoded = tokenizer(list(texts), add_special_tokens=True, truncation=True, max_length=EMBED_MAX_SEQ_LENGTH)
+    return np.array([len(ids) for ids in encoded["input_ids"]], dtype=np.int64)
+
+def plan_batches(lengths, batch_size=EMBED_MODEL_BATCH_SIZE, batch_tokens=EMBED_BATCH_TOKENS):
+    """
+    Group text indices in to batches of similar token length, so little of each forward pass is spent on padding.
+
+    Texts are sorted by length and cut in to runs of at most 'batch_size' texts whose padded size (count times the
+    longest) stays within 'batch_tokens'. Returns the batches longest first, the order they are best scheduled in.
+    """
+    batches, current = [], []
+    for i in np.argsort(lengths, kind="stable"):
+        # sorted ascending, so the text being added is the longest of its batch
+        if current and (len(current) >= batch_size or (len(current) + 1) * lengths[i] > batch_tokens):
+            batches.append(current)
+            current = []
+        current.append(int(i))
+    if current:
+        batches.append(current)
+    batches.reverse()
+    return batches
+
+def padding_stats(lengths, batches):
+    real = int(sum(lengths[i] for batch in batches for i in batch))
+    padded = int(sum(len(batch) * max(lengths[i] for i in batch) for batch in batches))
+    return {"batches": len(batches), "tokens": real, "padded_tokens": padded, "padding_efficiency": real / max(padded, 1)}
+
+# Process pool workers: each loads its own model once, on the threads (and cores) it was given
+_worker_model = None
+
+def _init_worker(model_name, backend, threads, core_sets, counter):
+    global _worker_model
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    # before torch or onnxruntime is imported, their thread pools size themselves from these
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    if core_sets:
+        os.sched_setaffinity(0, core_sets[index % len(core_sets)])
+    _worker_model = load_model(model_name, "cpu", backend, threads)
+
+def _encode_batch(args):
+    indices, texts = args
+    return indices, encode_with(_worker_model, texts)
+
+class EmbeddingEngine:
+    """
+    Encodes chunks in length-bucketed batches, in this process or sharded across a pool of 'workers' processes.
+
+    Each worker runs 'threads' threads, pinned to its own cores where the OS allows it, so workers don't contend for
+    the same ones. The pool starts on the first encode() and lives until close(). With one worker, 'local_model'
+    (a function returning a loaded model) is used instead of loading another copy.
+    """
+
+    def __init__(self, model_name=pdf_helper.EMBED_MODEL_NAME, backend=EMBED_BACKEND, workers=EMBED_WORKERS,
+                 threads=EMBED_THREADS, pin_cores=EMBED_PIN_CORES, batch_size=EMBED_MODEL_BATCH_SIZE,
+                 batch_tokens=EMBED_BATCH_TOKENS, local_model=None, bucketed=True):
+        self.model_name = model_name
+        self.backend = backend
+        self.workers = max(1, workers)
+        cores = os.cpu_count() or 1
+        self.threads = threads or (max(1, cores // self.workers) if self.workers > 1 else 0)
+        self.pin_cores = pin_cores and hasattr(os, "sched_setaffinity")
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.bucketed = bucketed    # False cuts fixed size batches in input order, only there to measure what bucketing saves
+        self.last_stats = {}
+        self._local_model = local_model
+        self._model = None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def cores(self):
+        """
+        Cores the engine encodes on, for per core throughput.
+        """
+        return self.workers * self.threads if self.threads else (os.cpu_count() or 1)
+
+    def _core_sets(self):
+        if not self.pin_cores:
+            return None
+        available = sorted(os.sched_getaffinity(0))
+        if len(available) < self.workers * self.threads:
+            return None     # not enough cores for every worker to have its own
+        return [set(available[i * self.threads:(i + 1) * self.threads]) for i in range(self.workers)]
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                start = time.perf_counter()
+                # spawned, not forked, a fork of a process whose torch thread pool is running can deadlock
+                ctx = multiprocessing.get_context("spawn")
+                self._pool = ctx.Pool(self.workers, initializer=_init_worker, initargs=(
+                    self.model_name, self.backend, self.threads, self._core_sets(), ctx.Value("i", 0)))
+                atexit.register(self.close)
+                print(f"Started {self.workers} embedding workers ({self.backend}, {self.threads} threads each) "
+                      f"in {time.perf_counter() - start:.2f} seconds")
+            return self._pool
+
+    def _get_model(self):
+        with self._lock:
+            if self._model is None:
+                self._model = self._local_model() if self._local_model else load_model(
+                    self.model_name, "cpu", self.backend, self.threads)
+            return self._model
+
+    def encode(self, texts):
+        """
+        Normalized float32 embeddings of 'texts', one row per text in the order given.
+        """
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        lengths = token_lengths(texts)
+        if self.bucketed:
+            batches = plan_batches(lengths, self.batch_size, self.batch_tokens)
+        else:
+            batches = [list(range(i, min(i + self.batch_size, len(texts)))) for i in range(0, len(texts), self.batch_size)]
+        self.last_stats = padding_stats(lengths, batches)
+
+        embeddings = None
+        if self.workers == 1:
+            model = self._get_model()
+            parts = ((batch, encode_with(model, [texts[i] for i in batch])) for batch in batches)
+        else:
+            parts = self._get_pool().imap_unordered(_encode_batch, ((batch, [texts[i] for i in batch]) for batch in batches))
+        for batch, encoded in parts:
+            if embeddings is None:
+                embeddings = np.empty((len(texts), encoded.shape[1]), dtype=np.float32)
+            embeddings[batch] = encoded
+        return embeddings
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+def parity_check(embeddings, reference, min_cosine=EMBED_PARITY_MIN_COSINE, k=5):
+    """
+    Compare 'embeddings' with 'reference' embeddings of the same texts (both normalized).
+
+    Reports the cosine similarity between each pair of vectors, and how much of each text's top 'k' nearest neighbors
+    among the other texts is the same under both, which is what retrieval actually depends on.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    reference = np.asarray(reference, dtype=np.float32)
+    cosine = np.sum(embeddings * reference, axis=1)
+
+    k = min(k, len(reference) - 1)
+    agreement = 1.0
+    if k > 0:
+        def neighbors(matrix):
+            scores = matrix @ matrix.T
+            np.fill_diagonal(scores, -np.inf)
+            return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        ours, theirs = neighbors(embeddings), neighbors(reference)
+        agreement = float(np.mean([len(set(a) & set(b)) / k for a, b in zip(ours, theirs)]))
+
+    return {"min_cosine": float(cosine.min()), "mean_cosine": float(cosine.mean()),
+            "max_abs_diff": float(np.abs(embeddings - reference).max()), "neighbor_agreement": agreement,
+            "passed": bool(cosine.min() >= min_cosine)}
@@ -0,0 +1,279 @@
+# general utilities
+import os, sys, time, queue, threading, contextlib, multiprocessing, dotenv
+import pdf_helper       # extraction and chunking
+import artifact_manifest
+import answer_queries   # embedding, content hashes and bulk inserts
+import db_pool
+import query_cache
+import metrics
+
+dotenv.load_dotenv()
+
+CHUNK_WORKERS = int(os.environ.get("CHUNK_WORKERS", 2))                 # chunking processes
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 256))         # chunks per model.encode call
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 4))     # items buffered between two stages
+PIPELINE_COMMIT_ROWS = int(os.environ.get("PIPELINE_COMMIT_ROWS", 0))   # rows written per transaction, 0 commits every batch
+
+_DONE = None    # end of stream marker passed down the queues
+_POLL_INTERVAL = 0.1    # seconds a stage waits on a queue before checking whether the pipeline was stopped
+
+class StageStats:
+    """
+    Counters for one pipeline stage.
+
+    'busy' is time spent doing work, 'starved' is time spent waiting for the previous stage to hand over input, and
+    'blocked' is time spent waiting for the next stage to make room (backpressure). The bottleneck is the stage whose
+    neighbours are the ones waiting.
+
+    Once 'stop' is set (a stage failed), get() returns _DONE and put() gives up instead of waiting on the queue, so no
+    stage is left blocked on a neighbour that is gone.
+    """
+
+    def __init__(self, name, stop):
+        self.name = name
+        self.stop = stop
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    def get(self, q):
+        start = time.perf_counter()
+        try:
+            while not self.stop.is_set():
+                try:
+                    return q.get(timeout=_POLL_INTERVAL)
+                except queue.Empty:
+                    pass
+            return _DONE
+        finally:
+            self.starved += time.perf_counter() - start
+
+    # returns whether 'item' was handed over
+    def put(self, q, item):
+        start = time.perf_counter()
+        try:
+            while not self.stop.is_set():
+                try:
+                    q.put(item, timeout=_POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            self.blocked += time.perf_counter() - start
+
+    def report(self, wall_time, unit):
+        rate = self.items / self.busy if self.busy else 0.0
+        return (f"    {self.name:<8} {self.items:>7} {unit:<6} busy {self.busy:7.2f}s ({rate:8.1f} {unit}/s)"
+                f"  starved {self.starved:7.2f}s  blocked {self.blocked:7.2f}s  utilization {self.busy / max(wall_time, 1e-9):4.0%}")
+
+# Worker for the chunking pool, reuses the chunk file left by an earlier run if the manifest says it is current and
+# writes a new one otherwise. Returns whether it wrote one, the parent process records it in the manifest.
+def _chunk(args):
+    txt_path, current = args
+    start = time.perf_counter()
+    if not os.path.exists(txt_path):
+        return txt_path, [], False, time.perf_counter() - start    # extraction failed
+
+    chunked_path = pdf_helper.chunked_txt_path(txt_path)
+    if current:
+        with open(chunked_path, "r", encoding="utf-8") as f:
+            chunks = [line.strip() for line in f if line.strip()]
+    else:
+        chunks = list(pdf_helper.iter_chunks(txt_path))
+        with artifact_manifest.atomic_write(chunked_path) as f:
+            for chunk in chunks:
+                f.write(chunk + "\n")
+    return txt_path, chunks, not current, time.perf_counter() - start
+
+# chunk file name (without extension) -> doc_id, matching how update_all_chunks pairs chunk files with documents
+def _documents_by_name():
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT doc_id, source FROM cs480_finalproject.document;")
+        docs = cur.fetchall()
+    return {os.path.splitext(os.path.basename(source))[0]: doc_id for doc_id, source in docs}
+
+def run_pipeline(pdf_files=None, commit_rows=None):
+    """
+    Extract, chunk, embed and insert 'pdf_files' (default: every pdf in Corpus/) with all four stages overlapping.
+
+    Extraction runs on a THREAD_COUNT process pool and chunking on a CHUNK_WORKERS process pool. Embedding starts on
+    the first document to come out of chunking, in EMBED_BATCH_SIZE batches that span documents, and a writer thread
+    COPYs each batch while the next one is encoded, committing once 'commit_rows' (default PIPELINE_COMMIT_ROWS) rows
+    are written. Stages hand work over through bounded queues. Like init_rag, chunks that are already embedded are
+    skipped and rows whose chunk disappeared are deleted, so a run that was interrupted resumes from its last commit.
+    If any stage fails, every stage stops and the first error is raised.
+    """
+    commit_rows = PIPELINE_COMMIT_ROWS if commit_rows is None else commit_rows
+    if pdf_files is None:
+        pdf_files = pdf_helper.corpus_pdfs()
+    pdf_files = sorted(pdf_files, key=os.path.getsize, reverse=True)  # longest schedule first, greedy approximation
+
+    documents = _documents_by_name()
+    stored = answer_queries.load_stored_embeddings()
+    stop = threading.Event()    # set by the first stage to fail
+    stats = {name: StageStats(name, stop) for name in ("extract", "chunk", "embed", "insert")}
+
+    txt_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)       # extracted text paths
+    chunk_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)     # (doc_id, chunks) per document
+    row_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)       # embedded batches waiting to be written
+    errors = []
+    processed_docs = set()
+
+    def fail(e):
+        errors.append(e)
+        stop.set()
+
+    print(f"Ingesting {len(pdf_files)} PDFs...")
+    wall_start = time.perf_counter()
+
+    # extraction workers run in parallel, so for this stage 'busy' is the stage's wall time outside of backpressure
+    def extract_stage(pool):
+        start = time.perf_counter()
+        try:
+            pending = []
+            for pdf_path in pdf_files:
+                if stop.is_set():
+                    return
+                if pdf_helper.extraction_is_current(pdf_path):
+                    stats["extract"].put(txt_queue, pdf_helper.extracted_txt_path(pdf_path))   # extracted by an earlier run
+                else:
+                    pending.append(pdf_path)
+            # big pdfs are split in to page ranges, each pdf is handed on as soon as all of its pages are done
+            # closed on the way out, so a stopped run removes the page ranges of pdfs it didn't finish
+            tasks = pdf_helper.plan_extraction(pending, pdf_helper.THREAD_COUNT)
+            with contextlib.closing(pdf_helper.run_extraction(tasks, pool)) as extracted:
+                for pdf_path, _ in extracted:
+                    stats["extract"].items += 1
+                    if not stats["extract"].put(txt_queue, pdf_helper.extracted_txt_path(pdf_path)):
+                        return
+        except Exception as e:
+            fail(e)
+        finally:
+            stats["extract"].busy = time.perf_counter() - start - stats["extract"].blocked
+            stats["extract"].put(txt_queue, _DONE)
+
+    def chunk_stage(pool):
+        try:
+            txt_paths = iter(lambda: stats["chunk"].get(txt_queue), _DONE)
+            work = ((txt_path, pdf_helper.chunks_are_current(txt_path)) for txt_path in txt_paths)
+            for txt_path, chunks, written, elapsed in pool.imap_unordered(_chunk, work):
+                stats["chunk"].items += 1
+                stats["chunk"].busy += elapsed
+                if written:
+                    pdf_helper.get_manifest().record(pdf_helper.chunked_txt_path(txt_path), txt_path, pdf_helper.chunking_params())
+                doc_id = documents.get(os.path.splitext(os.path.basename(txt_path))[0])
+                if doc_id is None:
+                    print(f"  No Document row for {os.path.basename(txt_path)}, skipping.")
+                    continue
+                if not stats["chunk"].put(chunk_queue, (doc_id, chunks)):
+                    break
+        except Exception as e:
+            fail(e)
+        finally:
+            stats["chunk"].put(chunk_queue, _DONE)
+
+    def insert_stage():
+        try:
+            with db_pool.connection() as conn, conn.cursor() as cur:
+                uncommitted = 0
+                while True:
+                    batch = stats["insert"].get(row_queue)
+                    if batch is _DONE:
+                        break
+                    start = time.perf_counter()
+                    doc_ids, texts, hashes, embeddings = batch
+                    answer_queries.bulk_insert_embeddings(cur, doc_ids, texts, hashes, embeddings)
+                    uncommitted += len(texts)
+                    if uncommitted >= commit_rows:
+                        conn.commit()
+                        uncommitted = 0
+                    stats["insert"].items += len(texts)
+                    stats["insert"].busy += time.perf_counter() - start
+                conn.commit()
+        except Exception as e:
+            fail(e)
+
+    # embedding runs on this thread, between the chunkers and the writer
+    def embed_stage():
+        pending = []    # (chunk_text, doc_id, content_hash) waiting for a full batch
+
+        def flush():
+            start = time.perf_counter()
+            texts = [tup[0] for tup in pending]
+            embeddings = answer_queries.encode_chunks(texts)
+            stats["embed"].items += len(texts)
+            stats["embed"].busy += time.perf_counter() - start
+            stats["embed"].put(row_queue, ([tup[1] for tup in pending], texts, [tup[2] for tup in pending], embeddings))
+            pending.clear()
+
+        while True:
+            item = stats["embed"].get(chunk_queue)
+            if item is _DONE:
+                break
+            doc_id, chunks = item
+            processed_docs.add(doc_id)
+            for chunk_text in chunks:
+                content_hash = answer_queries.chunk_hash(chunk_text)
+                matches = stored.get((doc_id, content_hash))
+                if matches:
+                    matches.pop()   # already embedded
+                    continue
+                pending.append((chunk_text, doc_id, content_hash))
+                if len(pending) >= EMBED_BATCH_SIZE:
+                    flush()
+                    if stop.is_set():
+                        return      # a stage failed, the error is raised once every thread is done
+        if pending and not stop.is_set():
+            flush()
+
+    with multiprocessing.Pool(processes=pdf_helper.THREAD_COUNT) as extract_pool, \
+            multiprocessing.Pool(processes=CHUNK_WORKERS) as chunk_pool:
+        threads = [
+            threading.Thread(target=extract_stage, args=(extract_pool,), name="extract"),
+            threading.Thread(target=chunk_stage, args=(chunk_pool,), name="chunk"),
+            threading.Thread(target=insert_stage, name="insert"),
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            embed_stage()
+        except Exception as e:
+            fail(e)
+        finally:
+            stats["embed"].put(row_queue, _DONE)
+            for thread in threads:
+                thread.join()
+
+    if errors:
+        # extraction workers may have still been writing page ranges when the pool was terminated
+        for pdf_path in pdf_files:
+            pdf_helper.remove_parts(pdf_path)
+        raise errors[0]
+
+    # rows of documents we just went through whose chunk no longer exists
+    stale = [embed_id for (doc_id, _), embed_ids in stored.items() if doc_id in processed_docs for embed_id in embed_ids]
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        if stale:
+            cur.execute("DELETE FROM cs480_finalproject.embeddings WHERE embed_id = ANY(%s);", (stale,))
+        rebuilt = answer_queries.create_hnsw_index(cur)
+        conn.commit()
+    if stale or stats["insert"].items or rebuilt:
+        query_cache.bump_corpus_generation()
+
+    wall_time = time.perf_counter() - wall_start
+    for stage in stats.values():
+        metrics.record(f"pipeline.{stage.name}", stage.busy, items=stage.items, starved=stage.starved,
+                       blocked=stage.blocked, wall_time=wall_time)
+    print(f"  Pipeline finished in {wall_time:.2f} seconds, {stats['insert'].items} rows inserted, {len(stale)} stale rows deleted")
+    print(stats["extract"].report(wall_time, "pdfs"))
+    print(stats["chunk"].report(wall_time, "docs"))
+    print(stats["embed"].report(wall_time, "chunks"))
+    print(stats["insert"].report(wall_time, "rows"))
+    return stats
+
+if __name__ == "__main__":
+    run_pipeline(sys.argv[1:] or None)
+    if metrics.METRICS_ENABLED:
+        print(metrics.report())
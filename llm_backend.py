@@ -0,0 +1,250 @@
+# general utilities
+import os, time, asyncio, threading, dotenv
+import httpx
+import ollama
+import metrics
+
+dotenv.load_dotenv()
+
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "ollama")              # "ollama", or "fake" for tests and benchmarks
+LLM_MODEL = os.environ.get("LLM_MODEL", "llama3")                  # replace with the model you have locally
+LLM_KEEP_ALIVE = os.environ.get("LLM_KEEP_ALIVE", "30m")           # how long Ollama keeps the model loaded after a request, "-1" for ever
+LLM_NUM_CTX = int(os.environ.get("LLM_NUM_CTX", 4096))             # context window, has to hold the system prompt, CONTEXT_TOKEN_BUDGET and the answer
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", 4))        # requests in flight at once, per process
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 120))            # seconds to connect, or between two reads of a response
+LLM_RETRIES = int(os.environ.get("LLM_RETRIES", 2))                # extra attempts after a timeout, dropped connection or server error
+LLM_RETRY_BACKOFF = float(os.environ.get("LLM_RETRY_BACKOFF", 0.5))  # seconds before the first retry, doubled for each one after
+
+# Never changes and always goes first, so every request starts with the same tokens and the server can reuse the
+# prompt prefix it already evaluated instead of prefilling it again. Per question text goes in the user message.
+SYSTEM_PROMPT = ("You are a domain expert assistant. Answer the user's question grounded on, but not absolutely "
+                 "limited to, the context provided with it.")
+
+def is_retryable(error):
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code >= 500
+    return isinstance(error, (ConnectionError, httpx.TransportError))   # TransportError covers timeouts
+
+# Time to first token and tokens/s of one answer from the timings (in nanoseconds) Ollama puts in its final message.
+# Without streaming, the time to first token is the server's model load plus prompt evaluation.
+def record_stats(response, time_to_first_token=None):
+    if not metrics.METRICS_ENABLED:
+        return
+    if time_to_first_token is None and response.get("prompt_eval_duration") is not None:
+        time_to_first_token = ((response.get("load_duration") or 0) + response.get("prompt_eval_duration")) / 1e9
+    if time_to_first_token is not None:
+        metrics.record("llm.first_token", time_to_first_token)
+    eval_count, eval_duration = response.get("eval_count"), response.get("eval_duration")
+    if eval_count and eval_duration:
+        metrics.observe("rag_llm_tokens_per_second", "llm.generate", eval_count / (eval_duration / 1e9))
+
+class LLMBackend:
+    """
+    Chat with an LLM under a concurrency limit, retrying failed requests, and recording metrics for every answer.
+
+    chat() returns the whole answer, stream() and astream() yield it as it is generated. Responses are Ollama's
+    ChatResponse objects whatever the backend, so response["message"]["content"] always works. A stream is only
+    retried if it fails before its first part arrived, after that the caller has already seen part of the answer.
+    Subclasses implement _chat, _stream and _astream.
+    """
+
+    def __init__(self, model=LLM_MODEL, concurrency=LLM_CONCURRENCY, retries=LLM_RETRIES):
+        self.model = model
+        self.retries = retries
+        self.concurrency = max(1, concurrency)
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+        self._async_state = (None, None)     # (event loop, asyncio.Semaphore), a semaphore only works on its own loop
+
+    def _async_slots(self):
+        loop = asyncio.get_running_loop()
+        if self._async_state[0] is not loop:
+            self._async_state = (loop, asyncio.Semaphore(self.concurrency))
+        return self._async_state[1]
+
+    def _backoff(self, attempt, error):
+        if attempt >= self.retries or not is_retryable(error):
+            return None
+        metrics.count("llm_retry")
+        print(f"  LLM request failed ({type(error).__name__}), retrying")
+        return LLM_RETRY_BACKOFF * 2 ** attempt
+
+    def chat(self, messages):
+        with self._slots, metrics.span("llm.generate", model=self.model) as span:
+            attempt = 0
+            while True:
+                try:
+                    response = self._chat(messages)
+                    break
+                except Exception as e:
+                    delay = self._backoff(attempt, e)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    attempt += 1
+            span.add(items=response.get("eval_count") or 0, attempts=attempt + 1)
+        record_stats(response)
+        return response
+
+    def stream(self, messages):
+        with self._slots:
+            start = time.perf_counter()
+            time_to_first_token = None
+            attempt = 0
+            part = {}   # the final part carries the timings, an empty stream has none
+            while True:
+                try:
+                    for part in self._stream(messages):
+                        if time_to_first_token is None:
+                            time_to_first_token = time.perf_counter() - start
+                        yield part
+                    break
+                except Exception as e:
+                    delay = self._backoff(attempt, e) if time_to_first_token is None else None
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    attempt += 1
+        # a generator can finish on another thread's context, so this is recorded rather than timed with a span
+        metrics.record("llm.generate", time.perf_counter() - start, part.get("eval_count") or 0, model=self.model, attempts=attempt + 1)
+        record_stats(part, time_to_first_token)
+
+    async def astream(self, messages):
+        async with self._async_slots():
+            start = time.perf_counter()
+            time_to_first_token = None
+            attempt = 0
+            part = {}
+            while True:
+                try:
+                    async for part in self._astream(messages):
+                        if time_to_first_token is None:
+                            time_to_first_token = time.perf_counter() - start
+                        yield part
+                    break
+                except Exception as e:
+                    delay = self._backoff(attempt, e) if time_to_first_token is None else None
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    attempt += 1
+        metrics.record("llm.generate", time.perf_counter() - start, part.get("eval_count") or 0, model=self.model, attempts=attempt + 1)
+        record_stats(part, time_to_first_token)
+
+    def load(self):
+        """
+        Ask the server to load the model ahead of the first question. Does nothing for backends without one.
+        """
+
+class OllamaBackend(LLMBackend):
+    """
+    One persistent client (and connection pool) per process, every request asking Ollama to keep the model loaded
+    for 'keep_alive' with a 'num_ctx' token context window.
+    """
+
+    def __init__(self, host=None, model=LLM_MODEL, keep_alive=LLM_KEEP_ALIVE, num_ctx=LLM_NUM_CTX,
+                 concurrency=LLM_CONCURRENCY, timeout=LLM_TIMEOUT, retries=LLM_RETRIES):
+        super().__init__(model, concurrency, retries)
+        self.host = host or os.environ.get("OLLAMA_HOST")
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.options = {"num_ctx": num_ctx}
+        self.client = ollama.Client(host=self.host, timeout=timeout)
+        self._async_client = (None, None)   # (event loop, AsyncClient), its connections belong to one loop
+
+    def _get_async_client(self):
+        loop = asyncio.get_running_loop()
+        if self._async_client[0] is not loop:
+            self._async_client = (loop, ollama.AsyncClient(host=self.host, timeout=self.timeout))
+        return self._async_client[1]
+
+    def _chat(self, messages):
+        return self.client.chat(model=self.model, messages=messages, options=self.options, keep_alive=self.keep_alive)
+
+    def _stream(self, messages):
+        return self.client.chat(model=self.model, messages=messages, options=self.options, keep_alive=self.keep_alive, stream=True)
+
+    async def _astream(self, messages):
+        client = self._get_async_client()
+        async for part in await client.chat(model=self.model, messages=messages, options=self.options,
+                                            keep_alive=self.keep_alive, stream=True):
+            yield part
+
+    def load(self):
+        # a chat request without messages only loads the model
+        self.client.chat(model=self.model, messages=[], keep_alive=self.keep_alive)
+
+class FakeBackend(LLMBackend):
+    """
+    Answers every question with the same canned text after simulated delays, with the timing fields a real Ollama
+    response has. For tests and benchmarks that must not depend on a model being installed.
+    """
+    ANSWER = ("Based on the provided context, the documents describe the topic of the question in detail, and the "
+              "relevant passages are summarized here.")
+
+    def __init__(self, model="fake", first_token_delay=0.05, token_delay=0.005, concurrency=LLM_CONCURRENCY):
+        super().__init__(model, concurrency, retries=0)
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.requests = 0
+
+    def _response(self, content, done, tokens=0):
+        timings = {}
+        if done:
+            timings = {"done_reason": "stop", "prompt_eval_duration": int(self.first_token_delay * 1e9),
+                       "eval_count": tokens, "eval_duration": int(self.token_delay * max(tokens - 1, 1) * 1e9)}
+        return ollama.ChatResponse(model=self.model, created_at=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                                   message=ollama.Message(role="assistant", content=content), done=done, **timings)
+
+    def _tokens(self):
+        words = self.ANSWER.split(" ")
+        return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+    def _chat(self, messages):
+        self.requests += 1
+        tokens = self._tokens()
+        time.sleep(self.first_token_delay + self.token_delay * (len(tokens) - 1))
+        return self._response("".join(tokens), True, len(tokens))
+
+    def _stream(self, messages):
+        self.requests += 1
+        tokens = self._tokens()
+        time.sleep(self.first_token_delay)
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(self.token_delay)
+            yield self._response(token, False)
+        yield self._response("", True, len(tokens))
+
+    async def _astream(self, messages):
+        self.requests += 1
+        tokens = self._tokens()
+        await asyncio.sleep(self.first_token_delay)
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(self.token_delay)
+            yield self._response(token, False)
+        yield self._response("", True, len(tokens))
+
+BACKENDS = {"ollama": OllamaBackend, "fake": FakeBackend}
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """
+    The process wide backend chosen by LLM_BACKEND, created on first use.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if LLM_BACKEND not in BACKENDS:
+                    raise ValueError(f"Unknown LLM_BACKEND {LLM_BACKEND!r}, expected one of {', '.join(BACKENDS)}")
+                _backend = BACKENDS[LLM_BACKEND]()
+    return _backend
+
+def set_backend(backend):
+    """
+    Replace the process wide backend, e.g. with a FakeBackend in a benchmark.
+    """
+    global _backend
+    _backend = backend
@@ -0,0 +1,250 @@
+# general utilities
+import os, json, time, threading, dotenv
+from collections import Counter
+import numpy as np
+import pdf_helper   # for project pathing
+import artifact_manifest    # atomic writes of the id arrays
+import memmap_matrix        # the memory-mapped file the vectors live in
+import db_pool
+import query_cache
+
+dotenv.load_dotenv()
+
+# lives next to Embedding_cache/, a stale or deleted copy only costs one full load from the Embeddings table
+LOCAL_INDEX_DIRECTORY = os.path.join(pdf_helper.PROJECT_ROOT, "Local_index")
+LOCAL_INDEX_DTYPE = os.environ.get("LOCAL_INDEX_DTYPE", "float32")     # "float16" halves memory, scores are still float32
+LOCAL_INDEX_SYNC_INTERVAL = float(os.environ.get("LOCAL_INDEX_SYNC_INTERVAL", 30))  # seconds between checks for rows other processes changed
+LOCAL_INDEX_BLOCK_ROWS = int(os.environ.get("LOCAL_INDEX_BLOCK_ROWS", 65536))       # matrix rows scored at a time, bounds scratch memory
+COMPACT_FRACTION = 0.25     # rewrite the matrix without tombstoned rows once this share of it is dead
+LOAD_BATCH_SIZE = 5000      # rows fetched from the Embeddings table at a time
+
+_index = None
+_index_lock = threading.Lock()
+
+class LocalIndex(memmap_matrix.MemmapMatrix):
+    """
+    Exact nearest neighbor search over a local copy of the Embeddings table.
+
+    Vectors are L2 normalized and kept in a memory-mapped matrix of 'dtype' rows, with parallel embed_id and doc_id
+    arrays in a .npy file next to it. Chunk text stays in the table, search() only fetches it for the hits it returns.
+    sync() appends rows whose embed_id is past the highest one loaded, and tombstones rows that were deleted (a whole
+    document, or stale chunks of one). Tombstoned rows are skipped by search() until enough of them pile up to be
+    worth compacting away.
+    """
+
+    def __init__(self, directory=LOCAL_INDEX_DIRECTORY, dtype=LOCAL_INDEX_DTYPE):
+        self.dtype = np.dtype(dtype)
+        self.lock = threading.RLock()   # sync() may grow or compact the matrix under a running search
+        os.makedirs(directory, exist_ok=True)
+        self.data_path = os.path.join(directory, f"vectors.{self.dtype.name}.bin")
+        self.index_path = os.path.join(directory, f"index.{self.dtype.name}.json")
+        self.ids_path = os.path.join(directory, f"ids.{self.dtype.name}.npy")     # (rows, 2) of embed_id, doc_id
+
+        self.dim = None
+        self.capacity = 0
+        self.embed_ids = []     # row -> embed_id
+        self.doc_ids = []       # row -> source_doc_id
+        self.tombstones = set() # embed_ids of rows deleted from the table
+        self.loaded_through = 0 # highest embed_id ever loaded
+        self.data = None        # np.memmap of shape (capacity, dim), only the first len(embed_ids) rows are valid
+        self.alive = np.zeros(0, dtype=bool)
+        self.synced_at = None           # time.monotonic() of the last sync
+        self.synced_generation = None   # query_cache.corpus_generation at the last sync
+
+        if all(os.path.exists(path) for path in (self.index_path, self.data_path, self.ids_path)):
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            ids = np.load(self.ids_path)
+            # the ids are written before the index, after a crash in between the two disagree and the copy is rebuilt
+            if len(ids) == index.get("rows"):
+                self.dim = index["dim"]
+                self.capacity = index["capacity"]
+                self.embed_ids = ids[:, 0].tolist()
+                self.doc_ids = ids[:, 1].tolist()
+                self.tombstones = set(index["tombstones"])
+                self.loaded_through = index["loaded_through"]
+                if self.capacity > 0:
+                    self._map()
+                self._refresh_alive()
+
+    def __len__(self):
+        return len(self.embed_ids) - len(self.tombstones)
+
+    def maybe_sync(self):
+        # this process bumps the generation whenever it changes the table, other processes are caught on a timer
+        if (self.synced_generation != query_cache.corpus_generation or self.synced_at is None
+                or time.monotonic() - self.synced_at > LOCAL_INDEX_SYNC_INTERVAL):
+            self.sync()
+
+    def sync(self):
+        """
+        Bring the local copy in line with the Embeddings table. Returns (rows added, rows tombstoned).
+        """
+        with self.lock:
+            generation = query_cache.corpus_generation
+            with db_pool.connection() as conn, conn.cursor() as cur:
+                cur.execute("SELECT source_doc_id, count(*) FROM cs480_finalproject.embeddings GROUP BY source_doc_id;")
+                table_counts = dict(cur.fetchall())
+
+                # embed_id is a SERIAL, so anything inserted since the last sync is past the high water mark
+                added = self._load_rows(cur, "embed_id > %s", (self.loaded_through,))
+
+                # a document whose row count differs from ours lost rows (deleted document, stale chunks), or the
+                # table was rebuilt under our feet, compare its actual embed_ids against what we hold
+                held = Counter(doc_id for doc_id, alive in zip(self.doc_ids, self.alive) if alive)
+                changed = [doc_id for doc_id in held.keys() | table_counts.keys() if held[doc_id] != table_counts.get(doc_id, 0)]
+                current = set()
+                if changed:
+                    cur.execute("SELECT embed_id FROM cs480_finalproject.embeddings WHERE source_doc_id = ANY(%s);", (changed,))
+                    current = {row[0] for row in cur.fetchall()}
+                unknown = current - set(self.embed_ids)
+                if current & self.tombstones:
+                    # deleted ids came back, the table was truncated and its sequence restarted
+                    print("  Embeddings table was reset, reloading the local index from scratch.")
+                    self._reset()
+                    added = self._load_rows(cur, "embed_id > %s", (0,))
+                elif unknown:
+                    added += self._load_rows(cur, "embed_id = ANY(%s)", (sorted(unknown),))
+
+            changed = set(changed)
+            dead = [embed_id for embed_id, doc_id, alive in zip(self.embed_ids, self.doc_ids, self.alive)
+                    if alive and doc_id in changed and embed_id not in current]
+            self.tombstones.update(dead)
+
+            if added or dead:
+                self._refresh_alive()
+                if len(self.tombstones) > COMPACT_FRACTION * len(self.embed_ids):
+                    self._compact()
+                self.save()
+            self.synced_at = time.monotonic()
+            self.synced_generation = generation
+            return added, len(dead)
+
+    def search(self, q_embs, k, doc_ids=None):
+        """
+        Exact top k by cosine distance for one query vector or a matrix of them, only over rows of 'doc_ids' if given.
+
+        Returns one list of (embed_id, chunk, distance, source_doc_id) per query, nearest first, the same rows SEARCH_QUERY returns.
+        A hit whose row was deleted from the table since the last sync is left out.
+        """
+        q = np.atleast_2d(np.asarray(q_embs, dtype=np.float32))
+        q = q / np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+
+        with self.lock:
+            rows = len(self.embed_ids)
+            allowed = self.alive
+            if doc_ids is not None:
+                allowed = allowed & np.isin(np.fromiter(self.doc_ids, dtype=np.int64, count=rows), list(doc_ids))
+            best_scores = np.empty((len(q), 0), dtype=np.float32)
+            best_rows = np.empty((len(q), 0), dtype=np.int64)
+            for start in range(0, rows, LOCAL_INDEX_BLOCK_ROWS):
+                end = min(start + LOCAL_INDEX_BLOCK_ROWS, rows)
+                scores = q @ np.asarray(self.data[start:end], dtype=np.float32).T
+                scores[:, ~allowed[start:end]] = -np.inf
+                # keep only this block's top k per query, then merge with the best seen so far
+                kk = min(k, end - start)
+                top = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+                best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+                best_rows = np.concatenate([best_rows, top + start], axis=1)
+                if best_scores.shape[1] > k:
+                    keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                    best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                    best_rows = np.take_along_axis(best_rows, keep, axis=1)
+
+            order = np.argsort(-best_scores, axis=1, kind="stable")
+            results = []
+            for scores, rows_ in zip(np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)):
+                results.append([(self.embed_ids[row], float(1.0 - score), self.doc_ids[row])
+                                for score, row in zip(scores, rows_) if score != -np.inf])
+
+        chunks = fetch_chunks({embed_id for hits in results for embed_id, _, _ in hits})
+        return [[(embed_id, chunks[embed_id], distance, doc_id) for embed_id, distance, doc_id in hits if embed_id in chunks]
+                for hits in results]
+
+    def save(self):
+        """
+        Flush the vectors and atomically rewrite the ids and the index. Rows written past what the index lists are
+        ignored on load, so a crash in between only means those rows get fetched again.
+        """
+        ids = np.column_stack([np.asarray(self.embed_ids, dtype=np.int64), np.asarray(self.doc_ids, dtype=np.int64)])
+        with artifact_manifest.atomic_write(self.ids_path, "wb") as f:
+            np.save(f, ids)
+        self._write_index({
+            "dtype": self.dtype.name,
+            "dim": self.dim,
+            "capacity": self.capacity,
+            "rows": len(ids),
+            "tombstones": sorted(self.tombstones),
+            "loaded_through": self.loaded_through,
+        })
+
+    def _refresh_alive(self):
+        self.alive = np.fromiter((embed_id not in self.tombstones for embed_id in self.embed_ids), dtype=bool,
+                                 count=len(self.embed_ids))
+
+    def _reset(self):
+        self.embed_ids, self.doc_ids = [], []
+        self.tombstones = set()
+        self.loaded_through = 0
+        self.alive = np.zeros(0, dtype=bool)
+
+    # Append the rows matching 'where', LOAD_BATCH_SIZE rows at a time
+    def _load_rows(self, cur, where, params):
+        cur.execute(f"""SELECT embed_id, source_doc_id, embedding FROM cs480_finalproject.embeddings
+            WHERE {where} ORDER BY embed_id;""", params)
+        added = 0
+        while rows := cur.fetchmany(LOAD_BATCH_SIZE):
+            vectors = np.vstack([np.asarray(row[2], dtype=np.float32) for row in rows])
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+            start = len(self.embed_ids)
+            if start + len(rows) > self.capacity:
+                self._grow(start + len(rows))
+            self.data[start:start + len(rows)] = vectors
+            self.embed_ids.extend(row[0] for row in rows)
+            self.doc_ids.extend(row[1] for row in rows)
+            self.loaded_through = max(self.loaded_through, rows[-1][0])
+            added += len(rows)
+        if added:
+            self.alive = np.concatenate([self.alive, np.ones(len(self.embed_ids) - len(self.alive), dtype=bool)])
+        return added
+
+    # Drop tombstoned rows, moving live rows down in place. Rows only ever move towards the front, so copying in
+    # order never overwrites a row that hasn't been moved yet.
+    def _compact(self):
+        live = np.flatnonzero(self.alive)
+        for start in range(0, len(live), LOCAL_INDEX_BLOCK_ROWS):
+            block = live[start:start + LOCAL_INDEX_BLOCK_ROWS]
+            self.data[start:start + len(block)] = self.data[block]
+        self.embed_ids = [self.embed_ids[row] for row in live]
+        self.doc_ids = [self.doc_ids[row] for row in live]
+        self.tombstones = set()
+        self.alive = np.ones(len(self.embed_ids), dtype=bool)
+
+# Chunk text of the rows 'embed_ids', by embed_id. Ids deleted from the table since are missing.
+def fetch_chunks(embed_ids):
+    if not embed_ids:
+        return {}
+    with db_pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT embed_id, chunk FROM cs480_finalproject.embeddings WHERE embed_id = ANY(%s);", (sorted(embed_ids),))
+        return dict(cur.fetchall())
+
+def get_index():
+    """
+    Returns the process wide local index, opening it on first use.
+    """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = LocalIndex()
+    return _index
+
+def search(q_embs, k, doc_ids=None):
+    """
+    Top k rows of the Embeddings table for each query vector, syncing with the table first if it may have changed.
+    """
+    index = get_index()
+    index.maybe_sync()
+    return index.search(q_embs, k, doc_ids)
@@ -1,7 +1,11 @@
-import sys
+import os, sys, time, datetime
+_import_start = time.perf_counter()  # for the start up report, see main()
 import database_helper  # handles database operations
 import pdf_helper
 import answer_queries
+import bulk_ingest
+import metrics
+answer_queries.startup_timings["imports"] = time.perf_counter() - _import_start
 
 ROLE_MAPPING = {"1": "Admin", "2": "Curator", "3": "EndUser"}
 
@@ -104,7 +108,8 @@ def create_doc(curator_id):
     while new_path == "":
         new_path = input("  Provide path to pdf relative to project root: ").strip()    # path up to and including the .pdf file extension
 
-    is_new_file = pdf_helper.extract_pdf(new_path)    # makes a .txt file in the TXT_OUTPUT_DIRECTORY, if not already existing
+    # makes a .txt file in the TXT_OUTPUT_DIRECTORY, if not already existing. Large pdfs are extracted in parallel page ranges
+    is_new_file = pdf_helper.extract_pdf(new_path, workers=pdf_helper.THREAD_COUNT)
 
     if is_new_file is False:    # document already existed
         print("Document already exists in system...")
@@ -127,6 +132,21 @@ def create_doc(curator_id):
     if ret is not None:
         answer_queries.add_document_to_index(new_path)
     return ret
+
+# many documents at once, from a directory of pdfs or a CSV/JSON manifest, without a prompt per document
+def bulk_create_docs(curator_id):
+    print("Adding Documents in bulk...")
+
+    path = ""
+    while path == "":
+        path = input("  Provide a directory of pdfs, or a .csv/.json manifest (path, title, type), relative to project root: ").strip()
+    doc_type = input(f"  Enter the document type for entries without one [{bulk_ingest.DEFAULT_DOC_TYPE}]: ").strip()
+
+    try:
+        return bulk_ingest.ingest(curator_id, path, doc_type or bulk_ingest.DEFAULT_DOC_TYPE)
+    except (OSError, ValueError) as e:
+        print("Could not read the documents to add:", e)
+        return None
     
 def fetch_docs(curator_id):
     print("  1. Fetch Your Documents")
@@ -192,6 +212,7 @@ def print_curator_menu():
     print("2. Fetch Document List")
     print("3. Delete Document")
     print("4. Edit Document")
+    print("5. Bulk Add Documents")
     print("X. Exit")
     print("=================")
 
@@ -273,7 +294,7 @@ def curator_loop(curator_id):
     choice = None
     while choice != "X" and choice != "":
         print_curator_menu()
-        choice = input("Select an option (1-4, X to exit): ").strip()
+        choice = input("Select an option (1-5, X to exit): ").strip()
 
         if choice == "1":
             create_doc(curator_id)
@@ -286,15 +307,47 @@ def curator_loop(curator_id):
             delete_doc(curator_id)
         elif choice == "4":
             update_doc(curator_id)
+        elif choice == "5":
+            bulk_create_docs(curator_id)
         elif choice == "X" or choice == "":
             print("Returning to role selection...")
         else:
             print("Invalid choice. Please try again.")
 
+# Ask which documents to search, returns an answer_queries.SearchFilter or None to search everything
+def prompt_search_filters():
+    restrict = input("Restrict answers to some documents? [y/N]: ").strip().lower()
+    if restrict not in ("y", "yes"):
+        return None
+    print("Leave any field blank to skip it.\n")
+
+    doc_ids = input("Document IDs, comma separated (or press Enter to skip): ").strip()
+    doc_type = input("Document type (or press Enter to skip): ").strip()
+    added_by = input("Added by curator ID (or press Enter to skip): ").strip()
+    added_after = input("Added on or after, YYYY-MM-DD (or press Enter to skip): ").strip()
+    added_before = input("Added before, YYYY-MM-DD (or press Enter to skip): ").strip()
+
+    try:
+        filters = answer_queries.SearchFilter(
+            doc_ids=[int(doc_id) for doc_id in doc_ids.split(",") if doc_id.strip()] or None,
+            doc_type=doc_type or None,
+            added_by=int(added_by) if added_by else None,
+            added_after=datetime.datetime.fromisoformat(added_after) if added_after else None,
+            added_before=datetime.datetime.fromisoformat(added_before) if added_before else None)
+    except ValueError as e:
+        print(f"Invalid filter ({e}), searching every document.")
+        return None
+    return filters if any(field is not None for field in filters) else None
+
 # can submit queries
 def enduser_loop(enduser_id):
     print("\n=== USER Menu ===")
-    top_k = answer_queries.queryDB(enduser_id)
+    filters = prompt_search_filters()
+    if os.environ.get("ASYNC_QUERY", "0") == "1":
+        import async_query  # only pulls in asyncpg when asked for
+        async_query.queryDB(enduser_id, filters)    # streams the answer as it is generated
+    else:
+        top_k = answer_queries.queryDB(enduser_id, filters)
 
 
 def main():
@@ -305,6 +358,15 @@ def main():
     Admins can do CRUD on Users table. Curators can do CRUD on Documents table.
     EndUsers can make queries.
     """
+    # the embedding model is only needed by EndUsers, optionally start loading it while the user logs in
+    # the report waits for what it times: the warm-up when there is one, the first query otherwise
+    report = os.environ.get("STARTUP_REPORT", "0") == "1"
+    if os.environ.get("WARMUP_MODEL", "0") == "1":
+        answer_queries.warm_up(background=True, on_done=answer_queries.report_startup if report else None)
+    elif report:
+        answer_queries.report_startup_after_first_query()
+    metrics.serve()     # Prometheus endpoint, only when METRICS_ENABLED=1 and METRICS_PORT are set
+
     # Step 1. Ask user for role
     # Step 2. Authenticate user credentials
     while True:
@@ -0,0 +1,34 @@
+# general utilities
+import json
+import numpy as np
+import artifact_manifest    # atomic writes of the index
+
+class MemmapMatrix:
+    """
+    Vectors kept in a memory-mapped file of 'capacity' rows of 'dim' 'dtype' values at 'data_path', alongside a JSON
+    index at 'index_path' that says what the rows hold. Subclasses set those attributes and 'data' (the np.memmap,
+    None until the first row is stored).
+    """
+
+    def _map(self):
+        self.data = np.memmap(self.data_path, dtype=self.dtype, mode="r+", shape=(self.capacity, self.dim))
+
+    # Resize the backing file to hold at least 'needed' rows (never more than 'limit'), doubling to amortize repeated growth
+    def _grow(self, needed, limit=None):
+        new_capacity = max(needed, self.capacity * 2, 1024)
+        if limit is not None:
+            new_capacity = min(new_capacity, limit)
+        if self.data is not None:
+            self.data.flush()
+            del self.data
+        with open(self.data_path, "ab") as f:
+            f.truncate(new_capacity * self.dim * self.dtype.itemsize)
+        self.capacity = new_capacity
+        self._map()
+
+    # Flush the vectors, then atomically rewrite the index with 'index'
+    def _write_index(self, index):
+        if self.data is not None:
+            self.data.flush()
+        with artifact_manifest.atomic_write(self.index_path) as f:
+            json.dump(index, f)
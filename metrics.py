@@ -0,0 +1,273 @@
+# general utilities
+import os, sys, json, time, uuid, bisect, threading, contextvars, dotenv
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import artifact_manifest    # atomic_write, so a scraper never reads half a written file
+
+dotenv.load_dotenv()
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0") == "1"   # off by default, spans are then a shared no-op
+METRICS_LOG = os.environ.get("METRICS_LOG")                       # JSONL file every finished span is appended to, "-" for stderr
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))             # serve Prometheus text at http://127.0.0.1:<port>/metrics, see serve()
+
+# seconds, from a cached lookup up to a slow LLM answer or an index build
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+
+class Histogram:
+    """
+    Cumulative bucket counts, sum and count of the observed values, the same shape as a Prometheus histogram.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimate the q quantile by interpolating inside the bucket it falls in, like PromQL's histogram_quantile.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]     # past the last bound, the best we can say
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+# metric name -> {stage: Histogram or counter value}
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+_log_file = None
+_current = contextvars.ContextVar("metrics_span", default=None)    # innermost open Span, for trace ids and parents
+
+STAGE_SECONDS = "rag_stage_seconds"
+STAGE_ITEMS = "rag_stage_items_total"
+EVENTS = "rag_events_total"
+HELP = {
+    STAGE_SECONDS: "Wall time of one pipeline stage.",
+    STAGE_ITEMS: "Items (queries, chunks, rows, tokens) processed by a stage.",
+    EVENTS: "Occurrences of an event, such as a cache hit.",
+    "rag_llm_tokens_per_second": "LLM generation speed of one answer.",
+}
+
+def _observe(metric, stage, value, buckets):
+    with _lock:
+        by_stage = _histograms.setdefault(metric, {})
+        histogram = by_stage.get(stage)
+        if histogram is None:
+            histogram = by_stage[stage] = Histogram(buckets)
+        histogram.observe(value)
+
+def _add(metric, stage, amount):
+    with _lock:
+        by_stage = _counters.setdefault(metric, {})
+        by_stage[stage] = by_stage.get(stage, 0) + amount
+
+def _log(event):
+    global _log_file
+    line = json.dumps(event, default=str) + "\n"
+    with _lock:
+        if _log_file is None:
+            _log_file = sys.stderr if METRICS_LOG == "-" else open(METRICS_LOG, "a", encoding="utf-8", buffering=1)
+        _log_file.write(line)
+
+def record(stage, seconds, items=0, trace=None, parent=None, **fields):
+    """
+    Record 'seconds' spent in 'stage' (and 'items' processed by it) for a timing measured elsewhere. Inside a span
+    it joins that span's trace.
+
+    Extra keyword arguments only go to the JSON log.
+    """
+    if not METRICS_ENABLED:
+        return
+    if trace is None and (outer := _current.get()) is not None:
+        trace, parent = outer.trace, outer.stage
+    _observe(STAGE_SECONDS, stage, seconds, DURATION_BUCKETS)
+    if items:
+        _add(STAGE_ITEMS, stage, items)
+    if METRICS_LOG:
+        _log({"ts": time.time(), "stage": stage, "seconds": seconds, "items": items, "trace": trace, "parent": parent, **fields})
+
+def observe(metric, stage, value, buckets=RATE_BUCKETS):
+    """
+    Add 'value' to histogram 'metric' (say, rag_llm_tokens_per_second) under 'stage'.
+    """
+    if METRICS_ENABLED:
+        _observe(metric, stage, value, buckets)
+
+def count(event, amount=1):
+    if METRICS_ENABLED:
+        _add(EVENTS, event, amount)
+
+class Span:
+    """
+    Times a with block and records it under 'stage' when the block exits. Spans opened inside it share its trace id
+    in the JSON log, so every step of one answer can be pulled out together.
+    """
+    __slots__ = ("stage", "fields", "items", "trace", "parent", "start", "_token")
+
+    def __init__(self, stage, fields):
+        self.stage = stage
+        self.fields = fields
+        self.items = 0
+
+    def __enter__(self):
+        outer = _current.get()
+        self.trace = outer.trace if outer is not None else uuid.uuid4().hex[:16]
+        self.parent = outer.stage if outer is not None else None
+        self._token = _current.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.fields["error"] = exc_type.__name__
+        record(self.stage, elapsed, self.items, self.trace, self.parent, **self.fields)
+        return False
+
+    def add(self, items=0, **fields):
+        """
+        Count 'items' towards this span and attach 'fields' to its log line.
+        """
+        self.items += items
+        self.fields.update(fields)
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def add(self, items=0, **fields):
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+def span(stage, **fields):
+    """
+    with metrics.span("query.search", backend="postgres") as s: ... s.add(items=len(rows))
+
+    Returns a shared do-nothing span when METRICS_ENABLED is off, so instrumented code pays one function call.
+    """
+    if not METRICS_ENABLED:
+        return _NOOP_SPAN
+    return Span(stage, fields)
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+def snapshot():
+    """
+    Every metric as plain data, for the JSON export.
+    """
+    with _lock:
+        histograms = {metric: {stage: {"count": h.count, "sum": h.sum, "p50": h.quantile(0.5), "p95": h.quantile(0.95),
+                                       "p99": h.quantile(0.99), "buckets": dict(zip(map(str, h.buckets), h.counts))}
+                               for stage, h in by_stage.items()}
+                      for metric, by_stage in _histograms.items()}
+        counters = {metric: dict(by_stage) for metric, by_stage in _counters.items()}
+    return {"histograms": histograms, "counters": counters}
+
+def prometheus_text():
+    """
+    Every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    with _lock:
+        for metric, by_stage in sorted(_histograms.items()):
+            lines += [f"# HELP {metric} {HELP.get(metric, metric)}", f"# TYPE {metric} histogram"]
+            for stage, h in sorted(by_stage.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(list(h.buckets) + ["+Inf"], h.counts):
+                    cumulative += bucket_count
+                    lines.append(f'{metric}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{stage="{stage}"}} {h.sum}')
+                lines.append(f'{metric}_count{{stage="{stage}"}} {h.count}')
+        for metric, by_stage in sorted(_counters.items()):
+            label = "event" if metric == EVENTS else "stage"
+            lines += [f"# HELP {metric} {HELP.get(metric, metric)}", f"# TYPE {metric} counter"]
+            for stage, value in sorted(by_stage.items()):
+                lines.append(f'{metric}{{{label}="{stage}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+def write(path):
+    """
+    Write every metric to 'path', as JSON if it ends in .json and Prometheus text otherwise (which node_exporter's
+    textfile collector can pick up).
+    """
+    with artifact_manifest.atomic_write(path) as f:
+        if path.endswith(".json"):
+            json.dump(snapshot(), f, indent=2)
+        else:
+            f.write(prometheus_text())
+
+def report():
+    """
+    One line per stage with its count, p50, p95 and p99, for printing at the end of a batch job.
+    """
+    data = snapshot()
+    lines = []
+    for metric, by_stage in data["histograms"].items():
+        unit = "ms" if metric == STAGE_SECONDS else ""
+        scale = 1000 if metric == STAGE_SECONDS else 1
+        for stage, h in sorted(by_stage.items()):
+            items = data["counters"].get(STAGE_ITEMS, {}).get(stage) if metric == STAGE_SECONDS else None
+            name = stage if metric == STAGE_SECONDS else f"{stage} {metric.removeprefix('rag_')}"
+            lines.append(f"    {name:<24} n={h['count']:<6} p50 {h['p50'] * scale:9.2f}{unit}  p95 {h['p95'] * scale:9.2f}{unit}"
+                         f"  p99 {h['p99'] * scale:9.2f}{unit}" + (f"  items {items}" if items else ""))
+    for event, value in sorted(data["counters"].get(EVENTS, {}).items()):
+        lines.append(f"    {event:<24} {value}")
+    return "\n".join(lines)
+
+_server = None
+
+def serve(port=None):
+    """
+    Serve prometheus_text() at /metrics on a daemon thread. Does nothing unless metrics are enabled and a port is
+    given or METRICS_PORT is set. Returns the server, or None.
+    """
+    global _server
+    port = port or METRICS_PORT
+    if not METRICS_ENABLED or not port or _server is not None:
+        return _server
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    _server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    _server.daemon_threads = True
+    threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Serving metrics at http://127.0.0.1:{port}/metrics")
+    return _server
@@ -1,9 +1,15 @@
 # general utilities
-import re, time, os, glob, dotenv
+import re, time, os, glob, math, dotenv, collections, itertools
 dotenv.load_dotenv()
 
 # extracting text from pdf
-import pdfminer.high_level, pdfminer.layout, multiprocessing
+import pdfminer, pdfminer.high_level, pdfminer.layout, pdfminer.pdfparser, pdfminer.pdfdocument, pdfminer.pdfpage, multiprocessing
+
+# records what every extracted and chunked file was built from, so only out of date ones get rebuilt
+import artifact_manifest
+
+# per-stage timings, a no-op unless METRICS_ENABLED
+import metrics
 
 # to suppress color gradient warnings from pdfminer.six since we only care about reading text
 import logging
@@ -14,10 +20,28 @@ PROJECT_ROOT = os.path.abspath(os.path.dirname(__file__))           # Repo root
 CORPUS_PATH = os.path.join(PROJECT_ROOT, "Corpus")                  # Input directory
 CHUNKS_OUTPUT_DIRECTORY = os.path.join(PROJECT_ROOT, "Chunked_txt") # Output directory for .txt files
 TXT_OUTPUT_DIRECTORY = os.path.join(PROJECT_ROOT, "Processed_pdf")  # Output directory for .txt files
+MANIFEST_PATH = os.path.join(PROJECT_ROOT, "artifact_manifest.json") # What every file in the two output directories was built from
 
 CHUNK_WORD_COUNT = int(os.environ.get("CHUNK_WORD_COUNT", 1000))
 OVERLAP = int(os.environ.get("OVERLAP", 200))
-__THREAD_COUNT = int(os.environ.get("THREAD_COUNT", 4))
+THREAD_COUNT = int(os.environ.get("THREAD_COUNT", 4))
+STREAM_BLOCK_SIZE = int(os.environ.get("STREAM_BLOCK_SIZE", 1 << 16))  # characters read at a time when streaming text
+SPLIT_MIN_PAGES = int(os.environ.get("SPLIT_MIN_PAGES", 40))            # PDFs with fewer pages are always extracted whole
+MIN_PAGES_PER_PART = int(os.environ.get("MIN_PAGES_PER_PART", 10))      # never split a PDF in to ranges shorter than this
+
+# "words" cuts fixed CHUNK_WORD_COUNT word windows, "tokens" fills windows up to what the embedding model actually reads
+CHUNK_MODE = os.environ.get("CHUNK_MODE", "words")
+EMBED_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+CHUNK_MAX_TOKENS = int(os.environ.get("CHUNK_MAX_TOKENS", 256))        # all-MiniLM-L6-v2 truncates input past 256 word pieces
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", 32))
+PARAGRAPH_BREAK_FILL = 0.75     # in token mode, start a new chunk at a paragraph once the current one is this full
+
+# an extracted text file is rebuilt whenever any of these change, bump "laparams" if the LAParams used below change
+EXTRACTION_PARAMS = {"extractor": f"pdfminer.six {pdfminer.__version__}", "laparams": "default"}
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_tokenizer = None
+_manifest = None
 
 # Use regex to find repetitive whitespace and replace it with a singular space.
 def normalize(s: str) -> str:
@@ -38,31 +62,362 @@ def chunk_text(text: str, max_words: int, overlap: int):
         i += max_words - overlap # slides window
     return chunks
 
-# helper function for multiprocessor pool
-# returns True if it actually had to extract text, False if the txt file already existed
-def extract_pdf(pdf_path):
-    output_path = TXT_OUTPUT_DIRECTORY + "/" + os.path.basename(pdf_path).rstrip(".pdf") + ".txt"
-    
-    # Avoid extracting text if it already exists
-    if not os.path.exists(output_path):
+# Yields the words of a text file without reading it all in to memory, the same words as normalize(text).split().
+# A block that doesn't end on whitespace may have cut its last word in half, so that word is carried to the next block.
+def iter_words(txt_path, block_size=STREAM_BLOCK_SIZE):
+    carry = ""
+    with open(txt_path, "r", encoding="utf-8") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            words = (carry + block).split()
+            carry = words.pop() if words and not block[-1].isspace() else ""
+            yield from words
+    if carry:
+        yield carry
+
+# Streaming version of chunk_text, yields exactly the same chunks from an iterable of words.
+# Only the current window is kept in memory, as a ring buffer that slides forward by max_words - overlap.
+def stream_chunks(words, max_words, overlap):
+    step = max_words - overlap
+    if step <= 0:
+        raise ValueError(f"OVERLAP ({overlap}) must be smaller than CHUNK_WORD_COUNT ({max_words})")
+
+    window = collections.deque()
+    for word in words:
+        window.append(word)
+        if len(window) == max_words:
+            yield " ".join(window)
+            for _ in range(step):
+                window.popleft()
+
+    # like chunk_text, keep emitting the shrinking tail while the window still starts before the last word
+    while window:
+        yield " ".join(window)
+        for _ in range(min(step, len(window))):
+            window.popleft()
+
+# Chunks of a processed text file, with peak memory bounded by the chunk size rather than the file size
+def iter_chunks(txt_path):
+    if CHUNK_MODE == "tokens":
+        return stream_token_chunks(iter_paragraphs(txt_path))
+    return stream_chunks(iter_words(txt_path), CHUNK_WORD_COUNT, OVERLAP)
+
+# Describes how chunks are cut, anything derived from chunks (like their content hashes) should change along with it
+def chunking_signature():
+    if CHUNK_MODE == "tokens":
+        return f"tokens\0{CHUNK_MAX_TOKENS}\0{CHUNK_OVERLAP_TOKENS}"
+    return f"{CHUNK_WORD_COUNT}\0{OVERLAP}"
+
+# The parameters chunk files are cut with, a chunk file is rebuilt whenever these change
+def chunking_params():
+    if CHUNK_MODE == "tokens":
+        return {"mode": "tokens", "model": EMBED_MODEL_NAME, "max_tokens": CHUNK_MAX_TOKENS,
+                "overlap_tokens": CHUNK_OVERLAP_TOKENS, "paragraph_break_fill": PARAGRAPH_BREAK_FILL}
+    return {"mode": "words", "chunk_word_count": CHUNK_WORD_COUNT, "overlap": OVERLAP}
+
+# The embedding model's own tokenizer, loaded on first use since transformers is a heavy import
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        from transformers import AutoTokenizer
+        _tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL_NAME)
+    return _tokenizer
+
+# Yields the paragraphs (runs of lines between blank lines) of a text file with their whitespace normalized,
+# reading one line at a time. Must run on the extracted text, normalize() erases paragraph breaks.
+def iter_paragraphs(txt_path):
+    lines = []
+    with open(txt_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                lines.append(line)
+            elif lines:
+                yield normalize(" ".join(lines))
+                lines = []
+    if lines:
+        yield normalize(" ".join(lines))
+
+# Splits a paragraph in to (text, token count) units no longer than 'budget' tokens, preferring sentence ends.
+# WordPiece splits on whitespace before anything else, so the token count of joined units is the sum of their counts
+# and every sentence only has to be tokenized once.
+def _token_units(paragraph, tokenizer, budget):
+    sentences = SENTENCE_END.split(paragraph)
+    encodings = tokenizer(sentences, add_special_tokens=False, return_offsets_mapping=True)
+    units = []
+    for sentence, ids, offsets in zip(sentences, encodings["input_ids"], encodings["offset_mapping"]):
+        if len(ids) <= budget:
+            units.append((sentence, len(ids)))
+            continue
+        # a single sentence (or a table flattened in to one) is over budget, cut it at word starts instead
+        start = 0
+        while start < len(ids):
+            end = min(start + budget, len(ids))
+            while end < len(ids) and end > start + 1 and not sentence[offsets[end][0] - 1].isspace():
+                end -= 1    # don't cut through the middle of a word
+            piece = sentence[offsets[start][0]:offsets[end - 1][1]]
+            units.append((piece, end - start))
+            start = end
+    return units
+
+def stream_token_chunks(paragraphs, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """
+    Pack paragraphs in to chunks that fit the embedding model's max sequence length.
+
+    Chunks end on sentence boundaries, and on paragraph boundaries once they are PARAGRAPH_BREAK_FILL full.
+    Consecutive chunks share up to 'overlap_tokens' tokens worth of whole sentences.
+    """
+    tokenizer = get_tokenizer()
+    budget = max_tokens - 2     # [CLS] and [SEP] are added to every input
+    window = collections.deque()    # (text, token count) units of the chunk being built
+    total = 0
+    fresh = False   # does the window hold anything not already emitted as part of the previous chunk
+
+    def flush():
+        nonlocal total, fresh
+        chunk = " ".join(text for text, _ in window)
+        # keep the trailing sentences that fit in the overlap as the start of the next chunk
+        carried, carried_total = collections.deque(), 0
+        while window and carried_total + window[-1][1] <= overlap_tokens:
+            unit = window.pop()
+            carried.appendleft(unit)
+            carried_total += unit[1]
+        window.clear()
+        window.extend(carried)
+        total, fresh = carried_total, False
+        return chunk
+
+    for paragraph in paragraphs:
+        units = _token_units(paragraph, tokenizer, budget)
+        paragraph_total = sum(n for _, n in units)
+        if fresh and total + paragraph_total > budget and total >= budget * PARAGRAPH_BREAK_FILL:
+            yield flush()
+
+        for unit in units:
+            if fresh and total + unit[1] > budget:
+                yield flush()
+            # drop carried overlap from the front until the new unit fits
+            while window and total + unit[1] > budget:
+                total -= window.popleft()[1]
+            window.append(unit)
+            total += unit[1]
+            fresh = True
+
+    if fresh:
+        yield flush()
+
+# Groups an iterable in to lists of at most n items
+def batched(iterable, n):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
+
+# Every pdf in 'directory', whatever the case of its extension
+def corpus_pdfs(directory=CORPUS_PATH):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(".pdf"))
+
+# Where the extracted text of a pdf goes
+def extracted_txt_path(pdf_path):
+    return TXT_OUTPUT_DIRECTORY + "/" + os.path.splitext(os.path.basename(pdf_path))[0] + ".txt"
+
+# Where the chunks of an extracted text file go
+def chunked_txt_path(txt_path):
+    return CHUNKS_OUTPUT_DIRECTORY + "/" + os.path.basename(txt_path)
+
+def get_manifest():
+    """
+    Returns the artifact manifest for Processed_pdf/ and Chunked_txt/, loading it on first use.
+    """
+    global _manifest
+    if _manifest is None:
+        _manifest = artifact_manifest.ArtifactManifest(MANIFEST_PATH, PROJECT_ROOT)
+    return _manifest
+
+# Is the extracted text of 'pdf_path' up to date with the pdf and EXTRACTION_PARAMS
+def extraction_is_current(pdf_path):
+    output_path = extracted_txt_path(pdf_path)
+    manifest = get_manifest()
+    if os.path.exists(output_path) and not manifest.has_record(output_path):
+        # text extracted before there was a manifest, re-extracting the whole corpus would take minutes, so trust it
+        manifest.record(output_path, pdf_path, EXTRACTION_PARAMS)
+        return True
+    return manifest.is_current(output_path, pdf_path, EXTRACTION_PARAMS)
+
+# Is the chunk file of 'txt_path' up to date with the text file and chunking_params().
+# Chunk files from before there was a manifest are rebuilt, chunking is cheap and they may be from other settings.
+def chunks_are_current(txt_path):
+    return get_manifest().is_current(chunked_txt_path(txt_path), txt_path, chunking_params())
+
+# Chunk 'txt_path' in to its chunk file, one chunk per line, and record it in the manifest
+def write_chunks(txt_path):
+    output_path = chunked_txt_path(txt_path)
+    # streams the text file, whitespace is collapsed as it is split in to words
+    with artifact_manifest.atomic_write(output_path) as f:
+        for chunk in iter_chunks(txt_path):
+            f.write(chunk + "\n")
+    get_manifest().record(output_path, txt_path, chunking_params())
+
+# One unit of extraction work: pages [first_page, last_page) of a pdf, or the whole pdf when parts == 1
+ExtractTask = collections.namedtuple("ExtractTask", ["pdf_path", "first_page", "last_page", "part", "parts"])
+
+def pdf_page_count(pdf_path):
+    """
+    Read the page count from the pdf's page tree without laying out any pages. Returns None if it can't be read.
+    """
+    try:
+        with open(pdf_path, "rb") as f:
+            document = pdfminer.pdfdocument.PDFDocument(pdfminer.pdfparser.PDFParser(f))
+            return sum(1 for _ in pdfminer.pdfpage.PDFPage.create_pages(document))
+    except Exception:
+        return None
+
+def plan_extraction(pdf_files, workers):
+    """
+    Turn a list of pdfs in to ExtractTasks, splitting big pdfs in to page ranges so one file can't pin a single
+    worker while the rest sit idle.
+
+    Each file is cut in to enough parts that no part is much bigger (by bytes) than half of one worker's fair share
+    of the whole batch, as long as every part keeps at least MIN_PAGES_PER_PART pages. Tasks come back biggest first.
+    """
+    sizes = {pdf_path: os.path.getsize(pdf_path) for pdf_path in pdf_files}
+    target = max(sum(sizes.values()) / max(workers * 2, 1), 1)    # two waves of tasks per worker balance well
+
+    weighted = []   # (estimated bytes, task)
+    for pdf_path in pdf_files:
+        size = sizes[pdf_path]
+        parts = 1
+        if workers > 1 and size > target:
+            pages = pdf_page_count(pdf_path)
+            if pages is not None and pages >= SPLIT_MIN_PAGES:
+                parts = max(1, min(math.ceil(size / target), workers, pages // MIN_PAGES_PER_PART))
+        if parts == 1:
+            weighted.append((size, ExtractTask(pdf_path, None, None, 0, 1)))
+            continue
+        bounds = [round(i * pages / parts) for i in range(parts + 1)]
+        for part in range(parts):
+            weighted.append((size / parts, ExtractTask(pdf_path, bounds[part], bounds[part + 1], part, parts)))
+
+    weighted.sort(key=lambda pair: pair[0], reverse=True)  # longest schedule first, greedy approximation
+    return [task for _, task in weighted]
+
+def _part_path(output_path, part):
+    return f"{output_path}.part{part}"
+
+# helper function for multiprocessor pool, extracts one ExtractTask
+# returns the task and whether it succeeded
+# runs in a pool worker, so the parent process records finished pdfs in the manifest
+def extract_task(task):
+    if task.parts == 1:
+        return task, _extract_whole(task.pdf_path)
+
+    part_path = _part_path(extracted_txt_path(task.pdf_path), task.part)
+    try:
+        # pdfminer ends every page with a form feed, so page ranges concatenate to exactly the whole document's text
+        with open(task.pdf_path, "rb") as infile, open(part_path, "w", encoding="utf-8") as outfile:
+            pdfminer.high_level.extract_text_to_fp(infile, outfile, laparams=pdfminer.layout.LAParams(), output_type="text",
+                                                   codec="utf-8", page_numbers=set(range(task.first_page, task.last_page)))
+        return task, True
+    except Exception as e:
+        print(f"Failed to process pages {task.first_page}-{task.last_page} of {task.pdf_path}: {e}")
+        return task, False
+
+def stitch_parts(pdf_path, parts):
+    """
+    Concatenate the page range outputs of a split pdf, in page order, in to its final text file.
+    """
+    output_path = extracted_txt_path(pdf_path)
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as outfile:
+        for part in range(parts):
+            with open(_part_path(output_path, part), "r", encoding="utf-8") as infile:
+                for block in iter(lambda: infile.read(STREAM_BLOCK_SIZE), ""):
+                    outfile.write(block)
+    os.replace(tmp_path, output_path)
+    for part in range(parts):
+        os.remove(_part_path(output_path, part))
+
+def remove_parts(pdf_path):
+    """
+    Delete the page range outputs left behind by a split extraction of 'pdf_path' that failed or was interrupted.
+    """
+    for part_path in glob.glob(glob.escape(extracted_txt_path(pdf_path)) + ".part*"):
         try:
-            # file size of "pdf_path" can be potentially huge, so stream data in to txt file
-            with open(pdf_path, "rb") as infile, open(output_path, "x", encoding="utf-8") as outfile:
-                pdfminer.high_level.extract_text_to_fp(infile, outfile, laparams=pdfminer.layout.LAParams(), output_type="text", codec="utf-8")
-            return True
-        except Exception as e:
-            print(f"Failed to process {pdf_path}: {e}")
-            return False
-    return False
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+
+def run_extraction(tasks, pool):
+    """
+    Run ExtractTasks on 'pool', yielding each pdf path as soon as its text is complete (all of its parts are done and
+    stitched together), along with whether extraction succeeded. Every completed pdf is recorded in the manifest
+    straight away, so an interrupted run picks up where it left off.
+    """
+    done_parts = collections.defaultdict(list)
+    try:
+        for task, ok in pool.imap_unordered(extract_task, tasks):
+            if task.parts > 1:
+                done_parts[task.pdf_path].append(ok)
+                if len(done_parts[task.pdf_path]) < task.parts:
+                    continue
+                ok = all(done_parts.pop(task.pdf_path))
+                if ok:
+                    stitch_parts(task.pdf_path, task.parts)
+                else:
+                    remove_parts(task.pdf_path)
+            if ok:
+                get_manifest().record(extracted_txt_path(task.pdf_path), task.pdf_path, EXTRACTION_PARAMS)
+            yield task.pdf_path, ok
+    finally:
+        # stopped part way through, the pdfs still missing parts are extracted from scratch next time
+        for pdf_path in done_parts:
+            remove_parts(pdf_path)
+
+# Extract the whole of 'pdf_path' in to its text file, returns whether it succeeded
+def _extract_whole(pdf_path):
+    try:
+        # file size of "pdf_path" can be potentially huge, so stream data in to txt file
+        with open(pdf_path, "rb") as infile, artifact_manifest.atomic_write(extracted_txt_path(pdf_path)) as outfile:
+            pdfminer.high_level.extract_text_to_fp(infile, outfile, laparams=pdfminer.layout.LAParams(), output_type="text", codec="utf-8")
+        return True
+    except Exception as e:
+        print(f"Failed to process {pdf_path}: {e}")
+        return False
+
+# returns True if it actually had to extract text, False if the txt file was already up to date
+# with workers > 1, a large pdf is split in to page ranges extracted in parallel on a pool of its own
+def extract_pdf(pdf_path, workers=1):
+    # Avoid extracting text if it already exists and the pdf hasn't changed since
+    if extraction_is_current(pdf_path):
+        return False
+
+    if workers > 1:
+        tasks = plan_extraction([pdf_path], workers)
+        if len(tasks) > 1:
+            with multiprocessing.Pool(processes=min(workers, len(tasks))) as pool:
+                return all(ok for _, ok in run_extraction(tasks, pool))
+    if not _extract_whole(pdf_path):
+        return False
+    get_manifest().record(extracted_txt_path(pdf_path), pdf_path, EXTRACTION_PARAMS)
+    return True
 
 # Process Corpus pdf files into text files
-def process_pdf_to_txt():
+# large pdfs are split in to page ranges that are extracted in parallel, unless split is False
+def process_pdf_to_txt(pdf_files=None, thread_count=None, split=True):
     print("  Starting PDF Extraction")
-    pdf_files = glob.glob(os.path.join(CORPUS_PATH, "*.pdf"))
+    if pdf_files is None:
+        pdf_files = corpus_pdfs()
+    thread_count = thread_count or THREAD_COUNT
     time_start = time.time()
-    pdf_files_sorted = sorted(pdf_files, key=os.path.getsize, reverse=True) # longest schedule first, greedy approximation
-    with multiprocessing.Pool(processes=__THREAD_COUNT) as pool:
-        pool.map(extract_pdf, pdf_files_sorted)
+
+    # Only extract pdfs that are new or changed, or were extracted with different parameters
+    pdf_files = [pdf_path for pdf_path in pdf_files if not extraction_is_current(pdf_path)]
+    if pdf_files:
+        with metrics.span("ingest.extract", workers=thread_count) as span:
+            tasks = plan_extraction(pdf_files, thread_count if split else 1)
+            with multiprocessing.Pool(processes=thread_count) as pool:
+                for _ in run_extraction(tasks, pool):
+                    span.add(items=1)
     print(f"    Extract Total: {time.time() - time_start}")
 
 # Chunk processed text files into new text files with one chunking per line
@@ -71,20 +426,12 @@ def chunk_processed_txt():
     txt_files = glob.glob(os.path.join(TXT_OUTPUT_DIRECTORY, "*.txt"))
     time_start = time.time()
 
-    # for every text file in "Processed_pdf", chunk it of size determined by .env
-    for txt_path in txt_files:
-        output_path = CHUNKS_OUTPUT_DIRECTORY + "/" + os.path.basename(txt_path)
-
-        if not os.path.exists(output_path):
-            with open(txt_path, "r", encoding="utf-8") as r:
-                text = r.read()
-            
-            text = normalize(text) # strips repetitive whitespace
-            # chunk_text(text: str, max_words: int, overlap: int)
-            chunked = chunk_text(text, CHUNK_WORD_COUNT, OVERLAP)
-            with open(output_path, "x", encoding="utf-8") as f:
-                for chunk in chunked:
-                    f.write(chunk + "\n")
+    # for every text file in "Processed_pdf", chunk it of size determined by .env, unless that is already done
+    with metrics.span("ingest.chunk", mode=CHUNK_MODE) as span:
+        for txt_path in txt_files:
+            if not chunks_are_current(txt_path):
+                write_chunks(txt_path)
+                span.add(items=1)
     print(f"    Chunk Total: {time.time() - time_start}")
 
 if __name__ == "__main__":
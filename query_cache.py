@@ -0,0 +1,70 @@
+# general utilities
+import os, time, threading, hashlib, dotenv
+from collections import OrderedDict
+
+dotenv.load_dotenv()
+
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", 1024))       # entries per cache
+QUERY_CACHE_TTL = float(os.environ.get("QUERY_CACHE_TTL", 3600))        # seconds, 0 disables expiry
+
+# Bumped whenever documents are added to or removed from the index, retrieval results cached under an older
+# generation are never served again.
+corpus_generation = 0
+_generation_lock = threading.Lock()
+
+def bump_corpus_generation():
+    global corpus_generation
+    with _generation_lock:
+        corpus_generation += 1
+        search_results.clear()
+        return corpus_generation
+
+# Queries that only differ in case or whitespace should share a cache entry, the embedding model is uncased anyway
+def normalize_query(query):
+    return " ".join(query.split()).lower()
+
+def embedding_key(embedding):
+    return hashlib.sha1(embedding.tobytes()).hexdigest()
+
+class LRUCache:
+    """
+    Thread-safe least recently used cache where each entry also expires 'ttl' seconds after it was stored.
+    """
+
+    def __init__(self, max_size=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()   # key -> (time stored, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+query_embeddings = LRUCache()   # normalized query text -> query embedding
+search_results = LRUCache()     # (embedding key, k, corpus generation) -> top k hits
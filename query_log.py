@@ -0,0 +1,182 @@
+# general utilities
+import os, queue, datetime, threading, atexit, dotenv
+import psycopg2, psycopg2.pool
+import db_pool
+import metrics
+
+dotenv.load_dotenv()
+
+QUERY_LOG_FLUSH_INTERVAL = float(os.environ.get("QUERY_LOG_FLUSH_INTERVAL", 2))   # seconds a logged query waits at most before it is written
+QUERY_LOG_BATCH_SIZE = int(os.environ.get("QUERY_LOG_BATCH_SIZE", 100))           # queries that trigger a write before the interval is up
+QUERY_LOG_MAX_PENDING = int(os.environ.get("QUERY_LOG_MAX_PENDING", 10000))       # queries held while the database is unreachable, newer ones are dropped
+
+# log_ids are taken from the sequence up front, so the rows that reference them can be written without a round trip each
+RESERVE_IDS_QUERY = """SELECT nextval(pg_get_serial_sequence('cs480_finalproject.querylog', 'log_id'))
+    FROM generate_series(1, %s);
+    """
+INSERT_LOGS_QUERY = """INSERT INTO cs480_finalproject.querylog (log_id, query_text, issuer_id, time_queried)
+    SELECT * FROM unnest(%s::int[], %s::varchar[], %s::int[], %s::timestamp[]);
+    """
+INSERT_MAKES_QUERY = """INSERT INTO cs480_finalproject.makes_query (end_id, log_id)
+    SELECT * FROM unnest(%s::int[], %s::int[]);
+    """
+# a document can be deleted between the search and the write, its rows are skipped rather than failing the batch
+INSERT_QUERIED_DOCS_QUERY = """INSERT INTO cs480_finalproject.queried_docs (log_id, doc_id)
+    SELECT q.log_id, q.doc_id FROM unnest(%s::int[], %s::int[]) AS q(log_id, doc_id)
+    JOIN cs480_finalproject.document d ON d.doc_id = q.doc_id
+    ON CONFLICT DO NOTHING;
+    """
+UPDATE_ACTIVITY_QUERY = """UPDATE cs480_finalproject.enduser e SET latest_activity = GREATEST(e.latest_activity, a.latest)
+    FROM unnest(%s::int[], %s::timestamp[]) AS a(end_id, latest)
+    WHERE e.end_id = a.end_id;
+    """
+
+class QueryLogWriter:
+    """
+    Write-behind logger for queries made by EndUsers.
+
+    log() only puts the query on a queue and returns, a background thread writes what has queued up every
+    QUERY_LOG_FLUSH_INTERVAL seconds, or as soon as QUERY_LOG_BATCH_SIZE queries are waiting, in one transaction: the
+    QueryLog rows, their Makes_Query and Queried_Docs rows, and each EndUser's latest_activity. A batch that fails to
+    write is retried with the next one. close() writes whatever is left, it is registered to run at exit.
+    """
+
+    def __init__(self, flush_interval=QUERY_LOG_FLUSH_INTERVAL, batch_size=QUERY_LOG_BATCH_SIZE,
+                 max_pending=QUERY_LOG_MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.batch_size = max(1, batch_size)
+        self.max_pending = max_pending
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._retry = []        # events of a batch that failed to write
+        self._thread = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="query-log", daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def log(self, query, enduser_id, doc_ids=()):
+        """
+        Record that 'enduser_id' asked 'query' and the documents 'doc_ids' were retrieved for it. Never blocks.
+        """
+        # the time it was asked, not the time it is written
+        event = (query, enduser_id, datetime.datetime.now(), sorted(set(d for d in doc_ids if d is not None)))
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            metrics.count("query_log_dropped")
+            return
+        if self._thread is None:
+            self.start()
+        if self._queue.qsize() >= self.batch_size:
+            self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def _take(self):
+        events, self._retry = self._retry, []
+        while True:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def flush(self):
+        """
+        Write every queued query now. Returns how many were written.
+        """
+        with self._lock:
+            events = self._take()
+            if not events:
+                return 0
+            try:
+                written = self._write_batch(events)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.pool.PoolError) as e:
+                # the database is unreachable, keep the batch (up to max_pending) for the next flush
+                print(f"  Could not write {len(events)} query log entries, will retry: {e}")
+                metrics.count("query_log_write_failed")
+                overflow = len(events) - self.max_pending
+                if overflow > 0:
+                    self.dropped += overflow
+                    events = events[overflow:]
+                self._retry = events
+                return 0
+            except psycopg2.Error:
+                # something in the batch can't be written, e.g. its EndUser was deleted since, so write them one at a
+                # time and drop only the ones that fail
+                written = 0
+                for event in events:
+                    try:
+                        written += self._write_batch([event])
+                    except psycopg2.Error as e:
+                        print(f"  Dropping query log entry for EndUser {event[1]}: {e}")
+                        self.dropped += 1
+                        metrics.count("query_log_dropped")
+            self.written += written
+            return written
+
+    def _write_batch(self, events):
+        with metrics.span("query.log_write") as span, db_pool.connection() as conn, conn.cursor() as cur:
+            self._write(cur, events)
+            conn.commit()
+            span.add(items=len(events))
+        return len(events)
+
+    def _write(self, cur, events):
+        cur.execute(RESERVE_IDS_QUERY, (len(events),))
+        log_ids = [row[0] for row in cur.fetchall()]
+        queries, issuers, times, doc_lists = zip(*events)
+        cur.execute(INSERT_LOGS_QUERY, (log_ids, [query[:1000] for query in queries], list(issuers), list(times)))
+        cur.execute(INSERT_MAKES_QUERY, (list(issuers), log_ids))
+
+        pairs = [(log_id, doc_id) for log_id, doc_ids in zip(log_ids, doc_lists) for doc_id in doc_ids]
+        if pairs:
+            cur.execute(INSERT_QUERIED_DOCS_QUERY, ([p[0] for p in pairs], [p[1] for p in pairs]))
+
+        latest = {}
+        for issuer, asked_at in zip(issuers, times):
+            latest[issuer] = max(asked_at, latest.get(issuer, asked_at))
+        cur.execute(UPDATE_ACTIVITY_QUERY, (list(latest), list(latest.values())))
+
+    def close(self):
+        """
+        Stop the background thread and write whatever is still queued. Meant for shutdown, it closes the pool after.
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._wake.set()
+            self._thread.join()
+        self.flush()
+        if self._retry:
+            print(f"  {len(self._retry)} query log entries could not be written.")
+        # at exit the pool may have been closed before this ran, and the flush above opened it again
+        db_pool.close_all()
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    """
+    The process wide QueryLogWriter, its thread is started on the first query logged.
+    """
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = QueryLogWriter()
+    return _writer
+
+def log_query(query, enduser_id, doc_ids=()):
+    get_writer().log(query, enduser_id, doc_ids)
@@ -0,0 +1,106 @@
+# Runs async_query.answer_query against llm_backend.FakeBackend and the fake Ollama server in benchmarks/, with the
+# database, embedding model and caches patched out. Usage: python -m pytest tests (or python -m unittest discover tests)
+import os, sys, io, asyncio, unittest, contextlib
+from unittest import mock
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+import numpy as np
+import llm_backend
+import answer_queries
+import answer_cache
+import query_log
+import async_query
+from fake_ollama import FakeOllama
+
+HITS = [{"rank": i + 1, "score": 0.1 * (i + 1), "doc_id": 1, "embed_id": i + 1, "chunk": f"chunk {i} " + "word " * 20}
+        for i in range(3)]
+
+async def fake_search(pool, query, k=answer_queries.FETCH_K, ef_search=None, filters=None):
+    await asyncio.sleep(0.01)
+    return [dict(hit) for hit in HITS]
+
+class CountingBackend(llm_backend.FakeBackend):
+    """
+    FakeBackend that records how many streams were being generated at once.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def _astream(self, messages):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            async for part in super()._astream(messages):
+                yield part
+        finally:
+            self.in_flight -= 1
+
+class AnswerQueryTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.object(answer_queries, "embed_query", lambda query: np.ones(answer_queries.EMBED_DIMENSION, dtype=np.float32)),
+            mock.patch.object(answer_cache, "lookup", lambda *args: None),
+            mock.patch.object(answer_cache, "store", lambda *args: None),
+            mock.patch.object(query_log, "log_query", mock.Mock()),
+            mock.patch.object(async_query, "search", fake_search),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def answer(self, backend, query="what is in the reports?"):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            answer = await async_query.answer_query(None, backend, 1, query)
+        return answer, out.getvalue()
+
+    # stdout is shared by every task, so concurrent answers are captured together
+    async def answer_all(self, backend, count):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            answers = await asyncio.gather(*(async_query.answer_query(None, backend, 1, f"question {i}")
+                                             for i in range(count)))
+        return answers, out.getvalue()
+
+    async def test_streams_the_answer(self):
+        backend = llm_backend.FakeBackend(first_token_delay=0.01, token_delay=0.001)
+        parts = [part["message"]["content"] async for part in backend.astream([{"role": "user", "content": "hi"}])]
+        self.assertGreater(len(parts), 2)   # token by token, not one message
+        self.assertEqual("".join(parts), llm_backend.FakeBackend.ANSWER)
+
+        answer, printed = await self.answer(backend)
+        self.assertEqual(answer, llm_backend.FakeBackend.ANSWER)
+        self.assertIn(llm_backend.FakeBackend.ANSWER, printed)
+        self.assertIn("time to first token", printed)
+        query_log.log_query.assert_called_with("what is in the reports?", 1, [1, 1, 1])
+
+    async def test_cached_answer_logs_its_documents(self):
+        cached = {"query_text": "what do the reports say?", "answer": "cached", "distance": 0.01, "doc_ids": [2, 3]}
+        backend = llm_backend.FakeBackend()
+        with mock.patch.object(answer_cache, "lookup", lambda *args: cached):
+            answer, printed = await self.answer(backend)
+        self.assertEqual(answer, "cached")
+        self.assertIn("cached answer to", printed)
+        self.assertEqual(backend.requests, 0)
+        query_log.log_query.assert_called_with("what is in the reports?", 1, [2, 3])
+
+    async def test_limits_concurrent_generations(self):
+        backend = CountingBackend(first_token_delay=0.05, token_delay=0.001, concurrency=2)
+        answers, _ = await self.answer_all(backend, 6)
+        self.assertEqual(answers, [llm_backend.FakeBackend.ANSWER] * 6)
+        self.assertEqual(backend.requests, 6)
+        self.assertEqual(backend.max_in_flight, 2)
+
+    async def test_streams_from_an_ollama_server(self):
+        with FakeOllama(first_token_delay=0.01, token_delay=0.001) as server:
+            backend = llm_backend.OllamaBackend(host=server.host, concurrency=2, retries=0)
+            answer, printed = await self.answer(backend)
+            self.assertTrue(answer)
+            self.assertIn(answer, printed)
+            answers, _ = await self.answer_all(backend, 4)
+        self.assertEqual(answers, [answer] * 4)
+
+if __name__ == "__main__":
+    unittest.main()